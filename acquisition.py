@@ -0,0 +1,280 @@
+"""Acquisition of the camera frames in a dedicated process.
+
+The process owns the I2C bus of the cameras and reads their frames one
+after the other, computing the temperatures and the pixel corrections, so
+this work does not compete for the GIL with the motor stepping and the MQTT
+client of the main process. The frames are written into a
+``SharedFrameRing`` per camera, read in place by the main process; only the
+notifications of the new frames go through a pipe, and only when a reader
+of the main process waits for them.
+"""
+
+import time
+import logging
+import threading
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+
+# Committed frames and latest slot, at the start of the shared memory
+_HEADER = 2
+
+
+class SharedFrameRing:
+    """Ring of frame slots in shared memory, written by a single process.
+
+    It has the interface of ``thermalcamera.FrameRing``: the writer
+    acquires a slot, writes the frame in place and commits it, the readers
+    get views of the slots, valid until the ring wraps around.
+
+    Parameters
+    ----------
+    size : int
+        Number of slots.
+    pixels : int
+        Number of pixels of a frame.
+    name : str, optional
+        Name of the shared memory to attach to, created if not given.
+    """
+
+    def __init__(self, size=16, pixels=24 * 32, name=None):
+        nbytes = 8 * (_HEADER + 3 * size) + 4 * size * pixels
+        self.owner = name is None
+        self.shm = shared_memory.SharedMemory(name=name, create=self.owner, size=nbytes)
+        self.name = self.shm.name
+        self.size = size
+        self.pixels = pixels
+        # The views hold the memory, which stays mapped while a frame is in use
+        buffer = self.shm.buf
+        self._header = np.frombuffer(buffer, np.int64, _HEADER)
+        self.sequence = np.frombuffer(buffer, np.int64, size, 8 * _HEADER)
+        self.timestamp = np.frombuffer(buffer, np.float64, size, 8 * (_HEADER + size))
+        self.position = np.frombuffer(buffer, np.float64, size, 8 * (_HEADER + 2 * size))
+        self.frames = np.frombuffer(buffer, np.float32, size * pixels, 8 * (_HEADER + 3 * size)).reshape(size, pixels)
+        if self.owner:
+            self._header[:] = (0, -1)
+            self.sequence.fill(-1)
+        self._count = int(self._header[0])
+
+    def acquire(self):
+        """Reserve the next slot for writing, see ``FrameRing.acquire``."""
+        index = self._count % self.size
+        self._count += 1
+        self.sequence[index] = -1
+        return index, self.frames[index]
+
+    def commit(self, index, position, timestamp=None):
+        """Publish the frame written into a slot, see ``FrameRing.commit``."""
+        sequence = int(self._header[0])
+        self.timestamp[index] = time.time() if timestamp is None else timestamp
+        self.position[index] = position
+        self.sequence[index] = sequence
+        # The readers look at the latest slot last
+        self._header[1] = index
+        self._header[0] = sequence + 1
+        return sequence
+
+    def record(self, index):
+        """Get the frame in a slot with its metadata, see ``FrameRing.record``."""
+        from thermalcamera import FrameRecord
+
+        return FrameRecord(
+            self.frames[index],
+            int(self.sequence[index]),
+            float(self.timestamp[index]),
+            float(self.position[index]),
+        )
+
+    def latest(self):
+        """Get the latest committed slot, None if no frame was committed yet."""
+        index = int(self._header[1])
+        return None if index < 0 else index
+
+    def close(self):
+        """Detach from the shared memory, and free it if this ring created it.
+
+        The frame views returned by ``acquire`` and ``record`` must be
+        released first, the memory cannot be unmapped under them
+        (``BufferError``).
+        """
+        self._header = self.sequence = self.timestamp = self.position = self.frames = None
+        if self.owner:
+            self.shm.unlink()
+        self.shm.close()
+
+
+def _acquire(backend, engine, addresses, names, ring_names, size, position, waiting, stop, connection, calibration):
+    """Main function of the acquisition process."""
+    from hardware import create_backend
+    from pixel_pipeline import load_pixel_pipelines
+    from thermalcamera import CameraPool, create_camera
+
+    backend = create_backend(backend)
+    if hasattr(backend, "follow"):
+        # Simulated cameras look from the motor angle of the main process
+        backend.follow(lambda: position.value)
+    cameras = CameraPool({name: lambda address=address: create_camera(backend, address, engine) for name, address in zip(names, addresses)})
+    rings = [SharedFrameRing(size, name=ring_name) for ring_name in ring_names]
+    pipelines = load_pixel_pipelines(calibration, names)
+    errors = 0
+    buffer = None
+    try:
+        while not stop.is_set():
+            for i, name in enumerate(names):
+                if stop.is_set():
+                    break
+                ring = rings[i]
+                index, buffer = ring.acquire()
+                start = position.value
+                try:
+                    cameras[name].getFrame(buffer)
+                except Exception as e:
+                    errors += 1
+                    if errors == 1 or errors % 100 == 0:
+                        logging.error(f"Acquisition error of {name} ({errors} so far): {e}")
+                    time.sleep(0.1)
+                    continue
+                pipelines[name].correct(buffer)
+                # A frame read while the motor moved has no position
+                end = position.value
+                ring.commit(index, start if end == start else np.nan)
+                if waiting[i]:
+                    waiting[i] = 0
+                    connection.send(i)
+    finally:
+        # The view of the last slot, released before unmapping the rings
+        buffer = None
+        for ring in rings:
+            ring.close()
+        connection.close()
+
+
+class AcquisitionProcess:
+    """Process acquiring the frames of the cameras into shared memory rings.
+
+    Parameters
+    ----------
+    backend : str
+        Name of the hardware backend, see ``hardware.create_backend``.
+    engine : str
+        Temperature calculation engine of the cameras.
+    addresses : list of int
+        I2C addresses of the cameras.
+    names : list of str
+        Names of the cameras.
+    size : int
+        Number of slots of each ring.
+    position : float
+        Initial motor position in degrees.
+    calibration : str
+        Path of the pixel calibration file, see ``pixel_pipeline``.
+
+    Attributes
+    ----------
+    rings : dict
+        ``SharedFrameRing`` of each camera.
+    """
+
+    def __init__(self, backend, engine, addresses, names, size=16, position=0.0, calibration="pixel_calibration.json"):
+        context = multiprocessing.get_context("spawn")
+        self.names = list(names)
+        self.rings = {name: SharedFrameRing(size) for name in self.names}
+        self._position = context.RawValue("d", position)
+        # Cameras with a reader waiting for a frame, to notify
+        self._waiting = context.RawArray("b", len(self.names))
+        self._stop = context.Event()
+        self._conditions = {name: threading.Condition() for name in self.names}
+        receiver, sender = context.Pipe(duplex=False)
+        self._receiver = receiver
+        self.process = context.Process(
+            target=_acquire,
+            args=(
+                backend,
+                engine,
+                list(addresses),
+                self.names,
+                [ring.name for ring in self.rings.values()],
+                size,
+                self._position,
+                self._waiting,
+                self._stop,
+                sender,
+                calibration,
+            ),
+            name="acquisition",
+            daemon=True,
+        )
+        self.process.start()
+        sender.close()
+        self._listener = threading.Thread(target=self._listen, name="acquisition-listener", daemon=True)
+        self._listener.start()
+
+    @property
+    def position(self):
+        """Motor position in degrees shared with the acquisition process."""
+        return self._position.value
+
+    @position.setter
+    def position(self, value):
+        self._position.value = value
+
+    def _listen(self):
+        while True:
+            try:
+                i = self._receiver.recv()
+            except (EOFError, OSError):
+                break
+            condition = self._conditions[self.names[i]]
+            with condition:
+                condition.notify_all()
+        # Wake up the readers of a stopped process
+        for condition in self._conditions.values():
+            with condition:
+                condition.notify_all()
+
+    def next_record(self, camera, timeout=None):
+        """Wait for the next frame of a camera.
+
+        Parameters
+        ----------
+        camera : str
+            Name of the camera.
+        timeout : float, optional
+            Maximum time to wait in seconds.
+
+        Returns
+        -------
+        record : FrameRecord
+            View of the frame in the shared ring, with its metadata.
+        """
+        ring = self.rings[camera]
+        i = self.names.index(camera)
+        condition = self._conditions[camera]
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with condition:
+            index = ring.latest()
+            sequence = -1 if index is None else ring.sequence[index]
+            while True:
+                # Asked before checking, so a frame committed meanwhile is notified
+                self._waiting[i] = 1
+                index = ring.latest()
+                if index is not None and ring.sequence[index] > sequence:
+                    return ring.record(index)
+                if not self.process.is_alive():
+                    raise RuntimeError(f"The acquisition process stopped with code {self.process.exitcode}")
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise TimeoutError(f"No frame of {camera} within {timeout} s")
+                condition.wait(remaining)
+
+    def close(self, timeout=5.0):
+        """Stop the process and free the rings."""
+        self._stop.set()
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self._listener.join(timeout)
+        self._receiver.close()
+        for ring in self.rings.values():
+            ring.close()
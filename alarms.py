@@ -0,0 +1,225 @@
+"""Hotspot alarms evaluated on the acquired frames."""
+
+import threading
+import numpy as np
+
+from stitching import DEFAULT_LAYOUT, oriented_pixel_index
+
+RULE_FIELDS = ("name", "camera", "region", "sector", "threshold", "rate", "hysteresis", "hold")
+
+
+class AlarmEngine:
+    """Threshold and rate-of-rise alarm rules, evaluated with NumPy masks.
+
+    Each rule watches the maximum temperature, or the maximum rate of rise
+    of the pixels, in the pixels selected by its mask: a camera, a region of
+    the upright image and a sector of the panorama. All the rules are
+    evaluated at once on each frame, as a masked maximum over a
+    ``(rules, pixels)`` array, so adding rules does not add Python work.
+
+    A rule is a dictionary with:
+
+    - ``name``: unique name of the rule;
+    - ``camera``: name of the camera, all the cameras if omitted;
+    - ``region``: ``[first_row, last_row, first_column, last_column]``
+      (exclusive ends) of the upright 32 by 24 image, see
+      ``stitching.oriented_pixel_index``, the whole image if omitted;
+    - ``sector``: ``[start, end]`` azimuth in degrees of the panorama,
+      clockwise and possibly across 0, the whole turn if omitted;
+    - ``threshold``: temperature in Celsius, or ``rate``: rate of rise in
+      kelvin per second between two frames at the same position;
+    - ``hysteresis``: the alarm clears below the limit minus the hysteresis,
+      1 by default;
+    - ``hold``: time in seconds the condition must last before the alarm is
+      raised or cleared, 0 by default.
+
+    The state of the rules is kept per camera.
+
+    Parameters
+    ----------
+    rules : list of dict
+        Alarm rules.
+    layout : dict, optional
+        Yaw and pitch in degrees of each camera at motor position 0, see
+        ``stitching.PanoramaStitcher``.
+    fov : float
+        Horizontal field of view of the upright image in degrees.
+
+    Attributes
+    ----------
+    publish : callable
+        Function taking each alarm event, see ``evaluate``, None to only
+        return them.
+    """
+
+    def __init__(self, rules=(), layout=None, fov=35.0):
+        self.layout = dict(DEFAULT_LAYOUT if layout is None else layout)
+        self.cameras = list(self.layout)
+        self.publish = None
+        self._lock = threading.Lock()
+        index = oriented_pixel_index()
+        height, width = index.shape
+        focal = (width / 2) / np.tan(np.radians(fov / 2))
+        self._pixels = index.size
+        self._index = index
+        # Azimuth of each column relative to the camera, and column of each raw pixel
+        self._column_azimuth = np.degrees(np.arctan((np.arange(width) - (width - 1) / 2) / focal))
+        self._pixel_column = np.empty(index.size, dtype=np.intp)
+        self._pixel_column[index] = np.arange(width)
+        self.configure(rules)
+
+    def configure(self, rules):
+        """Replace the rules, and forget the alarms.
+
+        Parameters
+        ----------
+        rules : list of dict
+            Alarm rules, see ``AlarmEngine``.
+        """
+        rules = [dict(rule) for rule in rules]
+        names = [rule.get("name") for rule in rules]
+        if None in names or len(set(names)) != len(names):
+            raise ValueError("Each alarm rule must have a unique name")
+        n = len(rules)
+        masks = np.zeros((len(self.cameras), n, self._pixels), dtype=bool)
+        is_rate = np.zeros((n,), dtype=bool)
+        limit = np.zeros((n,))
+        sectors = np.zeros((n, 2))
+        has_sector = np.zeros((n,), dtype=bool)
+        for i, rule in enumerate(rules):
+            unknown = set(rule) - set(RULE_FIELDS)
+            if unknown:
+                raise ValueError(f"Unknown fields {sorted(unknown)} of the alarm rule {rule['name']}")
+            if ("threshold" in rule) == ("rate" in rule):
+                raise ValueError(f"The alarm rule {rule['name']} needs either a threshold or a rate")
+            region = np.zeros(self._index.shape, dtype=bool)
+            row0, row1, column0, column1 = rule.get("region", (0, region.shape[0], 0, region.shape[1]))
+            region[row0:row1, column0:column1] = True
+            pixels = self._index[region]
+            camera = rule.get("camera")
+            if camera is not None and camera not in self.cameras:
+                raise ValueError(f"Unknown camera {camera} of the alarm rule {rule['name']}")
+            for c, name in enumerate(self.cameras):
+                if camera is None or camera == name:
+                    masks[c, i, pixels] = True
+            is_rate[i] = "rate" in rule
+            limit[i] = rule["rate"] if is_rate[i] else rule["threshold"]
+            if "sector" in rule:
+                has_sector[i] = True
+                sectors[i] = rule["sector"]
+        with self._lock:
+            self.rules = rules
+            self._masks = masks
+            self._is_rate = is_rate
+            self._limit = limit
+            self._clear = limit - np.array([rule.get("hysteresis", 1.0) for rule in rules])
+            self._hold = np.array([rule.get("hold", 0.0) for rule in rules])
+            self._sectors = np.nonzero(has_sector)[0]
+            self._temperatures = np.nonzero(~is_rate)[0]
+            self._rates = np.nonzero(is_rate)[0]
+            self._sector_start = sectors[has_sector, 0] % 360
+            self._sector_width = (sectors[has_sector, 1] - sectors[has_sector, 0]) % 360
+            self._active = np.zeros((len(self.cameras), n), dtype=bool)
+            self._since = np.full((len(self.cameras), n), np.nan)
+            self._previous = {}
+
+    def active(self):
+        """Get the raised alarms as ``(rule name, camera)`` pairs."""
+        with self._lock:
+            return [(self.rules[i]["name"], self.cameras[c]) for c, i in zip(*np.nonzero(self._active))]
+
+    @staticmethod
+    def _masked_max(data, masks):
+        """Maximum of the pixels of each mask, -inf for an empty mask."""
+        return np.max(np.broadcast_to(data, masks.shape), axis=1, where=masks, initial=-np.inf)
+
+    def evaluate(self, camera, frame, position, timestamp):
+        """Evaluate the rules on a frame.
+
+        Parameters
+        ----------
+        camera : str
+            Name of the camera.
+        frame : numpy.ndarray
+            Raw 768-pixel frame in Celsius.
+        position : float
+            Motor position in degrees.
+        timestamp : float
+            Acquisition time in seconds since the epoch.
+
+        Returns
+        -------
+        events : list of dict
+            Alarms raised or cleared by the frame: ``rule``, ``camera``,
+            ``state`` (``raised`` or ``cleared``), ``value`` and ``limit``,
+            ``row`` and ``column`` of the pixel in the upright image,
+            ``position`` and ``timestamp``. They are also passed to
+            ``publish``.
+        """
+        if camera not in self.layout:
+            return []
+        c = self.cameras.index(camera)
+        with self._lock:
+            if not self.rules:
+                return []
+            masks = self._masks[c]
+            # A frame read while the motor moved has no position (NaN)
+            positioned = bool(np.isfinite(position))
+            if self._sectors.size:
+                masks = masks.copy()
+                if positioned:
+                    # The azimuth only depends on the column of the pixel
+                    azimuth = (self._column_azimuth + self.layout[camera][0] + position) % 360
+                    inside = (azimuth[None, :] - self._sector_start[:, None]) % 360 <= self._sector_width[:, None]
+                    masks[self._sectors] &= inside[:, self._pixel_column]
+                else:
+                    # Not evaluated, the sector rules keep their state
+                    masks[self._sectors] = False
+            # Bad (-273.15) and failed (NaN) pixels are ignored
+            valid = np.where(frame > -273, frame, -np.inf)
+            value = np.full((len(self.rules),), -np.inf)
+            value[self._temperatures] = self._masked_max(valid, masks[self._temperatures])
+            rates = None
+            if self._rates.size:
+                # Rate of rise against the previous frame at the same position
+                previous = self._previous.get(camera)
+                if positioned and previous is not None and previous[1] == position and timestamp > previous[2]:
+                    rates = (valid - previous[0]) / (timestamp - previous[2])
+                    rates[~np.isfinite(rates)] = -np.inf
+                    value[self._rates] = self._masked_max(rates, masks[self._rates])
+                if positioned:
+                    self._previous[camera] = (valid, position, timestamp)
+            evaluated = np.isfinite(value)
+            active = self._active[c]
+            since = self._since[c]
+            # Conditions to change state, with hysteresis
+            pending = evaluated & np.where(active, value < self._clear, value > self._limit)
+            # The rules not evaluated, e.g. rates without a previous frame, keep their state
+            since[evaluated & ~pending] = np.nan
+            since[pending & np.isnan(since)] = timestamp
+            fire = pending & (timestamp - since >= self._hold)
+            active[fire] = ~active[fire]
+            since[fire] = np.nan
+            events = []
+            for i in np.nonzero(fire)[0]:
+                # Pixel of the value, only located for the events
+                data = rates if self._is_rate[i] else valid
+                pixel = np.where(masks[i], data, -np.inf).argmax()
+                row, column = np.argwhere(self._index == pixel)[0]
+                events.append(
+                    {
+                        "rule": self.rules[i]["name"],
+                        "camera": camera,
+                        "state": "raised" if active[i] else "cleared",
+                        "value": round(float(value[i]), 2),
+                        "limit": float(self._limit[i]),
+                        "row": int(row),
+                        "column": int(column),
+                        "position": position if positioned else None,
+                        "timestamp": timestamp,
+                    }
+                )
+        if self.publish is not None:
+            for event in events:
+                self.publish(event)
+        return events
@@ -1,74 +1,277 @@
+"""REST API of the thermal camera system.
+
+The frames are acquired once by a ``frame_server.FrameServer`` and served
+from memory, whatever the number of clients:
+
+- ``GET /frames/<camera>``: latest frame of a camera, with an ``ETag``; a
+  request with ``If-None-Match`` gets ``304 Not Modified`` until a new frame
+  is acquired, and with ``?wait=<seconds>`` it waits for the new frame
+  (long polling);
+- ``GET /stream?cameras=camera0,camera2``: long-lived chunked
+  ``multipart/x-mixed-replace`` stream of the new frames of the cameras, all
+  by default, each part with ``X-Camera``, ``X-Sequence`` and ``ETag``
+  headers. Each stream holds a server thread until the client disconnects,
+  so beyond ``MAX_STREAMS`` concurrent streams the answer is ``503 Service
+  Unavailable``: ``MAX_STREAMS`` must stay below the threads of the server,
+  see ``start_server.sh``, to leave some to the other requests.
+
+The motion requests return ``202 Accepted`` at once with a job, executed in
+order by a ``commands.CommandExecutor``:
+
+- ``POST /move`` with ``{"angle": ...}`` (relative) or ``{"position": ...}``
+  (absolute, ``"wrap": true`` for the shortest path);
+- ``POST /calibrate``;
+- ``GET /jobs/<id>``: status of a job, ``DELETE /jobs/<id>`` cancels it.
+
+``GET /history?camera=camera0&start=-604800&summary=1`` gives the statistics
+of the frames recorded by the frame server, see ``timeseries``: the buckets
+of a time range, or with ``summary`` their extrema per camera.
+
+``GET /state`` gives the motor position, the frame server statistics and the
+command latencies. The frames are encoded in the format of ``FRAME_FORMAT``,
+see ``frame_format``.
+"""
+
 import os
-import time
-from flask import Flask, Response, jsonify, request
+import threading
+from collections import OrderedDict
+from flask import Flask, Response, request
 from flask_restful import Resource, Api
+from werkzeug.wsgi import ClosingIterator
 
-import paho.mqtt.client as mqtt
-
+from commands import CommandExecutor
+from frame_server import FrameServer
 from thermalcamera import ThermalCamera
+from timeseries import StatisticsStore, rows_to_dict
 
-# MQTT
-broker = "192.168.0.45"
-brokerport = 1883
-# Flask
-app = Flask(__name__)
-api = Api(app)
-# Global ThermalCamera object
-thermal_camera = ThermalCamera(absolute_position=0)
+FRAME_FORMAT = os.environ.get("THERMALCAMERA_FRAME_FORMAT", "float32")
+# Frames per second of each camera
+FRAME_RATE = float(os.environ.get("THERMALCAMERA_FRAME_RATE", "1.0"))
+HISTORY_DIRECTORY = os.environ.get("THERMALCAMERA_HISTORY", "history")
+# Concurrent streams, below the 32 threads of start_server.sh
+MAX_STREAMS = int(os.environ.get("THERMALCAMERA_MAX_STREAMS", "24"))
+# Seconds before a refused stream client retries
+STREAM_RETRY_AFTER = 10
+# Finished jobs kept for the status requests
+MAX_JOBS = 100
+BOUNDARY = "frame"
 
 
-# REST API endpoints
-class ImportPosition(Resource):
-    def post(self):
-        thermal_camera.import_absolute_position()
-        return {"status": "success"}, 200
+class JobResults:
+    """Latest status of the recent motion jobs, see ``CommandExecutor``."""
 
+    def __init__(self, size=MAX_JOBS):
+        self.size = size
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+
+    def update(self, result):
+        with self._lock:
+            self._results[result["id"]] = {**self._results.pop(result["id"], {}), **result}
+            while len(self._results) > self.size:
+                self._results.popitem(last=False)
+
+    def get(self, job_id):
+        with self._lock:
+            result = self._results.get(job_id)
+            return None if result is None else dict(result)
+
+
+class Frame(Resource):
+    def __init__(self, server):
+        self.server = server
+
+    def get(self, camera):
+        if camera not in self.server.cameras:
+            return {"error": f"Unknown camera {camera}"}, 404
+        wait = request.args.get("wait", type=float)
+        if wait is not None and request.if_none_match:
+            etag = next(iter(request.if_none_match.as_set()), None)
+            snapshot = self.server.wait(camera, etag, timeout=wait)
+        else:
+            snapshot = self.server.latest(camera)
+        if snapshot is None:
+            return {"error": f"No frame of {camera} yet"}, 503
+        response = Response(snapshot.payload, mimetype=self.server.mimetype)
+        response.set_etag(snapshot.etag)
+        response.headers["Cache-Control"] = "no-cache"
+        response.headers["X-Sequence"] = str(snapshot.sequence)
+        response.headers["X-Position"] = str(snapshot.position)
+        response.headers["X-Timestamp"] = str(snapshot.timestamp)
+        return response.make_conditional(request)
 
-class GetFrameAtRelativeAngle(Resource):
-    def get(self):
-        args = request.get_json()
-        thermal_camera.rotate(args["angle"])
-        return Response(
-            thermal_camera.get_frame_as_bytes("camera-0"), mimetype="application/octet-stream"
-        )
 
+class Stream(Resource):
+    def __init__(self, server, slots):
+        self.server = server
+        self.slots = slots
 
-class GetFrameAtAbsoluteAngle(Resource):
     def get(self):
-        args = request.get_json()
-        thermal_camera.go_to(args["position"])
-        return Response(
-            thermal_camera.get_frame_as_bytes("camera-0"), mimetype="application/octet-stream"
-        )
+        cameras = request.args.get("cameras")
+        if not self.slots.acquire(blocking=False):
+            return {"error": "Too many streams"}, 503, {"Retry-After": str(STREAM_RETRY_AFTER)}
+        try:
+            updates = self.server.updates(None if cameras is None else cameras.split(","))
+        except KeyError as e:
+            self.slots.release()
+            return {"error": f"Unknown cameras {e}"}, 404
+        mimetype = self.server.mimetype
+
+        def parts():
+            for snapshot in updates:
+                yield (
+                    f"--{BOUNDARY}\r\nContent-Type: {mimetype}\r\nContent-Length: {len(snapshot.payload)}\r\n"
+                    f"X-Camera: {snapshot.camera}\r\nX-Sequence: {snapshot.sequence}\r\nETag: \"{snapshot.etag}\"\r\n\r\n"
+                ).encode() + snapshot.payload + b"\r\n"
+
+        # Closed by the server when the client disconnects, even before the first part
+        body = ClosingIterator(parts(), self.slots.release)
+        return Response(body, mimetype=f"multipart/x-mixed-replace; boundary={BOUNDARY}", direct_passthrough=True)
+
+
+class Move(Resource):
+    def __init__(self, thermal_camera, executor):
+        self.thermal_camera = thermal_camera
+        self.executor = executor
+
+    def post(self):
+        args = request.get_json(silent=True) or {}
+        if ("angle" in args) == ("position" in args):
+            return {"error": "Give either an angle or a position"}, 400
+        if "angle" in args:
+            job_id = self.executor.submit("rotate", "motor", lambda p: self.thermal_camera.rotate(float(p["angle"])), args)
+        else:
+            job_id = self.executor.submit(
+                "go_to",
+                "motor",
+                lambda p: self.thermal_camera.go_to(float(p["position"]), wrap=bool(p.get("wrap", False))),
+                args,
+            )
+        return {"id": job_id, "status": "accepted"}, 202, {"Location": f"/jobs/{job_id}"}
 
 
 class Calibrate(Resource):
+    def __init__(self, thermal_camera, executor):
+        self.thermal_camera = thermal_camera
+        self.executor = executor
+
     def post(self):
-        thermal_camera.calibrate()
+        job_id = self.executor.submit("calibrate", "motor", lambda p: self.thermal_camera.calibrate(), {})
+        return {"id": job_id, "status": "accepted"}, 202, {"Location": f"/jobs/{job_id}"}
+
+
+class Job(Resource):
+    def __init__(self, executor, results):
+        self.executor = executor
+        self.results = results
+
+    def get(self, job_id):
+        result = self.results.get(job_id)
+        if result is None:
+            return {"error": f"Unknown job {job_id}"}, 404
+        return result, 200
+
+    def delete(self, job_id):
+        if not self.executor.cancel(job_id):
+            return {"error": f"Job {job_id} is not queued nor running"}, 404
+        return {"id": job_id, "status": "cancelling"}, 202
+
+
+class ImportPosition(Resource):
+    def __init__(self, thermal_camera):
+        self.thermal_camera = thermal_camera
+
+    def post(self):
+        self.thermal_camera.import_absolute_position()
         return {"status": "success"}, 200
 
 
-class StartMonitoring(Resource):
+class History(Resource):
+    def __init__(self, history):
+        self.history = history
+
+    def get(self):
+        args = request.args
+        camera = args.get("camera")
+        start = args.get("start", type=float)
+        stop = args.get("stop", type=float)
+        positions = args.get("positions", "0").lower() in ("1", "true")
+        try:
+            if args.get("summary", "0").lower() in ("1", "true"):
+                resolution, rows = self.history.summary(camera, start, stop, positions)
+            else:
+                resolution, rows = self.history.query(camera, start, stop, args.get("resolution", type=float), positions)
+        except ValueError as e:
+            return {"error": str(e)}, 400
+        return {"resolution": resolution, **rows_to_dict(rows)}, 200
+
+
+class State(Resource):
+    def __init__(self, thermal_camera, server, executor):
+        self.thermal_camera = thermal_camera
+        self.server = server
+        self.executor = executor
+
     def get(self):
-        while True:
-            print("Starting monitoring...")
-            mqqttclient = mqtt.Client("thermalcam")
-            mqqttclient.connect(broker, brokerport)
-            mqqttclient.publish(
-                "/thermalcamera/camera2/image", thermal_camera.get_frame_as_bytes()
-            )
-            print("Done.")
-            time.sleep(10)
         return {
-            "status": "success"
-        }, 200  # TODO This is never reached, implement a better solution
+            "absolute_position": self.thermal_camera.absolute_position,
+            "frame_server": self.server.stats(),
+            "frame_cache": self.thermal_camera.frame_cache.stats(),
+            "commands": self.executor.metrics(),
+        }, 200
+
+
+def create_app(thermal_camera=None, rate=FRAME_RATE, fmt=FRAME_FORMAT, history=None, max_streams=MAX_STREAMS):
+    """Create the REST application and start its frame server.
+
+    Parameters
+    ----------
+    thermal_camera : ThermalCamera, optional
+        Thermal camera, created at position 0 by default.
+    rate : float
+        Frames per second of each camera.
+    fmt : str
+        Format of the frames, one of ``frame_format.FORMATS``.
+    history : timeseries.StatisticsStore, optional
+        Store of the statistics of the frames, in ``HISTORY_DIRECTORY`` by
+        default.
+    max_streams : int
+        Maximum number of concurrent streams.
 
+    Returns
+    -------
+    app : flask.Flask
+        Application, with the ``thermal_camera``, ``frame_server``,
+        ``executor`` and ``history`` in its ``extensions``.
+    """
+    if thermal_camera is None:
+        thermal_camera = ThermalCamera(absolute_position=0)
+    if history is None:
+        history = StatisticsStore(HISTORY_DIRECTORY)
+    server = FrameServer(
+        list(thermal_camera.frame_rings),
+        lambda camera, sequence: thermal_camera.get_filtered_record(camera, newer_than=sequence),
+        rate,
+        fmt,
+        history,
+    )
+    results = JobResults()
+    executor = CommandExecutor(results.update, {"motor": thermal_camera.cancel_event})
+    app = Flask(__name__)
+    api = Api(app)
+    api.add_resource(Frame, "/frames/<string:camera>", resource_class_args=(server,))
+    api.add_resource(Stream, "/stream", resource_class_args=(server, threading.BoundedSemaphore(max_streams)))
+    api.add_resource(Move, "/move", resource_class_args=(thermal_camera, executor))
+    api.add_resource(Calibrate, "/calibrate", resource_class_args=(thermal_camera, executor))
+    api.add_resource(Job, "/jobs/<string:job_id>", resource_class_args=(executor, results))
+    api.add_resource(ImportPosition, "/import-position", resource_class_args=(thermal_camera,))
+    api.add_resource(History, "/history", resource_class_args=(history,))
+    api.add_resource(State, "/state", resource_class_args=(thermal_camera, server, executor))
+    app.extensions.update(thermal_camera=thermal_camera, frame_server=server, executor=executor, history=history)
+    server.start()
+    return app
 
-api.add_resource(ImportPosition, "/import-position")
-api.add_resource(GetFrameAtRelativeAngle, "/get-frame-relative")
-api.add_resource(GetFrameAtAbsoluteAngle, "/get-frame-absolute")
-api.add_resource(Calibrate, "/calibrate")
-api.add_resource(StartMonitoring, "/start-monitoring")
 
 if __name__ == "__main__":
-    app.run(debug=True)
+    # Threaded, so the streams do not block the other requests
+    create_app().run(threaded=True)
@@ -0,0 +1,242 @@
+"""Append-only on-disk archive of the thermal camera frames.
+
+The archive is a directory of chunks. Each chunk is a pair of files:
+
+- ``frames_NNNNNN.f32``: the frames, raw little-endian float32, 768 pixels each,
+  which can be memory-mapped;
+- ``frames_NNNNNN.idx``: one ``INDEX_DTYPE`` record per frame (timestamp, motor
+  position, camera number and sequence number).
+
+Both files are only appended to, so a frame lost in a crash can only be the
+last one, and readers ignore the records without a complete frame.
+"""
+
+import os
+import glob
+import logging
+import threading
+import numpy as np
+
+from frame_format import camera_number
+
+PIXELS = 24 * 32
+INDEX_DTYPE = np.dtype(
+    [
+        ("timestamp", "<f8"),
+        ("position", "<f4"),
+        ("camera", "u1"),
+        ("sequence", "<u4"),
+    ]
+)
+
+
+class FrameArchiveWriter:
+    """Writer appending frames to an archive.
+
+    Every writer starts a new chunk, and a new chunk is started every
+    ``chunk_frames`` frames. The writer can be shared by several threads;
+    the frames appended after ``close`` are not archived.
+
+    Parameters
+    ----------
+    directory : str
+        Directory of the archive, created if needed.
+    chunk_frames : int
+        Maximum number of frames in a chunk.
+
+    Attributes
+    ----------
+    lock : threading.RLock
+        Lock of the writes, held to close the writer while other threads
+        may append.
+    """
+
+    def __init__(self, directory, chunk_frames=4096):
+        self.directory = directory
+        self.chunk_frames = chunk_frames
+        os.makedirs(directory, exist_ok=True)
+        chunks = _chunk_numbers(directory)
+        self._chunk = chunks[-1] + 1 if chunks else 0
+        self._frames = 0
+        self._data = None
+        self._index = None
+        self._closed = False
+        self.lock = threading.RLock()
+
+    def _open_chunk(self):
+        self._close_chunk()
+        path = os.path.join(self.directory, f"frames_{self._chunk:06d}")
+        self._data = open(f"{path}.f32", "ab")
+        self._index = open(f"{path}.idx", "ab")
+        self._chunk += 1
+        self._frames = 0
+
+    def append(self, camera, frame, timestamp, position, sequence=0):
+        """Append a frame to the archive.
+
+        Parameters
+        ----------
+        camera : str or int
+            Name or number of the camera.
+        frame : numpy.ndarray
+            Frame of 768 pixels in Celsius.
+        timestamp : float
+            Acquisition time in seconds since the epoch.
+        position : float
+            Motor position in degrees.
+        sequence : int
+            Sequence number of the frame.
+        """
+        record = np.zeros((1,), dtype=INDEX_DTYPE)
+        record["timestamp"] = timestamp
+        record["position"] = position
+        record["camera"] = camera if isinstance(camera, int) else camera_number(camera)
+        record["sequence"] = sequence & 0xFFFFFFFF
+        data = np.ascontiguousarray(frame, dtype="<f4")
+        with self.lock:
+            if self._closed:
+                logging.warning("Frame appended to a closed archive, not archived")
+                return
+            if self._data is None or self._frames >= self.chunk_frames:
+                self._open_chunk()
+            # Frame first: an index record always points to a complete frame
+            self._data.write(memoryview(data))
+            self._index.write(record.tobytes())
+            self._frames += 1
+
+    def flush(self):
+        """Hand the buffered frames over to the operating system."""
+        with self.lock:
+            if self._data is not None:
+                self._data.flush()
+                self._index.flush()
+
+    def close(self):
+        """Flush the frames to disk and close the writer."""
+        with self.lock:
+            self._closed = True
+            self._close_chunk()
+
+    def _close_chunk(self):
+        if self._data is not None:
+            for f in (self._data, self._index):
+                f.flush()
+                os.fsync(f.fileno())
+                f.close()
+            self._data = None
+            self._index = None
+
+
+class FrameArchive:
+    """Reader of an archive.
+
+    Only the indexes are read when querying, the frames are memory-mapped and
+    only the selected ones are copied.
+
+    Parameters
+    ----------
+    directory : str
+        Directory of the archive.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def chunks(self):
+        """Get the index and the memory-mapped frames of each chunk.
+
+        Returns
+        -------
+        chunks : list of tuple
+            ``(index, frames)`` of each non-empty chunk, oldest first.
+        """
+        chunks = []
+        for number in _chunk_numbers(self.directory):
+            path = os.path.join(self.directory, f"frames_{number:06d}")
+            try:
+                records = os.path.getsize(f"{path}.idx") // INDEX_DTYPE.itemsize
+                index = np.fromfile(f"{path}.idx", dtype=INDEX_DTYPE, count=records)
+                frames = os.path.getsize(f"{path}.f32") // (4 * PIXELS)
+            except (OSError, ValueError) as e:
+                logging.warning(f"Skipping unreadable archive chunk {path}: {e}")
+                continue
+            # Ignore records whose frame was not completely written
+            count = min(len(index), frames)
+            if count == 0:
+                continue
+            data = np.memmap(f"{path}.f32", dtype="<f4", mode="r", shape=(count, PIXELS))
+            chunks.append((index[:count], data))
+        return chunks
+
+    def select(self, camera=None, start=None, stop=None, min_position=None, max_position=None):
+        """Iterate over the frames matching a query, one chunk at a time.
+
+        Parameters
+        ----------
+        camera : str or int, optional
+            Name or number of the camera.
+        start, stop : float, optional
+            Time range in seconds since the epoch, ``stop`` excluded.
+        min_position, max_position : float, optional
+            Position range in degrees, modulo 360. A range with
+            ``min_position > max_position`` wraps around 0 degrees.
+
+        Yields
+        ------
+        records : numpy.ndarray
+            ``INDEX_DTYPE`` records of the selected frames.
+        frames : numpy.ndarray
+            ``(len(records), 768)`` float32 array of the selected frames.
+        """
+        for index, data in self.chunks():
+            if start is not None and index["timestamp"].max() < start:
+                continue
+            if stop is not None and index["timestamp"].min() >= stop:
+                continue
+            mask = np.ones((len(index),), dtype=bool)
+            if camera is not None:
+                mask &= index["camera"] == (camera if isinstance(camera, int) else camera_number(camera))
+            if start is not None:
+                mask &= index["timestamp"] >= start
+            if stop is not None:
+                mask &= index["timestamp"] < stop
+            if min_position is not None or max_position is not None:
+                position = index["position"] % 360
+                low = 0 if min_position is None else min_position % 360
+                high = 360 if max_position is None else max_position % 360
+                if max_position is not None and high == 0 and max_position != 0:
+                    high = 360
+                if low <= high:
+                    mask &= (position >= low) & (position <= high)
+                else:
+                    mask &= (position >= low) | (position <= high)
+            selected = np.flatnonzero(mask)
+            if len(selected):
+                yield index[selected], np.asarray(data[selected])
+
+    def query(self, **kwargs):
+        """Get all the frames matching a query.
+
+        Parameters
+        ----------
+        **kwargs
+            Query, see ``select``.
+
+        Returns
+        -------
+        records : numpy.ndarray
+            ``INDEX_DTYPE`` records of the selected frames.
+        frames : numpy.ndarray
+            ``(len(records), 768)`` float32 array of the selected frames.
+        """
+        records, frames = [np.zeros((0,), dtype=INDEX_DTYPE)], [np.zeros((0, PIXELS), dtype=np.float32)]
+        for chunk_records, chunk_frames in self.select(**kwargs):
+            records.append(chunk_records)
+            frames.append(chunk_frames)
+        return np.concatenate(records), np.concatenate(frames)
+
+
+def _chunk_numbers(directory):
+    """Numbers of the chunks of an archive, sorted."""
+    paths = glob.glob(os.path.join(directory, "frames_*.idx"))
+    return sorted(int(os.path.basename(path)[7:13]) for path in paths)
@@ -0,0 +1,1252 @@
+"""Benchmarks of the thermal camera system on simulated hardware."""
+
+import os
+import json
+import time
+import logging
+import argparse
+import tempfile
+import threading
+import functools
+import numpy as np
+import adafruit_mlx90640
+
+from alarms import AlarmEngine
+from archive import FrameArchive
+from change_detection import ChangeDetector
+from denoising import MODES, TemporalFilter
+from frame_format import FORMATS, FrameDecoder, decode_frame, encode_bundle, encode_frame
+from frame_stats import FrameStatistics
+from homing import home
+from mqtt_api import ThermalCameraAPI
+from motion import execute, plan_move
+from pipeline import Pipeline
+from pixel_pipeline import PixelPipeline
+from publisher import MQTTPublisher
+from recording import StreamRecorder, StreamReplayer
+from simulation import RecordingMQTTClient, SimulatedBroker, SimulatedHomeSwitch, SimulatedI2C, SimulatedMLX90640
+from stitching import PanoramaStitcher
+from streaming import StreamScheduler
+from thermalcamera import CameraPool, FastMLX90640, FrameRecord, ThermalCamera
+from timeseries import StatisticsStore, merge
+from viewer import FrameReceiver, FrameViewer
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+)
+
+
+def _timeit(func, repeat):
+    """Return the mean duration of ``func`` in seconds."""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat
+
+
+def benchmark_engine(repeat=20):
+    """Compare the Adafruit and the NumPy temperature calculation.
+
+    Parameters
+    ----------
+    repeat : int
+        Number of frames read with each engine.
+
+    Returns
+    -------
+    results : dict
+        Frames per second of the full readout and of the temperature
+        calculation alone, and maximum temperature difference in Celsius.
+    """
+    device = SimulatedMLX90640(die_temperature=35.0, seed=0)
+    bus = SimulatedI2C({0x33: device})
+    engines = {
+        "adafruit": adafruit_mlx90640.MLX90640(bus, 0x33),
+        "numpy": FastMLX90640(bus, 0x33),
+    }
+    device._new_subpage()
+    words = np.concatenate([device.ram, [device.control, device.status & 0x0001]]).astype(np.uint16)
+    results = {}
+    frames = {}
+    for name, engine in engines.items():
+        frame = np.zeros((768,))
+        data = words if name == "numpy" else words.tolist()
+        calculation = _timeit(lambda: engine._CalculateTo(data, 0.95, 22.0, frame), repeat)
+        readout = _timeit(lambda: engine.getFrame(frame), repeat)
+        frames[name] = np.zeros((768,))
+        engine._CalculateTo(data, 0.95, 22.0, frames[name])
+        results[name] = {"frame_fps": 1 / readout, "calculation_fps": 1 / calculation}
+    results["max_difference"] = float(np.max(np.abs(frames["numpy"] - frames["adafruit"])))
+    return results
+
+
+def benchmark_startup():
+    """Compare the startup time of four cameras with and without the cache.
+
+    The simulated I2C bus runs at 1 MHz, like the one of the rig.
+
+    Returns
+    -------
+    results : dict
+        Time in seconds until all the cameras are ready, when created one
+        after the other with the Adafruit driver, and when created in
+        parallel with an empty and with a filled calibration cache.
+    """
+    addresses = [0x30, 0x31, 0x32, 0x33]
+    bus = SimulatedI2C({addr: SimulatedMLX90640(seed=addr) for addr in addresses}, frequency=1e6)
+    results = {}
+    start = time.perf_counter()
+    for addr in addresses:
+        adafruit_mlx90640.MLX90640.brokenPixels = []
+        adafruit_mlx90640.MLX90640.outlierPixels = []
+        adafruit_mlx90640.MLX90640(bus, addr)
+    results["adafruit_sequential"] = time.perf_counter() - start
+    with tempfile.TemporaryDirectory() as cache_dir:
+        factories = {addr: functools.partial(FastMLX90640, bus, addr, cache_dir=cache_dir) for addr in addresses}
+        results["numpy_parallel_cold_cache"] = CameraPool(factories).wait()
+        results["numpy_parallel_warm_cache"] = CameraPool(factories).wait()
+    return results
+
+
+def benchmark_format(repeat=1000):
+    """Measure size and encoding/decoding time of the frame message formats.
+
+    Parameters
+    ----------
+    repeat : int
+        Number of frames encoded and decoded with each format.
+
+    Returns
+    -------
+    results : dict
+        Bytes per frame, encoding and decoding time in microseconds and
+        maximum decoding error in Celsius of each format.
+    """
+    frame = SimulatedMLX90640(seed=0).scene().astype(np.float32)
+    stats = {
+        "min_temperature": float(frame.min()),
+        "max_temperature": float(frame.max()),
+        "percentile05_temperature": 22.0,
+        "percentile95_temperature": 30.0,
+    }
+    results = {}
+    for fmt in FORMATS:
+        message = encode_frame(frame, "camera2", 90.0, time.time(), 1, stats, fmt)
+        payload = message.encode("utf-8") if isinstance(message, str) else message
+        encode = _timeit(lambda: encode_frame(frame, "camera2", 90.0, time.time(), 1, stats, fmt), repeat)
+        decode = _timeit(lambda: decode_frame(payload, camera=2), repeat)
+        results[fmt] = {
+            "bytes": len(payload),
+            "encode_us": encode * 1e6,
+            "decode_us": decode * 1e6,
+            "max_error": float(np.max(np.abs(decode_frame(payload).image - frame))),
+        }
+    return results
+
+
+def benchmark_motion(angle=45.0, step_time=0.001):
+    """Compare the sleep-based stepping loop with the planned moves.
+
+    Parameters
+    ----------
+    angle : float
+        Rotation in degrees of each move.
+    step_time : float
+        Simulated duration in seconds of a step, the I2C transfers to the
+        motor driver.
+
+    Returns
+    -------
+    results : dict
+        Planned and actual duration in seconds of the move and maximum step
+        delay of each method.
+    """
+    step_value, period = 0.18, 0.004
+    steps = round(angle / step_value)
+
+    def step():
+        time.sleep(step_time)
+
+    start = time.perf_counter()
+    for _ in range(steps):
+        step()
+        time.sleep(period)
+    results = {"sleep_loop": {"planned_time": steps * period, "actual_time": time.perf_counter() - start}}
+    moves = {
+        "constant": plan_move(angle, step_value, 1 / period, profile="constant"),
+        "trapezoidal_2x": plan_move(angle, step_value, 2 / period, 1 / period, 2000),
+        "s-curve_2x": plan_move(angle, step_value, 2 / period, 1 / period, 2000, "s-curve"),
+    }
+    for name, plan in moves.items():
+        results[name] = execute(plan, step)._asdict()
+    return results
+
+
+def benchmark_homing(runs=100, step_time=0.002, latency=0.002, jitter=0.02):
+    """Compare the polling calibration with the two-phase homing.
+
+    Both run on a simulated clock against a simulated switch, from random
+    angles between 20 and 180 degrees.
+
+    Parameters
+    ----------
+    runs : int
+        Number of calibrations with each method.
+    step_time : float
+        Simulated duration in seconds of a step.
+    latency : float
+        Delay in seconds between the switch actuation and the GPIO edge.
+    jitter : float
+        Standard deviation in degrees of the switch actuation angle.
+
+    Returns
+    -------
+    results : dict
+        Mean and maximum duration in seconds, and mean, standard deviation
+        and maximum absolute value of the error of the position fix in
+        degrees of each method.
+    """
+    now = [0.0]
+
+    def clock():
+        return now[0]
+
+    def sleep(duration):
+        now[0] += duration
+
+    def polling(switch):
+        # Former ThermalCamera.calibrate loop
+        for _ in range(round(180 / ThermalCamera.STEP_VALUE)):
+            if switch.pressed():
+                break
+            switch.step(-ThermalCamera.STEP_VALUE)
+            sleep(step_time + 0.01)
+
+    def two_phase(switch):
+        def step(angle):
+            switch.step(angle)
+            sleep(step_time)
+
+        home(
+            lambda: step(-ThermalCamera.STEP_VALUE),
+            lambda: step(ThermalCamera.STEP_VALUE),
+            switch,
+            round(180 / ThermalCamera.STEP_VALUE),
+            ThermalCamera.HOMING_FAST_RATE,
+            ThermalCamera.HOMING_SLOW_RATE,
+            ThermalCamera.HOMING_BACKOFF_STEPS,
+            ThermalCamera.START_STEP_RATE,
+            ThermalCamera.STEP_ACCELERATION,
+            clock,
+            sleep,
+        )
+
+    rng = np.random.default_rng(0)
+    angles = rng.uniform(20, 180, runs)
+    results = {}
+    for name, method in {"polling": polling, "two_phase": two_phase}.items():
+        durations, errors = [], []
+        for i, angle in enumerate(angles):
+            switch = SimulatedHomeSwitch(angle=angle, jitter=jitter, latency=latency, clock=clock, seed=i)
+            start = now[0]
+            method(switch)
+            durations.append(now[0] - start)
+            errors.append(switch.angle)
+        errors = np.array(errors)
+        results[name] = {
+            "mean_duration": float(np.mean(durations)),
+            "max_duration": float(np.max(durations)),
+            "mean_error": float(errors.mean()),
+            "std_error": float(errors.std()),
+            "max_abs_error": float(np.abs(errors).max()),
+        }
+    return results
+
+
+def benchmark_pipeline(positions=20, motion=0.05, acquisition=0.03, processing=0.02, publishing=0.01):
+    """Compare the sequential and the pipelined scan loops.
+
+    The stages are simulated by sleeping for their duration.
+
+    Parameters
+    ----------
+    positions : int
+        Number of positions of the scan.
+    motion, acquisition, processing, publishing : float
+        Duration in seconds of each stage for one position.
+
+    Returns
+    -------
+    results : dict
+        Positions per second of each loop, and timing of the pipeline stages.
+    """
+    start = time.perf_counter()
+    for _ in range(positions):
+        for duration in (motion, acquisition, processing, publishing):
+            time.sleep(duration)
+    results = {"sequential_positions_per_s": positions / (time.perf_counter() - start)}
+
+    def scan():
+        for position in range(positions):
+            time.sleep(motion)
+            time.sleep(acquisition)
+            yield position
+
+    pipeline = Pipeline(
+        scan,
+        [("processing", lambda x: time.sleep(processing) or x), ("publishing", lambda x: time.sleep(publishing))],
+        name="scan",
+    )
+    start = time.perf_counter()
+    pipeline.start()
+    pipeline.join()
+    results["pipelined_positions_per_s"] = positions / (time.perf_counter() - start)
+    results["stages"] = pipeline.timer.summary()
+    return results
+
+
+def benchmark_streaming(duration=1.0, rate=10.0, messages_per_s=20.0):
+    """Measure the CPU usage and the backpressure of the frame streaming.
+
+    Parameters
+    ----------
+    duration : float
+        Duration in seconds of each measurement.
+    rate : float
+        Frames per second of each of the four cameras.
+    messages_per_s : float
+        Messages per second the simulated broker accepts.
+
+    Returns
+    -------
+    results : dict
+        CPU seconds per second used while a scan runs by the former loop,
+        which spun, and by the paused scheduler, and the frames published and
+        dropped against a slow broker with the maximum number of messages
+        waiting to be sent.
+    """
+    cameras = [f"camera{i}" for i in range(4)]
+    running = threading.Event()
+    running.set()
+
+    def spinning_loop():
+        # Former ThermalCameraAPI._send_images_loop during a scan
+        while running.is_set():
+            continue
+
+    results = {}
+    thread = threading.Thread(target=spinning_loop)
+    start = time.process_time()
+    thread.start()
+    time.sleep(duration)
+    running.clear()
+    thread.join()
+    results["spinning_cpu"] = (time.process_time() - start) / duration
+    scheduler = StreamScheduler(cameras, lambda camera: camera, lambda camera, record: None, rate)
+    scheduler.start()
+    scheduler.pause()
+    start = time.process_time()
+    time.sleep(duration)
+    results["paused_scheduler_cpu"] = (time.process_time() - start) / duration
+    scheduler.stop()
+
+    client = RecordingMQTTClient(messages_per_s)
+    scheduler = StreamScheduler(
+        cameras, lambda camera: camera, lambda camera, record: client.publish(camera, record), rate, max_inflight=4
+    )
+    max_inflight = 0
+    scheduler.start()
+    end = time.monotonic() + duration
+    while time.monotonic() < end:
+        max_inflight = max(max_inflight, scheduler.stats()["inflight"])
+        time.sleep(0.01)
+    scheduler.stop()
+    results["slow_broker"] = {
+        "published_per_s": scheduler.published / duration,
+        "dropped_per_s": scheduler.dropped / duration,
+        "max_inflight": max_inflight,
+    }
+    return results
+
+
+def benchmark_commands(queries=10, interval=0.1):
+    """Measure the command latency while the motor moves.
+
+    The API runs on the real-time simulated hardware: a 45 degree ``go_to``
+    is followed by state queries, which run while the motor moves.
+
+    Parameters
+    ----------
+    queries : int
+        Number of ``get_switch_state`` commands sent during the move.
+    interval : float
+        Time in seconds between two queries.
+
+    Returns
+    -------
+    results : dict
+        Number of executions, mean and maximum time in milliseconds spent in
+        the queue and executing of each command.
+    """
+    client = RecordingMQTTClient()
+    api = ThermalCameraAPI(backend="simulated-realtime")
+    api.start_executor(client)
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            api.submit_command(client, "init", {"absolute_position": 0})
+            api.submit_command(client, "go_to", {"position": 45})
+            time.sleep(0.2)
+            for _ in range(queries):
+                api.submit_command(client, "get_switch_state", {})
+                time.sleep(interval)
+            api.executor.stop(timeout=10)
+        finally:
+            os.chdir(cwd)
+    return api.executor.metrics()
+
+
+def benchmark_frame_cache(readers=4, requests=20):
+    """Measure the bus reads of concurrent frame consumers.
+
+    Each reader, like the streaming, the commands and the REST app, asks for
+    frames of the same camera in a loop, reading the bus directly or through
+    the frame cache.
+
+    Parameters
+    ----------
+    readers : int
+        Number of concurrent readers.
+    requests : int
+        Number of frames asked by each reader.
+
+    Returns
+    -------
+    results : dict
+        Bus reads and duration in seconds with direct reads and through the
+        cache.
+    """
+    thermal_camera = ThermalCamera(absolute_position=0.0, backend="simulated")
+    thermal_camera.mlx_dict.wait()
+    cache = thermal_camera.frame_cache
+    ring = thermal_camera.frame_rings["camera0"]
+
+    def direct():
+        # Former ThermalCamera.get_frame_record
+        index, buffer = ring.acquire()
+        thermal_camera.mlx_dict["camera0"].getFrame(buffer)
+        ring.commit(index, thermal_camera.absolute_position)
+
+    def cached():
+        # Each reader asks for a frame newer than its previous one
+        sequence = None
+        for _ in range(requests):
+            sequence = cache.get("camera0", newer_than=sequence).sequence
+
+    def run(function):
+        threads = [threading.Thread(target=function) for _ in range(readers)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - start
+
+    results = {"direct_reads": readers * requests}
+    results["direct_s"] = run(lambda: [direct() for _ in range(requests)])
+    results["cached_s"] = run(cached)
+    results["cached_reads"] = cache.stats()["camera0"]["reads"]
+    return results
+
+
+def benchmark_denoising(frames=64, length=8, repeat=1000):
+    """Measure the noise reduction and the cost of the temporal filters.
+
+    Parameters
+    ----------
+    frames : int
+        Number of frames of a simulated camera looking at a still scene.
+    length : int
+        Number of frames of the moving average and median.
+    repeat : int
+        Number of updates timed for each filter.
+
+    Returns
+    -------
+    results : dict
+        Temporal standard deviation of the pixels in kelvin, and time of an
+        update in microseconds, of the raw frames and of each filter.
+    """
+    thermal_camera = ThermalCamera(absolute_position=0.0, backend="simulated")
+    raw = np.array([thermal_camera.get_frame_record("camera0", max_age=0).frame for _ in range(frames)])
+    results = {"raw_noise": float(raw.std(axis=0).mean())}
+    for mode in MODES[1:]:
+        frame_filter = TemporalFilter(mode, length)
+        filtered = np.array([frame_filter.update(frame, 0.0).copy() for frame in raw])
+        results[f"{mode}_noise"] = float(filtered[length:].std(axis=0).mean())
+        update = functools.partial(frame_filter.update, raw[0], 0.0)
+        results[f"{mode}_update_us"] = 1e6 * _timeit(update, repeat)
+    return results
+
+
+def benchmark_change_detection(archive=None, frames=300, threshold=0.5, step=0.05, keyframe_interval=10.0):
+    """Measure the bandwidth saved by the change detection on recorded frames.
+
+    The frames are streamed once per second through a ``ChangeDetector`` in
+    each configuration, and the bytes published are compared to full
+    ``float32`` frames.
+
+    Parameters
+    ----------
+    archive : str, optional
+        Directory of a ``FrameArchive`` recorded with the rig parked. By
+        default, frames of a simulated camera looking at a still scene are
+        recorded, averaged over 4 frames as with the ``mean`` filter.
+    frames : int
+        Maximum number of frames.
+    threshold, step, keyframe_interval : float
+        Configuration of the detector, see ``ChangeDetector``.
+
+    Returns
+    -------
+    results : dict
+        Bytes published in each configuration relative to the full frames,
+        and maximum error of the delta frames in kelvin.
+    """
+    if archive is None:
+        thermal_camera = ThermalCamera(absolute_position=0.0, backend="simulated")
+        thermal_camera.configure_filter(mode="mean", length=4)
+        recorded = np.array([thermal_camera.get_filtered_record("camera0", max_age=0).frame for _ in range(frames)])
+    else:
+        recorded = FrameArchive(archive).query(camera=0)[1][:frames]
+    stats = dict.fromkeys(
+        ["min_temperature", "max_temperature", "percentile05_temperature", "percentile95_temperature"], 0.0
+    )
+    configurations = {
+        "uint16": ({}, "uint16"),
+        "threshold": ({"threshold": threshold}, "float32"),
+        "delta": ({"delta": True}, "float32"),
+        "threshold_delta": ({"threshold": threshold, "delta": True}, "float32"),
+    }
+    full = len(recorded) * len(encode_frame(recorded[0], "camera0", 0, 0, 0, stats, "float32"))
+    results = {"frames": len(recorded)}
+    for name, (config, fmt) in configurations.items():
+        detector = ChangeDetector(step=step, keyframe_interval=keyframe_interval, **config)
+        decoder = FrameDecoder()
+        error = 0.0
+        for sequence, frame in enumerate(recorded):
+            record = FrameRecord(frame, sequence, float(sequence), 0.0)
+            payload = detector.encode("camera0", record, stats, fmt)
+            if payload is not None:
+                error = max(error, float(np.abs(decoder.decode(payload).image - frame).max()))
+        results[f"{name}_ratio"] = detector.stats()["bytes"] / full
+        results[f"{name}_error"] = error
+    return results
+
+
+def benchmark_statistics(repeat=1000, cameras=4):
+    """Compare the per-camera statistics to the batched statistics.
+
+    Parameters
+    ----------
+    repeat : int
+        Number of acquisition cycles.
+    cameras : int
+        Number of cameras of a cycle.
+
+    Returns
+    -------
+    results : dict
+        Time of the statistics of a cycle in microseconds, computed per
+        camera with ``np.min``, ``np.max`` and ``np.percentile`` as before,
+        and in one pass with ``FrameStatistics``, without and with all the
+        optional statistics.
+    """
+    frames = list(np.random.default_rng(0).normal(25, 3, (cameras, 24 * 32)).astype(np.float32))
+
+    def per_camera():
+        # Former ThermalCameraAPI._frame_message
+        for frame in frames:
+            low_temp, high_temp = np.percentile(frame, [5, 95]).tolist()
+            float(np.min(frame)), float(np.max(frame))
+
+    headers = FrameStatistics(cameras, mean=False, std=False, hotspot=False)
+    full = FrameStatistics(cameras, percentiles=(1, 5, 50, 95, 99), bins=32, histogram_range=(0, 64))
+    return {
+        "per_camera_us": 1e6 * _timeit(per_camera, repeat),
+        "batched_us": 1e6 * _timeit(lambda: headers.compute(frames), repeat),
+        "batched_all_us": 1e6 * _timeit(lambda: full.compute(frames), repeat),
+    }
+
+
+def benchmark_alarms(rules=(1, 10, 100), repeat=200):
+    """Measure the cost of the alarm rules per frame.
+
+    Parameters
+    ----------
+    rules : sequence of int
+        Numbers of rules, a mix of region, sector and rate-of-rise rules.
+    repeat : int
+        Number of frames evaluated for each number of rules.
+
+    Returns
+    -------
+    results : dict
+        Time of the evaluation of a frame in microseconds for each number of
+        rules.
+    """
+    rng = np.random.default_rng(0)
+    frames = rng.normal(25, 1, (repeat, 24 * 32)).astype(np.float32)
+    results = {}
+    for n in rules:
+        kinds = [
+            lambda i: {"region": [i % 28, i % 28 + 4, i % 20, i % 20 + 4], "threshold": 80},
+            lambda i: {"sector": [i % 360, i % 360 + 30], "threshold": 80, "hold": 2.0},
+            lambda i: {"rate": 5.0, "camera": f"camera{i % 4}"},
+        ]
+        engine = AlarmEngine([{"name": f"rule{i}", **kinds[i % 3](i)} for i in range(n)])
+        start = time.perf_counter()
+        for i, frame in enumerate(frames):
+            engine.evaluate("camera0", frame, 0.0, float(i))
+        results[f"{n}_rules_us"] = 1e6 * (time.perf_counter() - start) / repeat
+    return results
+
+
+def benchmark_pixel_pipeline(repeat=10000, bad_pixels=8):
+    """Measure the pixel corrections and the orientation of a frame.
+
+    Parameters
+    ----------
+    repeat : int
+        Number of frames.
+    bad_pixels : int
+        Number of bad pixels of the camera.
+
+    Returns
+    -------
+    results : dict
+        Time in microseconds of the flip and rotation of a frame as done by
+        each consumer before, of the gather of the oriented image, and of the
+        gain, offset and bad-pixel correction.
+    """
+    rng = np.random.default_rng(0)
+    frame = rng.normal(25, 1, 24 * 32).astype(np.float32)
+    pipeline = PixelPipeline(
+        bad_pixels=rng.choice(768, bad_pixels, replace=False),
+        gain=rng.normal(1, 0.01, 768),
+        offset=rng.normal(0, 0.1, 768),
+    )
+    image = np.empty(pipeline.image_shape, dtype=np.float32)
+    buffer = np.empty_like(frame)
+
+    def correct():
+        # In place, from the raw frame each time like the acquisition
+        np.copyto(buffer, frame)
+        pipeline.correct(buffer)
+
+    return {
+        "flip_rot90_us": 1e6 * _timeit(lambda: np.flip(np.rot90(frame.reshape(24, 32)), axis=0).copy(), repeat),
+        "gather_us": 1e6 * _timeit(lambda: pipeline.orient(frame, out=image), repeat),
+        "correction_us": 1e6 * _timeit(correct, repeat),
+    }
+
+
+def benchmark_step_jitter(angle=90.0, consumers=2, rate=32.0, backend="simulated"):
+    """Measure the timing of the motor steps under the frame acquisition load.
+
+    The motor turns at the maximum step rate on the real clock while
+    consumer threads, like the streaming, ask for the next frames of the
+    cameras and encode them in JSON. The frames are acquired in the threads
+    of the consumers, competing with the stepping for the GIL, or in the
+    acquisition process, which reads the simulated cameras continuously.
+
+    Parameters
+    ----------
+    angle : float
+        Rotation in degrees of the move.
+    consumers : int
+        Number of consumer threads.
+    rate : float
+        Frames per second consumed by all the consumers.
+    backend : str
+        Name of the simulated backend.
+
+    Returns
+    -------
+    results : dict
+        Mean, 99th percentile and maximum delay in milliseconds of the steps
+        after their deadlines, and frames consumed per second, without load
+        and with each acquisition.
+    """
+    results = {}
+    for name, acquisition in (("idle", None), ("thread", "thread"), ("process", "process")):
+        thermal_camera = ThermalCamera(absolute_position=0.0, backend=backend, acquisition=acquisition or "thread")
+        if thermal_camera.mlx_dict is not None:
+            thermal_camera.mlx_dict.wait()
+        cameras = list(thermal_camera.frame_rings)
+        for camera in cameras:
+            thermal_camera.get_frame_record(camera, max_age=0)
+        plan = plan_move(angle, ThermalCamera.STEP_VALUE, ThermalCamera.MAX_STEP_RATE, profile="constant")
+        stop = threading.Event()
+        frames = []
+
+        def consume():
+            deadline = time.monotonic()
+            while not stop.is_set():
+                for camera in cameras:
+                    record = thermal_camera.get_frame_record(camera, max_age=0)
+                    json.dumps(record.frame.tolist())
+                    frames.append(record.sequence)
+                    deadline += consumers / rate
+                    stop.wait(max(0.0, deadline - time.monotonic()))
+
+        threads = [threading.Thread(target=consume) for _ in range(consumers if acquisition else 0)]
+        for thread in threads:
+            thread.start()
+        times = []
+
+        def step():
+            times.append(time.monotonic())
+            thermal_camera.absolute_position += ThermalCamera.STEP_VALUE
+            thermal_camera.kit.stepper1.onestep(style=ThermalCamera.STEP_STYLE)
+
+        start = time.monotonic()
+        execute(plan, step)
+        elapsed = time.monotonic() - start
+        stop.set()
+        for thread in threads:
+            thread.join()
+        thermal_camera.close()
+        lateness = (np.array(times) - start - plan.deadlines[: len(times)]) * 1e3
+        results[name] = {
+            "mean_ms": float(lateness.mean()),
+            "p99_ms": float(np.percentile(lateness, 99)),
+            "max_ms": float(lateness.max()),
+            "frames_per_s": len(frames) / elapsed,
+        }
+    return results
+
+
+def _read_parts(response, boundary=b"--frame"):
+    """Read the parts of a multipart stream, yielding their payloads."""
+    while True:
+        line = response.readline()
+        if not line:
+            return
+        if not line.startswith(boundary):
+            continue
+        headers = {}
+        while True:
+            line = response.readline().strip()
+            if not line:
+                break
+            name, _, value = line.decode().partition(":")
+            headers[name.lower()] = value.strip()
+        yield response.read(int(headers["content-length"]))
+
+
+def benchmark_rest(pollers=8, streamers=8, duration=3.0, rate=5.0, interval=0.02):
+    """Load test the REST app with concurrent clients on simulated hardware.
+
+    The pollers ask for the frame of a camera every ``interval`` seconds
+    with ``If-None-Match``, the streamers read the stream of all the
+    cameras, while a motion job runs. Before the frame server, each frame
+    request made its own bus read.
+
+    Parameters
+    ----------
+    pollers : int
+        Number of clients asking for the frames.
+    streamers : int
+        Number of clients reading the stream.
+    duration : float
+        Duration of the test in seconds.
+    rate : float
+        Frames per second of each camera of the frame server.
+    interval : float
+        Time in seconds between the requests of a poller.
+
+    Returns
+    -------
+    results : dict
+        Requests per second, responses by status and their median and 99th
+        percentile latency in milliseconds, frames received by the
+        streamers, bus reads, and duration of the motion job.
+    """
+    import http.client
+    from werkzeug.serving import make_server
+    from app import create_app
+
+    thermal_camera = ThermalCamera(absolute_position=0.0, backend="simulated")
+    thermal_camera.mlx_dict.wait()
+    app = create_app(thermal_camera, rate=rate)
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    port = server.server_port
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    app.extensions["frame_server"].wait("camera0", timeout=5.0)
+    stop = threading.Event()
+    latencies = {}
+    streamed = []
+
+    def poll(camera):
+        connection = http.client.HTTPConnection("127.0.0.1", port)
+        etag = None
+        while not stop.is_set():
+            start = time.perf_counter()
+            connection.request("GET", f"/frames/{camera}", headers={"If-None-Match": etag} if etag else {})
+            response = connection.getresponse()
+            response.read()
+            latencies.setdefault(response.status, []).append(time.perf_counter() - start)
+            etag = response.getheader("ETag") or etag
+            stop.wait(interval)
+        connection.close()
+
+    def stream():
+        connection = http.client.HTTPConnection("127.0.0.1", port)
+        connection.request("GET", "/stream")
+        frames = 0
+        for _ in _read_parts(connection.getresponse()):
+            frames += 1
+            if stop.is_set():
+                break
+        streamed.append(frames)
+        connection.close()
+
+    cameras = list(thermal_camera.frame_rings)
+    threads = [threading.Thread(target=poll, args=(cameras[i % len(cameras)],)) for i in range(pollers)]
+    threads += [threading.Thread(target=stream) for _ in range(streamers)]
+    reads = sum(s["reads"] for s in thermal_camera.frame_cache.stats().values())
+    for thread in threads:
+        thread.start()
+    connection = http.client.HTTPConnection("127.0.0.1", port)
+    connection.request("POST", "/move", body=json.dumps({"angle": 90}), headers={"Content-Type": "application/json"})
+    job = json.loads(connection.getresponse().read())["id"]
+    time.sleep(duration)
+    connection.request("GET", f"/jobs/{job}")
+    result = json.loads(connection.getresponse().read())
+    stop.set()
+    for thread in threads:
+        thread.join()
+    reads = sum(s["reads"] for s in thermal_camera.frame_cache.stats().values()) - reads
+    app.extensions["frame_server"].stop()
+    app.extensions["executor"].stop()
+    server.shutdown()
+    requests = sum(len(values) for values in latencies.values())
+    return {
+        "requests_per_s": requests / duration,
+        "responses": {
+            status: {
+                "count": len(values),
+                "p50_ms": 1e3 * float(np.percentile(values, 50)),
+                "p99_ms": 1e3 * float(np.percentile(values, 99)),
+            }
+            for status, values in latencies.items()
+        },
+        "streamed_frames": streamed,
+        "frames_served": len(latencies.get(200, [])) + sum(streamed),
+        "bus_reads": reads,
+        "move": {"status": result["status"], "exec_ms": result.get("exec_ms")},
+    }
+
+
+def benchmark_publisher(cycles=500, cameras=4, fmt="uint16", connects=20):
+    """Compare the publishing of the frames of the acquisition cycles to a local broker.
+
+    The frames are published with a new client and connection per frame,
+    as ``mqtt-send.py`` did, or through the ``MQTTPublisher`` one message per
+    frame or one bundle per cycle.
+
+    Parameters
+    ----------
+    cycles : int
+        Number of acquisition cycles published through the publisher.
+    cameras : int
+        Number of frames of a cycle.
+    fmt : str
+        Format of the frame messages.
+    connects : int
+        Number of frames published with a connection each.
+
+    Returns
+    -------
+    results : dict
+        Time per cycle in milliseconds until all the messages are sent, and
+        packets and bytes received by the broker per cycle.
+    """
+    import paho.mqtt.client as mqtt
+
+    frames = np.random.default_rng(0).normal(25, 2, (cameras, 768)).astype(np.float32)
+    stats = {"min_temperature": 20.0, "max_temperature": 30.0, "percentile05_temperature": 21.0, "percentile95_temperature": 29.0}
+    messages = [(f"camera{i}", encode_frame(frame, f"camera{i}", 0.0, 0.0, 0, stats, fmt)) for i, frame in enumerate(frames)]
+    results = {}
+    broker = SimulatedBroker()
+
+    def measure(name, run, count):
+        packets, nbytes = broker.packets, broker.bytes
+        start = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - start
+        # The packets of the connections are counted too
+        results[name] = {
+            "ms_per_cycle": 1e3 * elapsed / count,
+            "packets_per_cycle": (broker.packets - packets) / count,
+            "bytes_per_cycle": (broker.bytes - nbytes) / count,
+        }
+
+    def connect_per_frame():
+        for i in range(connects):
+            camera, payload = messages[i % cameras]
+            client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, "thermalcam")
+            client.connect("127.0.0.1", broker.port)
+            client.loop_start()
+            client.publish(f"/thermalcamera/{camera}", payload).wait_for_publish()
+            client.disconnect()
+            client.loop_stop()
+
+    measure("connect_per_frame", connect_per_frame, connects / cameras)
+    publisher = MQTTPublisher(mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, "thermalcam"), buffer=cycles * cameras)
+    publisher.connect("127.0.0.1", broker.port)
+    while not publisher.connected:
+        time.sleep(0.01)
+
+    def publish(bundle):
+        for _ in range(cycles):
+            if bundle:
+                sent = [publisher.publish("/thermalcamera/frames", encode_bundle(messages))]
+            else:
+                sent = [publisher.publish(f"/thermalcamera/{camera}", payload) for camera, payload in messages]
+        while not all(message.is_published() for message in sent) or publisher.stats()["pending"]:
+            time.sleep(0.001)
+        # The last packets reach the broker
+        time.sleep(0.05)
+
+    measure("publisher", lambda: publish(False), cycles)
+    measure("publisher_bundle", lambda: publish(True), cycles)
+    publisher.disconnect()
+    publisher.loop_stop()
+    broker.close()
+    return results
+
+
+def benchmark_viewer(messages=400, cameras=4, fmt="uint16", duration=3.0, rate=200.0, fps=10.0):
+    """Compare the handling of the received frames by the viewer.
+
+    The former viewer decoded each message and drew the whole figure in the
+    MQTT callback; the ``FrameReceiver`` callback only queues the message
+    and the ``FrameViewer`` blits the newest frames at a fixed rate. The
+    figures are drawn off screen.
+
+    Parameters
+    ----------
+    messages : int
+        Number of messages of the callback and drawing timings.
+    cameras : int
+        Number of cameras.
+    fmt : str
+        Format of the frame messages.
+    duration : float
+        Duration of the sustained test in seconds.
+    rate : float
+        Messages per second received during the sustained test.
+    fps : float
+        Frames per second of the display during the sustained test.
+
+    Returns
+    -------
+    results : dict
+        Time in microseconds spent in the callback per message and in
+        milliseconds per drawing, and the messages, rendered and dropped
+        frames per second of the sustained test.
+    """
+    import types
+    import matplotlib.pyplot as plt
+
+    plt.switch_backend("Agg")
+    frames = np.random.default_rng(0).normal(25, 2, (cameras, 768)).astype(np.float32)
+    stats = {"min_temperature": 20.0, "max_temperature": 30.0, "percentile05_temperature": 21.0, "percentile95_temperature": 29.0}
+    payloads = [
+        types.SimpleNamespace(topic=f"/thermalcamera/camera{i}", payload=encode_frame(frame, f"camera{i}", 0.0, 0.0, 0, stats, fmt))
+        for i, frame in enumerate(frames)
+    ]
+    results = {}
+
+    # Decoding and full drawing in the callback
+    fig, axs = plt.subplots(2, (cameras + 1) // 2)
+    images = [ax.imshow(np.zeros((32, 24)), cmap="plasma") for ax in axs.flat]
+    decoder = FrameDecoder()
+    start = time.perf_counter()
+    for i in range(messages):
+        message = decoder.decode(payloads[i % cameras].payload)
+        images[message.camera].set_data(np.flip(np.rot90(message.image.reshape(24, 32)), axis=0))
+        images[message.camera].set_clim(min(20, message.image.min()), message.image.max())
+        fig.canvas.draw()
+    results["callback_draw_us"] = 1e6 * (time.perf_counter() - start) / messages
+    plt.close(fig)
+
+    receiver = FrameReceiver()
+    viewer = FrameViewer(receiver, cameras, fps)
+    start = time.perf_counter()
+    for i in range(messages):
+        receiver.on_message(None, None, payloads[i % cameras])
+    results["callback_queue_us"] = 1e6 * (time.perf_counter() - start) / messages
+    receiver.start()
+    viewer.fig.canvas.draw()
+    start = time.perf_counter()
+    for i in range(messages // cameras):
+        for payload in payloads:
+            receiver.on_message(None, None, payload)
+        while receiver.stats()["pending"]:
+            time.sleep(0.0005)
+        viewer.draw()
+    results["decode_blit_ms"] = 1e3 * (time.perf_counter() - start) / (messages // cameras)
+
+    # Messages faster than the display
+    before = (receiver.stats(), viewer.rendered)
+    stop = threading.Event()
+
+    def receive():
+        deadline = time.monotonic()
+        i = 0
+        while not stop.is_set():
+            receiver.on_message(None, None, payloads[i % cameras])
+            i += 1
+            deadline += 1 / rate
+            time.sleep(max(0, deadline - time.monotonic()))
+
+    thread = threading.Thread(target=receive)
+    thread.start()
+    start = time.monotonic()
+    while time.monotonic() - start < duration:
+        viewer.draw()
+        time.sleep(1 / fps)
+    stop.set()
+    thread.join()
+    elapsed = time.monotonic() - start
+    after = receiver.stats()
+    receiver.stop()
+    plt.close(viewer.fig)
+    results["sustained"] = {
+        "messages_per_s": (after["received"] - before[0]["received"]) / elapsed,
+        "rendered_per_s": (viewer.rendered - before[1]) / elapsed,
+        "dropped_per_s": (after["dropped"] - before[0]["dropped"]) / elapsed,
+    }
+    return results
+
+
+def benchmark_end_to_end(duration=2.0, backend="simulated", fmt="float32", step=5.0):
+    """Measure the scan loop of the MQTT API on simulated hardware.
+
+    The API runs in a temporary directory and publishes to a client
+    recording the messages.
+
+    Parameters
+    ----------
+    duration : float
+        Duration of the scan in seconds.
+    backend : str
+        Hardware backend, see ``hardware.create_backend``.
+    fmt : str
+        Format of the frame messages.
+    step : float
+        Angle in degrees between two positions of the scan.
+
+    Returns
+    -------
+    results : dict
+        Positions, frames and bytes per second published, latency in
+        milliseconds from acquisition to publication (mean, 95th percentile
+        and maximum), and timing of the scan stages.
+    """
+    client = RecordingMQTTClient()
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            api = ThermalCameraAPI(backend=backend)
+            api.init(client, {"absolute_position": 0})
+            api.thermal_camera.mlx_dict.wait()
+            start = time.time()
+            api.run(client, {"step": step, "wait": 0, "format": fmt})
+            time.sleep(duration)
+            api.stop(client, {})
+            elapsed = time.time() - start
+        finally:
+            os.chdir(cwd)
+    frames = [(t, payload) for t, topic, payload in client.messages if topic.startswith(f"{api.TOPIC_ROOT}/camera")]
+    latency = np.array([t - decode_frame(payload).timestamp for t, payload in frames]) * 1e3
+    return {
+        "positions_per_s": len(frames) / len(api.thermal_camera.mlx_dict) / elapsed,
+        "frames_per_s": len(frames) / elapsed,
+        "bytes_per_s": sum(len(payload) for _, _, payload in client.messages) / elapsed,
+        "latency_ms": {
+            "mean": float(latency.mean()),
+            "p95": float(np.percentile(latency, 95)),
+            "max": float(latency.max()),
+        },
+        "stages": api.scan_timer.summary(),
+    }
+
+
+def benchmark_replay(duration=2.0, speeds=(1.0, 10.0, None), fmt="float32", step=5.0):
+    """Record a scan on simulated hardware and replay it at several speeds.
+
+    The messages of the scan are recorded, then replayed to a local
+    ``SimulatedBroker`` through an ``MQTTPublisher``, and as fast as
+    possible into a panorama stitcher consuming the frames in the replaying
+    thread.
+
+    Parameters
+    ----------
+    duration : float
+        Duration of the recorded scan in seconds.
+    speeds : tuple
+        Replay speeds, None for as fast as possible.
+    fmt : str
+        Format of the frame messages.
+    step : float
+        Angle in degrees between two positions of the scan.
+
+    Returns
+    -------
+    results : dict
+        Messages and bytes of the recording, and the replay statistics of
+        each speed and of the stitcher, see ``StreamReplayer.run``.
+    """
+    import paho.mqtt.client as mqtt
+
+    client = RecordingMQTTClient()
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            api = ThermalCameraAPI(backend="simulated")
+            api.init(client, {"absolute_position": 0})
+            api.run(client, {"step": step, "wait": 0, "format": fmt})
+            time.sleep(duration)
+            api.stop(client, {})
+            api.thermal_camera.close()
+        finally:
+            os.chdir(cwd)
+        path = os.path.join(directory, "scan.rec")
+        recorder = StreamRecorder(path)
+        for t, topic, payload in client.messages:
+            recorder.record(topic, payload, timestamp=t)
+        recorder.close()
+        results = {"recording": {"messages": recorder.messages, "bytes": os.path.getsize(path)}}
+
+        broker = SimulatedBroker()
+        publisher = MQTTPublisher(mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, "replay"))
+        publisher.connect("127.0.0.1", broker.port)
+        while not publisher.connected:
+            time.sleep(0.01)
+        for speed in speeds:
+            results[f"speed_{speed or 'max'}"] = StreamReplayer(path, publisher, speed=speed).run()
+        publisher.disconnect()
+        publisher.loop_stop()
+        broker.close()
+
+        class Stitcher:
+            """Consumer stitching the replayed frames into a panorama."""
+
+            def __init__(self):
+                self.stitcher = PanoramaStitcher()
+
+            def publish(self, topic, payload=None, qos=0, retain=False):
+                if topic.startswith(f"{api.TOPIC_ROOT}/camera"):
+                    message = decode_frame(payload)
+                    self.stitcher.add_frame(f"camera{message.camera}", message.image, message.position)
+
+        results["stitcher"] = StreamReplayer(path, Stitcher(), speed=None).run(topics=[f"{api.TOPIC_ROOT}/camera"])
+    return results
+
+
+def benchmark_history(days=7, interval=10.0, cameras=4, step=5.0):
+    """Record a scan of several days into a statistics store and query it.
+
+    Parameters
+    ----------
+    days : float
+        Duration of the recorded scan in days, ending now.
+    interval : float
+        Time in seconds between two acquisitions of the cameras.
+    cameras : int
+        Number of cameras.
+    step : float
+        Angle in degrees between two positions of the scan.
+
+    Returns
+    -------
+    results : dict
+        Frames recorded, time in microseconds to record a frame, and for
+        the last hour, the last day and a summary of the whole scan, the
+        resolution, rows read and time in milliseconds of the query. The
+        whole scan is also summarized from the 1 min buckets for reference.
+    """
+    now = time.time()
+    start = now - days * 86400
+    times = np.arange(start, now, interval)
+    stats = {"min_temperature": 20.0, "max_temperature": 30.0, "percentile05_temperature": 21.0, "percentile95_temperature": 29.0}
+    results = {"frames": len(times) * cameras}
+    with tempfile.TemporaryDirectory() as directory:
+        store = StatisticsStore(directory)
+        begin = time.perf_counter()
+        for i, t in enumerate(times):
+            for camera in range(cameras):
+                store.add(camera, t, (i * step) % 360, stats)
+        results["add_us"] = 1e6 * (time.perf_counter() - begin) / results["frames"]
+        store.flush(now + 3600)
+
+        def measure(name, query):
+            store.rows_read = 0
+            begin = time.perf_counter()
+            resolution, rows = query()
+            results[name] = {
+                "resolution": resolution,
+                "rows_read": store.rows_read,
+                "rows": len(rows),
+                "ms": 1e3 * (time.perf_counter() - begin),
+            }
+
+        measure("last_hour", lambda: store.query(start=-3600))
+        measure("last_day", lambda: store.query(start=-86400))
+        measure("summary", lambda: store.summary(start=start))
+        measure("summary_1min", lambda: (60, merge(store.query(start=start, resolution=60)[1], ["camera"])))
+        store.close()
+    return results
+
+
+BENCHMARKS = {
+    "engine": benchmark_engine,
+    "startup": benchmark_startup,
+    "format": benchmark_format,
+    "motion": benchmark_motion,
+    "homing": benchmark_homing,
+    "pipeline": benchmark_pipeline,
+    "streaming": benchmark_streaming,
+    "commands": benchmark_commands,
+    "frame_cache": benchmark_frame_cache,
+    "denoising": benchmark_denoising,
+    "change_detection": benchmark_change_detection,
+    "statistics": benchmark_statistics,
+    "alarms": benchmark_alarms,
+    "pixel_pipeline": benchmark_pixel_pipeline,
+    "step_jitter": benchmark_step_jitter,
+    "rest": benchmark_rest,
+    "publisher": benchmark_publisher,
+    "viewer": benchmark_viewer,
+    "replay": benchmark_replay,
+    "history": benchmark_history,
+    "end_to_end": benchmark_end_to_end,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmarks", nargs="*", default=list(BENCHMARKS), help="Benchmarks to run")
+    args = parser.parse_args()
+
+    for name in args.benchmarks:
+        logging.info(f"Running benchmark {name}")
+        print(name, BENCHMARKS[name]())
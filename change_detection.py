@@ -0,0 +1,124 @@
+"""Change detection of the streamed frames, for the scenes that barely change."""
+
+import threading
+import numpy as np
+
+from frame_format import decode_frame, encode_delta, encode_frame
+
+
+class ChangeDetector:
+    """Encode the streamed frames of the cameras, skipping the unchanged ones.
+
+    A frame is not published when no pixel differs by more than
+    ``threshold`` from the last published frame of the camera. In delta
+    mode, the published frames are sent as their quantized difference to the
+    last keyframe, see ``frame_format.encode_delta``. A full keyframe is sent
+    at least every ``keyframe_interval`` seconds, even if nothing changed, so
+    late subscribers can sync and know the camera is alive.
+
+    Parameters
+    ----------
+    threshold : float
+        Change in kelvin of a pixel above which a frame is published, 0 to
+        publish all the frames. It should be above the noise of the frames,
+        see ``denoising``.
+    delta : bool
+        Whether to send delta frames between the keyframes. The ``json``
+        format is always sent in full.
+    keyframe_interval : float
+        Maximum time in seconds between two keyframes.
+    step : float
+        Quantization step of the delta frames in kelvin.
+    """
+
+    def __init__(self, threshold=0.0, delta=False, keyframe_interval=10.0, step=0.05):
+        if threshold < 0 or keyframe_interval <= 0 or step <= 0:
+            raise ValueError("The threshold must be positive or zero, the keyframe interval and step positive")
+        self.threshold = threshold
+        self.delta = delta
+        self.keyframe_interval = keyframe_interval
+        self.step = step
+        self.keyframes = 0
+        self.deltas = 0
+        self.unchanged = 0
+        self.bytes = 0
+        self._cameras = {}
+        self._lock = threading.Lock()
+
+    def config(self):
+        """Get the configuration of the detector."""
+        return {
+            "threshold": self.threshold,
+            "delta": self.delta,
+            "keyframe_interval": self.keyframe_interval,
+            "step": self.step,
+        }
+
+    def stats(self):
+        """Get the number of keyframes, delta frames and unchanged frames, and the bytes sent."""
+        return {"keyframes": self.keyframes, "deltas": self.deltas, "unchanged": self.unchanged, "bytes": self.bytes}
+
+    def encode(self, camera, record, stats, fmt):
+        """Encode a frame unless it did not change.
+
+        Parameters
+        ----------
+        camera : str
+            Name of the camera.
+        record : FrameRecord
+            Frame and its metadata.
+        stats : dict
+            Statistics of the frame, see ``frame_format.encode_frame``.
+        fmt : str
+            Format of the keyframes, one of ``frame_format.FORMATS``.
+
+        Returns
+        -------
+        payload : bytes or str
+            Encoded message, None if the frame did not change.
+        """
+        frame = record.frame
+        with self._lock:
+            if camera not in self._cameras:
+                self._cameras[camera] = {
+                    "last": np.empty_like(frame),
+                    "difference": np.empty_like(frame),
+                    "keyframe": None,
+                    "sequence": None,
+                    "time": None,
+                }
+            state = self._cameras[camera]
+            last, difference = state["last"], state["difference"]
+            due = state["time"] is None or abs(record.timestamp - state["time"]) >= self.keyframe_interval
+            if not due and self.threshold > 0:
+                np.subtract(frame, last, out=difference)
+                np.abs(difference, out=difference)
+                if difference.max() <= self.threshold:
+                    self.unchanged += 1
+                    return None
+            payload = None
+            if self.delta and not due and fmt != "json" and state["keyframe"] is not None:
+                payload = encode_delta(
+                    frame,
+                    state["keyframe"],
+                    state["sequence"],
+                    camera,
+                    record.position,
+                    record.timestamp,
+                    record.sequence,
+                    stats,
+                    self.step,
+                )
+            if payload is None:
+                payload = encode_frame(frame, camera, record.position, record.timestamp, record.sequence, stats, fmt)
+                if self.delta and fmt != "json":
+                    # The deltas refer to the keyframe as decoded by the subscribers
+                    state["keyframe"] = decode_frame(payload).image
+                state["sequence"] = record.sequence
+                state["time"] = record.timestamp
+                self.keyframes += 1
+            else:
+                self.deltas += 1
+            last[:] = frame
+            self.bytes += len(payload)
+            return payload
@@ -0,0 +1,181 @@
+"""Execution of the commands received over MQTT, off the network thread."""
+
+import time
+import queue
+import logging
+import itertools
+import threading
+
+
+class _Job:
+    """Command waiting for or under execution."""
+
+    def __init__(self, job_id, command, resource, function, payload):
+        self.id = job_id
+        self.command = command
+        self.resource = resource
+        self.function = function
+        self.payload = payload
+        self.submitted = time.monotonic()
+        self.cancelled = False
+
+
+class CommandExecutor:
+    """Queue of commands with one worker thread per resource.
+
+    Commands on the same resource run one at a time in order of arrival,
+    commands on different resources run concurrently. Every command is
+    acknowledged when queued and reported when finished through
+    ``publish_result``, with its correlation id.
+
+    Parameters
+    ----------
+    publish_result : callable
+        Function taking the result dictionary of a command: ``id``,
+        ``command``, ``status`` (``accepted``, ``done``, ``error`` or
+        ``cancelled``), and for finished commands ``queue_ms``, ``exec_ms``
+        and ``error``.
+    interrupts : dict, optional
+        ``threading.Event`` of each resource, set to interrupt the command
+        running on it and cleared after each command.
+    """
+
+    def __init__(self, publish_result, interrupts=None):
+        self.publish_result = publish_result
+        self.interrupts = dict(interrupts or {})
+        self._queues = {}
+        self._workers = {}
+        self._running = {}
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+
+    def submit(self, command, resource, function, payload, job_id=None):
+        """Queue a command.
+
+        Parameters
+        ----------
+        command : str
+            Name of the command.
+        resource : str
+            Resource the command uses, e.g. ``motor``.
+        function : callable
+            Function executing the command, taking ``payload``.
+        payload : dict
+            Parameters of the command.
+        job_id : str, optional
+            Correlation id, generated if not given.
+
+        Returns
+        -------
+        job_id : str
+            Correlation id of the command.
+        """
+        job_id = str(next(self._ids)) if job_id is None else str(job_id)
+        job = _Job(job_id, command, resource, function, payload)
+        with self._lock:
+            if resource not in self._queues:
+                self._queues[resource] = queue.Queue()
+                worker = threading.Thread(target=self._work, args=(resource,), name=f"cmd-{resource}", daemon=True)
+                self._workers[resource] = worker
+                worker.start()
+            self._queues[resource].put(job)
+            depth = self._queues[resource].qsize()
+        self.publish_result({"id": job_id, "command": command, "status": "accepted", "queue_depth": depth})
+        return job_id
+
+    def cancel(self, job_id=None, resource="motor"):
+        """Cancel a queued or running command.
+
+        Parameters
+        ----------
+        job_id : str, optional
+            Correlation id of the command. By default, the command running on
+            ``resource`` is interrupted.
+        resource : str
+            Resource of the command to interrupt if no id is given.
+
+        Returns
+        -------
+        found : bool
+            Whether a command was cancelled.
+        """
+        with self._lock:
+            if job_id is None:
+                running = self._running.get(resource)
+                jobs = [running] if running is not None else []
+            else:
+                jobs = [job for job in self._running.values() if job is not None and job.id == str(job_id)]
+                for jobs_queue in self._queues.values():
+                    with jobs_queue.mutex:
+                        jobs += [job for job in jobs_queue.queue if job.id == str(job_id)]
+            for job in jobs:
+                job.cancelled = True
+                if self._running.get(job.resource) is job and job.resource in self.interrupts:
+                    self.interrupts[job.resource].set()
+        return bool(jobs)
+
+    def stop(self, timeout=5.0):
+        """Stop the workers after the commands already queued."""
+        with self._lock:
+            for jobs_queue in self._queues.values():
+                jobs_queue.put(None)
+            workers = list(self._workers.values())
+        for worker in workers:
+            worker.join(timeout)
+
+    def metrics(self):
+        """Get the latency of each command.
+
+        Returns
+        -------
+        metrics : dict
+            Number of executions, mean and maximum time in milliseconds spent
+            in the queue and executing, of each command.
+        """
+        with self._lock:
+            return {
+                command: {
+                    "count": m["count"],
+                    "queue_ms": 1e3 * m["queue"] / m["count"],
+                    "max_queue_ms": 1e3 * m["max_queue"],
+                    "exec_ms": 1e3 * m["exec"] / m["count"],
+                    "max_exec_ms": 1e3 * m["max_exec"],
+                }
+                for command, m in self._metrics.items()
+            }
+
+    def _work(self, resource):
+        jobs_queue = self._queues[resource]
+        while True:
+            job = jobs_queue.get()
+            if job is None:
+                break
+            with self._lock:
+                self._running[resource] = job
+            start = time.monotonic()
+            result = {"id": job.id, "command": job.command, "error": None}
+            if job.cancelled:
+                result["status"] = "cancelled"
+            else:
+                try:
+                    job.function(job.payload)
+                    result["status"] = "cancelled" if job.cancelled else "done"
+                except Exception as e:
+                    logging.error(f"Error when executing command {job.command}: {e}")
+                    result.update(status="error", error=str(e) or type(e).__name__)
+            end = time.monotonic()
+            with self._lock:
+                self._running[resource] = None
+                if resource in self.interrupts:
+                    self.interrupts[resource].clear()
+                m = self._metrics.setdefault(
+                    job.command, {"count": 0, "queue": 0.0, "max_queue": 0.0, "exec": 0.0, "max_exec": 0.0}
+                )
+                m["count"] += 1
+                m["queue"] += start - job.submitted
+                m["max_queue"] = max(m["max_queue"], start - job.submitted)
+                m["exec"] += end - start
+                m["max_exec"] = max(m["max_exec"], end - start)
+            result.update(queue_ms=1e3 * (start - job.submitted), exec_ms=1e3 * (end - start))
+            self.publish_result(result)
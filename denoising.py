@@ -0,0 +1,139 @@
+"""Temporal denoising of the camera frames."""
+
+import threading
+import numpy as np
+
+MODES = ("none", "mean", "ema", "median")
+
+
+class TemporalFilter:
+    """Filter of the successive frames of a camera, computed in place.
+
+    The last ``length`` frames are kept in a preallocated history, and the
+    filtered frame is written into a preallocated buffer:
+
+    - ``mean``: moving average of the last ``length`` frames, updated with a
+      running sum;
+    - ``ema``: exponential moving average with weight ``alpha`` of the new
+      frame;
+    - ``median``: median of the last ``length`` frames, robust to the outliers;
+    - ``none``: the frames are passed through.
+
+    The filter is reset when the motor position changes, so frames of
+    different positions are never mixed.
+
+    Parameters
+    ----------
+    mode : str
+        One of ``MODES``.
+    length : int
+        Number of frames of the moving average and median.
+    alpha : float
+        Weight of the new frame in the exponential moving average, in (0, 1].
+    pixels : int
+        Number of pixels of a frame.
+    """
+
+    def __init__(self, mode="none", length=8, alpha=0.25, pixels=24 * 32):
+        if mode not in MODES:
+            raise ValueError(f"Filter mode must be one of {list(MODES)}")
+        if length < 1:
+            raise ValueError("The filter length must be at least 1")
+        if not 0 < alpha <= 1:
+            raise ValueError("The filter weight must be in (0, 1]")
+        self.mode = mode
+        self.length = length
+        self.alpha = alpha
+        self.history = np.zeros((length, pixels), dtype=np.float32)
+        self.output = np.zeros((pixels,), dtype=np.float32)
+        self._sum = np.zeros((pixels,), dtype=np.float64)
+        self._scratch = np.zeros((length, pixels), dtype=np.float32)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self, position=None):
+        """Forget the frames accumulated so far."""
+        self.count = 0
+        self.position = position
+        self.sequence = None
+        self._sum.fill(0)
+
+    @property
+    def settled(self):
+        """Whether the filter holds ``length`` frames of the current position."""
+        return self.mode == "none" or self.count >= self.length
+
+    def update(self, frame, position, sequence=None, out=None):
+        """Add a frame and get the filtered frame.
+
+        Parameters
+        ----------
+        frame : numpy.ndarray
+            New frame.
+        position : float
+            Motor position of the frame, the filter is reset when it changes.
+            A frame without position (NaN) is passed through.
+        sequence : int, optional
+            Sequence number of the frame, a frame already added is ignored.
+        out : numpy.ndarray, optional
+            Array the filtered frame is copied into, for the callers sharing
+            the filter with other threads.
+
+        Returns
+        -------
+        output : numpy.ndarray
+            Filtered frame, ``out`` if given, otherwise a buffer of the filter
+            overwritten by the next update.
+        """
+        with self._lock:
+            if not np.isfinite(position):
+                # Read while the motor moved: passed through, the filter is kept
+                if out is None:
+                    return frame
+                out[:] = frame
+                return out
+            if position != self.position:
+                self.reset(position)
+            if sequence is None or sequence != self.sequence:
+                self._add(frame)
+            self.sequence = sequence
+            if out is None:
+                return self.output
+            out[:] = self.output
+            return out
+
+    def _add(self, frame):
+        if self.mode == "none":
+            self.output[:] = frame
+        elif self.mode == "ema":
+            if self.count == 0:
+                self.output[:] = frame
+            else:
+                # output += alpha * (frame - output)
+                scratch = self._scratch[0]
+                np.subtract(frame, self.output, out=scratch)
+                scratch *= self.alpha
+                self.output += scratch
+        else:
+            slot = self.count % self.length
+            if self.mode == "mean":
+                if self.count >= self.length:
+                    self._sum -= self.history[slot]
+                self._sum += frame
+            self.history[slot] = frame
+            filled = min(self.count + 1, self.length)
+            if self.mode == "mean":
+                np.divide(self._sum, filled, out=self.output, casting="same_kind")
+            else:
+                # The partial sort of np.median works on a copy of the history
+                scratch = self._scratch[:filled]
+                np.copyto(scratch, self.history[:filled])
+                np.median(scratch, axis=0, out=self.output, overwrite_input=True)
+        self.count += 1
+        if self.mode == "mean" and self.count % (64 * self.length) == 0:
+            # Drop the rounding errors accumulated by the running sum
+            np.sum(self.history, axis=0, dtype=np.float64, out=self._sum)
+
+    def config(self):
+        """Get the configuration of the filter."""
+        return {"mode": self.mode, "length": self.length, "alpha": self.alpha}
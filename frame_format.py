@@ -0,0 +1,407 @@
+"""Encoding and decoding of the frame messages published by the thermal camera system.
+
+Three formats are available:
+
+- ``json``: JSON object with the base64 encoded float32 frame and the
+  statistics, the historical format.
+- ``float32``: binary header followed by the raw float32 pixels.
+- ``uint16``: binary header followed by the pixels quantized to unsigned 16 bit
+  centi-kelvin (0.01 K resolution, -273.15 to 382.20 C, 0 marks bad pixels).
+
+The binary header is little-endian:
+
+====== ======= =====================================================
+Offset Type    Content
+====== ======= =====================================================
+0      2s      magic ``b"TC"``
+2      uint8   format version
+3      uint8   pixel encoding (``FLOAT32`` or ``UINT16_CK``)
+4      uint8   camera number
+5      uint8   reserved
+6      uint16  number of pixels
+8      uint32  frame sequence number
+12     float64 acquisition timestamp (seconds since the epoch)
+20     float32 motor position in degrees
+24     float32 minimum, maximum, 5th and 95th percentile temperatures
+====== ======= =====================================================
+
+Delta frames, sent instead of full frames of a scene that barely changes,
+have the binary header with the ``DELTA_INT8`` pixel encoding, followed by
+the sequence number (uint32) of the keyframe they refer to, the quantization
+step (float32) in kelvin, and the zlib-compressed int8 differences of the
+pixels to the keyframe in steps. Any full frame is a keyframe, see
+``FrameDecoder``.
+
+Panorama regions are published with a header followed by the float32 cells,
+row by row (NaN for cells never seen):
+
+====== ======= =====================================================
+Offset Type    Content
+====== ======= =====================================================
+0      2s      magic ``b"TP"``
+2      uint8   format version
+3      uint8   reserved
+4      uint16  rows and columns of the whole panorama
+8      uint16  first row and first column of the region
+12     uint16  rows and columns of the region
+16     float32 angular size of a cell in degrees
+====== ======= =====================================================
+
+Bundles carry the frame messages of all the cameras of an acquisition cycle
+in one message: a header (magic ``b"TB"``, uint8 format version, uint8
+number of frames), then for each frame its uint8 camera number and uint32
+message length, then the frame messages one after the other.
+"""
+
+import json
+import zlib
+import base64
+import struct
+from collections import namedtuple
+import numpy as np
+
+MAGIC = b"TC"
+VERSION = 1
+FLOAT32 = 0
+UINT16_CK = 1
+DELTA_INT8 = 2
+HEADER = struct.Struct("<2sBBBxHIdf4f")
+DELTA_HEADER = struct.Struct("<If")
+PANORAMA_MAGIC = b"TP"
+PANORAMA_HEADER = struct.Struct("<2sBxHHHHHHf")
+BUNDLE_MAGIC = b"TB"
+BUNDLE_HEADER = struct.Struct("<2sBB")
+BUNDLE_ENTRY = struct.Struct("<BI")
+FORMATS = {
+    "json": None,
+    "float32": FLOAT32,
+    "uint16": UINT16_CK,
+}
+
+FrameMessage = namedtuple(
+    "FrameMessage",
+    [
+        "camera",
+        "position",
+        "timestamp",
+        "sequence",
+        "min_temperature",
+        "max_temperature",
+        "percentile05_temperature",
+        "percentile95_temperature",
+        "image",
+    ],
+)
+
+
+PanoramaRegion = namedtuple("PanoramaRegion", ["shape", "row", "column", "resolution", "panorama"])
+
+
+def camera_number(camera):
+    """Get the number of a camera from its name, e.g. 2 for ``camera2``."""
+    return int(camera.replace("camera", "").replace("-", ""))
+
+
+def encode_frame(frame, camera, position, timestamp, sequence, stats, fmt="float32"):
+    """Encode a frame message.
+
+    Parameters
+    ----------
+    frame : numpy.ndarray
+        Float32 frame in Celsius.
+    camera : str
+        Name of the camera.
+    position : float
+        Motor position in degrees.
+    timestamp : float
+        Acquisition time in seconds since the epoch.
+    sequence : int
+        Sequence number of the frame.
+    stats : dict
+        ``min_temperature``, ``max_temperature``, ``percentile05_temperature``
+        and ``percentile95_temperature`` of the frame.
+    fmt : str
+        Message format, one of ``FORMATS``.
+
+    Returns
+    -------
+    payload : bytes or str
+        Encoded message.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown frame format {fmt}, must be one of {list(FORMATS)}")
+    if fmt == "json":
+        result = {
+            "image": base64.b64encode(memoryview(frame)).decode("utf-8"),
+            "position": position,
+            "timestamp": timestamp,
+            "sequence": sequence,
+        }
+        result.update(stats)
+        return json.dumps(result)
+    encoding = FORMATS[fmt]
+    header = _pack_header(encoding, frame, camera, position, timestamp, sequence, stats)
+    if encoding == UINT16_CK:
+        scaled = frame * np.float32(100)
+        scaled += np.float32(27315.5)
+        scaled[np.isnan(scaled)] = 0
+        np.clip(scaled, 0, 65535, out=scaled)
+        pixels = scaled.astype("<u2")
+    else:
+        pixels = frame.astype("<f4", copy=False)
+    return b"".join((header, memoryview(pixels)))
+
+
+def _pack_header(encoding, frame, camera, position, timestamp, sequence, stats):
+    return HEADER.pack(
+        MAGIC,
+        VERSION,
+        encoding,
+        camera_number(camera),
+        len(frame),
+        sequence & 0xFFFFFFFF,
+        timestamp,
+        position,
+        stats["min_temperature"],
+        stats["max_temperature"],
+        stats["percentile05_temperature"],
+        stats["percentile95_temperature"],
+    )
+
+
+def encode_delta(frame, keyframe, keyframe_sequence, camera, position, timestamp, sequence, stats, step=0.05):
+    """Encode a frame as its quantized difference to a keyframe.
+
+    Parameters
+    ----------
+    frame : numpy.ndarray
+        Float32 frame in Celsius.
+    keyframe : numpy.ndarray
+        Frame last published in full, as received by the subscribers.
+    keyframe_sequence : int
+        Sequence number of the keyframe.
+    camera, position, timestamp, sequence, stats
+        See ``encode_frame``.
+    step : float
+        Quantization step of the differences in kelvin, the error of the
+        decoded pixels is at most half a step.
+
+    Returns
+    -------
+    payload : bytes
+        Encoded message, None if a difference does not fit in 8 bits, in
+        which case a new keyframe must be sent.
+    """
+    steps = np.subtract(frame, keyframe, dtype=np.float32)
+    steps /= np.float32(step)
+    np.rint(steps, out=steps)
+    if not np.all(np.abs(steps) <= 127):
+        return None
+    header = _pack_header(DELTA_INT8, frame, camera, position, timestamp, sequence, stats)
+    delta = DELTA_HEADER.pack(keyframe_sequence & 0xFFFFFFFF, step)
+    return b"".join((header, delta, zlib.compress(steps.astype(np.int8).tobytes(), 1)))
+
+
+def decode_frame(payload, camera=None, keyframe=None):
+    """Decode a frame message in any of the formats.
+
+    Parameters
+    ----------
+    payload : bytes
+        Message payload.
+    camera : int, optional
+        Camera number, used for ``json`` messages which do not carry it.
+    keyframe : numpy.ndarray, optional
+        Keyframe of a delta frame.
+
+    Returns
+    -------
+    message : FrameMessage
+        Decoded message, ``image`` is a float32 array of the 768 pixels.
+    """
+    payload = memoryview(payload)
+    if payload[:2] != MAGIC:
+        result = json.loads(bytes(payload))
+        return FrameMessage(
+            camera=camera,
+            position=result.get("position"),
+            timestamp=result.get("timestamp"),
+            sequence=result.get("sequence"),
+            min_temperature=result.get("min_temperature"),
+            max_temperature=result.get("max_temperature"),
+            percentile05_temperature=result.get("percentile05_temperature"),
+            percentile95_temperature=result.get("percentile95_temperature"),
+            image=np.frombuffer(base64.b64decode(result["image"]), dtype="<f4"),
+        )
+    header = HEADER.unpack_from(payload)
+    version, encoding, number, pixels, sequence, timestamp, position = header[1:8]
+    if version != VERSION:
+        raise ValueError(f"Unsupported frame format version {version}")
+    if encoding == UINT16_CK:
+        raw = np.frombuffer(payload, dtype="<u2", count=pixels, offset=HEADER.size)
+        image = raw.astype(np.float32)
+        image *= 0.01
+        image -= 273.15
+    elif encoding == FLOAT32:
+        image = np.frombuffer(payload, dtype="<f4", count=pixels, offset=HEADER.size)
+    elif encoding == DELTA_INT8:
+        if keyframe is None:
+            raise ValueError("Delta frame decoded without its keyframe")
+        _, step = DELTA_HEADER.unpack_from(payload, HEADER.size)
+        steps = np.frombuffer(zlib.decompress(payload[HEADER.size + DELTA_HEADER.size :]), dtype=np.int8)
+        image = steps.astype(np.float32)
+        image *= np.float32(step)
+        image += keyframe
+    else:
+        raise ValueError(f"Unknown pixel encoding {encoding}")
+    return FrameMessage(number, position, timestamp, sequence, *header[8:], image)
+
+
+class FrameDecoder:
+    """Decoder of a stream of frame messages, delta frames included.
+
+    The last ``keep`` full frames of each camera are kept as the
+    keyframes of the delta frames, found by their sequence number: the full
+    frames replying to ``get_frame`` between the streamed ones do not replace
+    the keyframe of the stream. A delta frame arriving before its keyframe,
+    e.g. for a late subscriber, is skipped until the next keyframe.
+
+    Parameters
+    ----------
+    keep : int
+        Number of full frames kept per camera.
+
+    Attributes
+    ----------
+    skipped : int
+        Number of delta frames without their keyframe.
+    """
+
+    def __init__(self, keep=4):
+        self.keyframes = {}
+        self.keep = keep
+        self.skipped = 0
+
+    def decode(self, payload, camera=None):
+        """Decode a frame message.
+
+        Parameters
+        ----------
+        payload : bytes
+            Message payload.
+        camera : int, optional
+            Camera number, used for ``json`` messages which do not carry it.
+
+        Returns
+        -------
+        message : FrameMessage
+            Decoded message, None for a delta frame without its keyframe.
+        """
+        payload = memoryview(payload)
+        if payload[:2] == MAGIC and payload[3] == DELTA_INT8:
+            number = payload[4]
+            keyframe_sequence, _ = DELTA_HEADER.unpack_from(payload, HEADER.size)
+            keyframe = self.keyframes.get(number, {}).get(keyframe_sequence)
+            if keyframe is None:
+                self.skipped += 1
+                return None
+            return decode_frame(payload, camera, keyframe)
+        message = decode_frame(payload, camera)
+        keyframes = self.keyframes.setdefault(message.camera, {})
+        keyframes[message.sequence] = message.image
+        if len(keyframes) > self.keep:
+            # Oldest first, in order of insertion
+            del keyframes[next(iter(keyframes))]
+        return message
+
+
+def encode_panorama_region(shape, row, column, panorama, resolution):
+    """Encode a region of the panorama.
+
+    Parameters
+    ----------
+    shape : tuple of int
+        Rows and columns of the whole panorama.
+    row, column : int
+        First cell of the region.
+    panorama : numpy.ndarray
+        Float32 cells of the region.
+    resolution : float
+        Angular size of a cell in degrees.
+
+    Returns
+    -------
+    payload : bytes
+        Encoded message.
+    """
+    header = PANORAMA_HEADER.pack(PANORAMA_MAGIC, VERSION, *shape, row, column, *panorama.shape, resolution)
+    return b"".join((header, memoryview(np.ascontiguousarray(panorama, dtype="<f4"))))
+
+
+def decode_panorama_region(payload):
+    """Decode a region of the panorama.
+
+    Parameters
+    ----------
+    payload : bytes
+        Message payload.
+
+    Returns
+    -------
+    region : PanoramaRegion
+        Panorama shape, first cell, cell size and float32 cells of the region.
+    """
+    magic, version, total_rows, total_columns, row, column, rows, columns, resolution = PANORAMA_HEADER.unpack_from(
+        payload
+    )
+    if magic != PANORAMA_MAGIC or version != VERSION:
+        raise ValueError("Not a panorama message of a supported version")
+    panorama = np.frombuffer(payload, dtype="<f4", count=rows * columns, offset=PANORAMA_HEADER.size)
+    return PanoramaRegion((total_rows, total_columns), row, column, resolution, panorama.reshape(rows, columns))
+
+
+def encode_bundle(messages):
+    """Encode the frame messages of an acquisition cycle as a single message.
+
+    Parameters
+    ----------
+    messages : list of tuple
+        ``(camera, payload)`` of each frame, the camera name and its frame
+        message in any format.
+
+    Returns
+    -------
+    payload : bytes
+        Encoded bundle.
+    """
+    payloads = [payload.encode("utf-8") if isinstance(payload, str) else payload for _, payload in messages]
+    parts = [BUNDLE_HEADER.pack(BUNDLE_MAGIC, VERSION, len(payloads))]
+    parts += [BUNDLE_ENTRY.pack(camera_number(camera), len(payload)) for (camera, _), payload in zip(messages, payloads)]
+    return b"".join(parts + payloads)
+
+
+def decode_bundle(payload):
+    """Split a bundle into its frame messages.
+
+    Parameters
+    ----------
+    payload : bytes
+        Message payload.
+
+    Returns
+    -------
+    messages : list of tuple
+        ``(camera number, payload)`` of each frame, the payloads are views of
+        the bundle, see ``decode_frame`` and ``FrameDecoder.decode``.
+    """
+    payload = memoryview(payload)
+    magic, version, count = BUNDLE_HEADER.unpack_from(payload)
+    if magic != BUNDLE_MAGIC or version != VERSION:
+        raise ValueError("Not a bundle message of a supported version")
+    offset = BUNDLE_HEADER.size + count * BUNDLE_ENTRY.size
+    messages = []
+    for i in range(count):
+        number, length = BUNDLE_ENTRY.unpack_from(payload, BUNDLE_HEADER.size + i * BUNDLE_ENTRY.size)
+        messages.append((number, payload[offset : offset + length]))
+        offset += length
+    return messages
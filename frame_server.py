@@ -0,0 +1,221 @@
+"""Latest frames of the cameras, acquired once and served from memory to many clients."""
+
+import time
+import logging
+import threading
+from collections import namedtuple
+
+from frame_format import FORMATS, encode_frame
+from frame_stats import FrameStatistics
+
+Snapshot = namedtuple("Snapshot", ["camera", "etag", "payload", "sequence", "timestamp", "position"])
+
+
+class FrameServer:
+    """Acquire the frames of the cameras in a thread and keep the latest one encoded.
+
+    A thread acquires a frame of each camera every ``1 / rate`` seconds,
+    computes the statistics of all of them at once and encodes each frame
+    once. The clients get the latest encoded frame, a ``Snapshot``, from
+    memory: their number does not change the bus reads nor the encoding
+    work. Each snapshot has an entity tag, unique across restarts, for the
+    conditional requests.
+
+    Parameters
+    ----------
+    cameras : list of str
+        Names of the cameras.
+    acquire : callable
+        Function taking a camera name and the sequence number of its previous
+        frame (None at first), and returning a newer ``FrameRecord``.
+    rate : float
+        Frames per second of each camera.
+    fmt : str
+        Format of the frames, one of ``frame_format.FORMATS``.
+    history : timeseries.StatisticsStore, optional
+        Store recording the statistics of every frame.
+    """
+
+    LOG_EVERY = 100
+
+    def __init__(self, cameras, acquire, rate=1.0, fmt="float32", history=None):
+        if fmt not in FORMATS:
+            raise ValueError(f"Unknown frame format {fmt}, must be one of {list(FORMATS)}")
+        if rate <= 0:
+            raise ValueError("The frame rate must be positive")
+        self.cameras = list(cameras)
+        self.acquire = acquire
+        self.rate = rate
+        self.fmt = fmt
+        self.history = history
+        self.statistics = FrameStatistics(cameras=len(self.cameras))
+        self.cycles = 0
+        self.errors = 0
+        self.clients = 0
+        self._epoch = f"{time.time_ns():x}"
+        self._snapshots = {}
+        self._version = 0
+        self._condition = threading.Condition()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    @property
+    def mimetype(self):
+        """Media type of the frame payloads."""
+        return "application/json" if self.fmt == "json" else "application/octet-stream"
+
+    def start(self):
+        """Start acquiring in a thread."""
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._loop, name="frame-server", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5.0):
+        """Stop acquiring, and end the streams of the clients."""
+        self._stopping.set()
+        with self._condition:
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def stats(self):
+        """Get the acquisition cycles, errors and connected stream clients."""
+        return {"rate": self.rate, "format": self.fmt, "cycles": self.cycles, "errors": self.errors, "clients": self.clients}
+
+    def _loop(self):
+        sequences = {}
+        deadline = time.monotonic()
+        while not self._stopping.is_set():
+            try:
+                records = [(camera, self.acquire(camera, sequences.get(camera))) for camera in self.cameras]
+                stats = self.statistics.compute([record.frame for _, record in records])
+                snapshots = {}
+                for i, (camera, record) in enumerate(records):
+                    header = self.statistics.header(stats, i)
+                    if self.history is not None:
+                        self.history.add(camera, record.timestamp, record.position, header)
+                    payload = encode_frame(
+                        record.frame,
+                        camera,
+                        record.position,
+                        record.timestamp,
+                        record.sequence,
+                        header,
+                        self.fmt,
+                    )
+                    if isinstance(payload, str):
+                        payload = payload.encode("utf-8")
+                    etag = f"{self._epoch}-{camera}-{record.sequence}"
+                    snapshots[camera] = Snapshot(camera, etag, payload, record.sequence, record.timestamp, record.position)
+                    sequences[camera] = record.sequence
+            except Exception as e:
+                self.errors += 1
+                if self.errors == 1 or self.errors % self.LOG_EVERY == 0:
+                    logging.error(f"Frame server acquisition error ({self.errors} so far): {e}")
+                self._stopping.wait(1 / self.rate)
+                continue
+            with self._condition:
+                self._snapshots.update(snapshots)
+                self._version += 1
+                self.cycles += 1
+                self._condition.notify_all()
+            # A late cycle skips its missed slots instead of bursting
+            deadline = max(deadline + 1 / self.rate, time.monotonic())
+            self._stopping.wait(deadline - time.monotonic())
+
+    def latest(self, camera):
+        """Get the latest snapshot of a camera.
+
+        Parameters
+        ----------
+        camera : str
+            Name of the camera.
+
+        Returns
+        -------
+        snapshot : Snapshot
+            Latest encoded frame, None if no frame was acquired yet.
+        """
+        if camera not in self.cameras:
+            raise KeyError(camera)
+        with self._condition:
+            return self._snapshots.get(camera)
+
+    def wait(self, camera, etag=None, timeout=None):
+        """Wait for a snapshot of a camera other than the one with an entity tag.
+
+        Parameters
+        ----------
+        camera : str
+            Name of the camera.
+        etag : str, optional
+            Entity tag of the snapshot the client has.
+        timeout : float, optional
+            Maximum time to wait in seconds.
+
+        Returns
+        -------
+        snapshot : Snapshot
+            New snapshot, or the current one on timeout, None if there is
+            none.
+        """
+        if camera not in self.cameras:
+            raise KeyError(camera)
+
+        def changed():
+            snapshot = self._snapshots.get(camera)
+            return self._stopping.is_set() or (snapshot is not None and snapshot.etag != etag)
+
+        with self._condition:
+            self._condition.wait_for(changed, timeout)
+            return self._snapshots.get(camera)
+
+    def updates(self, cameras=None, timeout=None):
+        """Iterate over the new snapshots of cameras as they are acquired.
+
+        A client slower than the acquisition gets the latest snapshot of
+        each camera and misses the older ones, it never makes the server
+        buffer frames.
+
+        Parameters
+        ----------
+        cameras : list of str, optional
+            Names of the cameras, all by default.
+        timeout : float, optional
+            The iteration ends when no snapshot comes for ``timeout``
+            seconds, and when the server stops.
+
+        Yields
+        ------
+        snapshot : Snapshot
+            New snapshot of one of the cameras.
+        """
+        cameras = self.cameras if cameras is None else list(cameras)
+        unknown = set(cameras) - set(self.cameras)
+        if unknown:
+            raise KeyError(", ".join(sorted(unknown)))
+        return self._updates(cameras, timeout)
+
+    def _updates(self, cameras, timeout):
+        seen = {}
+        version = None
+        with self._condition:
+            self.clients += 1
+        try:
+            while True:
+                with self._condition:
+                    if not self._condition.wait_for(
+                        lambda: self._stopping.is_set() or self._version != version, timeout
+                    ):
+                        return
+                    if self._stopping.is_set():
+                        return
+                    version = self._version
+                    snapshots = [self._snapshots[camera] for camera in cameras if camera in self._snapshots]
+                for snapshot in snapshots:
+                    if seen.get(snapshot.camera) != snapshot.etag:
+                        seen[snapshot.camera] = snapshot.etag
+                        yield snapshot
+        finally:
+            with self._condition:
+                self.clients -= 1
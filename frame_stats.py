@@ -0,0 +1,201 @@
+"""Statistics of the frames of all the cameras, computed in one vectorized pass."""
+
+import threading
+import numpy as np
+
+# Percentiles of the frame message headers, see frame_format
+HEADER_PERCENTILES = (5, 95)
+
+
+class FrameStatistics:
+    """Statistics of a batch of frames, one frame per camera.
+
+    The frames are stacked into a preallocated ``(cameras, pixels)`` array
+    and all the statistics are computed along the pixels at once. The
+    percentiles and the extrema come from a single in-place
+    ``np.partition`` of a preallocated copy of the frames, with the linear
+    interpolation of ``np.percentile``.
+
+    Parameters
+    ----------
+    cameras : int
+        Maximum number of frames of a batch.
+    pixels : int
+        Number of pixels of a frame.
+    percentiles : sequence of float
+        Percentiles of the records, the header percentiles are always
+        computed.
+    mean, std : bool
+        Whether to compute the mean and the standard deviation.
+    bins : int
+        Number of bins of the temperature histogram, 0 for no histogram.
+    histogram_range : tuple of float
+        Temperatures in Celsius of the edges of the first and last bins,
+        pixels outside are not counted.
+    hotspot : bool
+        Whether to locate the hottest pixel.
+    columns : int
+        Number of columns of the frames, to locate the hotspot.
+    """
+
+    def __init__(
+        self,
+        cameras=4,
+        pixels=24 * 32,
+        percentiles=HEADER_PERCENTILES,
+        mean=True,
+        std=True,
+        bins=0,
+        histogram_range=(0.0, 100.0),
+        hotspot=True,
+        columns=32,
+    ):
+        if any(not 0 <= p <= 100 for p in percentiles):
+            raise ValueError("The percentiles must be between 0 and 100")
+        if bins < 0 or histogram_range[1] <= histogram_range[0]:
+            raise ValueError("The histogram must have a positive number of bins and an increasing range")
+        self.percentiles = tuple(sorted(set(percentiles) | set(HEADER_PERCENTILES)))
+        self.requested = tuple(percentiles)
+        self.mean = mean
+        self.std = std
+        self.bins = bins
+        self.histogram_range = tuple(histogram_range)
+        self.hotspot = hotspot
+        self.columns = columns
+        self.frames = np.empty((cameras, pixels), dtype=np.float32)
+        self._work = np.empty_like(self.frames)
+        # Ranks around each percentile and of the extrema, partitioned at once
+        ranks = np.array(self.percentiles) / 100 * (pixels - 1)
+        self._low = np.floor(ranks).astype(np.intp)
+        self._high = np.ceil(ranks).astype(np.intp)
+        self._fraction = (ranks - self._low).astype(np.float32)
+        self._kth = np.unique(np.concatenate(([0, pixels - 1], self._low, self._high)))
+        self._lock = threading.Lock()
+
+    def config(self):
+        """Get the configuration of the statistics."""
+        return {
+            "percentiles": list(self.requested),
+            "mean": self.mean,
+            "std": self.std,
+            "bins": self.bins,
+            "histogram_range": list(self.histogram_range),
+            "hotspot": self.hotspot,
+        }
+
+    def compute(self, frames):
+        """Compute the statistics of a batch of frames.
+
+        Parameters
+        ----------
+        frames : sequence of numpy.ndarray
+            One frame per camera, at most ``cameras``.
+
+        Returns
+        -------
+        stats : dict
+            Arrays with one entry per frame: ``min``, ``max``,
+            ``percentiles`` (frames by percentiles, in the order of the
+            ``percentiles`` attribute), and as configured ``mean``, ``std``,
+            ``histogram`` (frames by bins) and ``hotspot`` (flat pixel index
+            of the maximum).
+        """
+        n = len(frames)
+        if n > len(self.frames):
+            raise ValueError(f"At most {len(self.frames)} frames per batch")
+        with self._lock:
+            stacked = self.frames[:n]
+            for row, frame in zip(stacked, frames):
+                row[:] = frame
+            work = self._work[:n]
+            work[:] = stacked
+            work.partition(self._kth, axis=1)
+            low, high = work[:, self._low], work[:, self._high]
+            stats = {
+                "min": work[:, 0].copy(),
+                "max": work[:, -1].copy(),
+                "percentiles": low + (high - low) * self._fraction,
+            }
+            if self.mean:
+                stats["mean"] = stacked.mean(axis=1)
+            if self.std:
+                stats["std"] = stacked.std(axis=1)
+            if self.hotspot:
+                stats["hotspot"] = stacked.argmax(axis=1)
+            if self.bins:
+                stats["histogram"] = self._histogram(stacked)
+            return stats
+
+    def _histogram(self, stacked):
+        low, high = self.histogram_range
+        index = np.floor((stacked - low) * (self.bins / (high - low))).astype(np.intp)
+        # The last edge belongs to the last bin, as with np.histogram
+        index[stacked == high] = self.bins - 1
+        inside = (index >= 0) & (index < self.bins)
+        index += np.arange(len(stacked))[:, None] * self.bins
+        counts = np.bincount(index[inside], minlength=len(stacked) * self.bins)
+        return counts.reshape(len(stacked), self.bins)
+
+    def header(self, stats, row):
+        """Get the statistics of a frame message header.
+
+        Parameters
+        ----------
+        stats : dict
+            Statistics returned by ``compute``.
+        row : int
+            Index of the frame in the batch.
+
+        Returns
+        -------
+        header : dict
+            ``min_temperature``, ``max_temperature``,
+            ``percentile05_temperature`` and ``percentile95_temperature``,
+            see ``frame_format.encode_frame``.
+        """
+        low, high = (self.percentiles.index(p) for p in HEADER_PERCENTILES)
+        return {
+            "min_temperature": float(stats["min"][row]),
+            "max_temperature": float(stats["max"][row]),
+            "percentile05_temperature": float(stats["percentiles"][row, low]),
+            "percentile95_temperature": float(stats["percentiles"][row, high]),
+        }
+
+    def record(self, stats, cameras, timestamp, positions):
+        """Get the compact record of the statistics of an acquisition cycle.
+
+        Parameters
+        ----------
+        stats : dict
+            Statistics returned by ``compute``.
+        cameras : list of str
+            Names of the cameras of the frames.
+        timestamp : float
+            Acquisition time of the cycle in seconds since the epoch.
+        positions : list of float
+            Motor position of each frame.
+
+        Returns
+        -------
+        record : dict
+            JSON serializable record, with one list per statistic holding a
+            value per camera, temperatures rounded to 0.01 K.
+        """
+        columns = [self.percentiles.index(p) for p in self.requested]
+        record = {
+            "timestamp": timestamp,
+            "cameras": list(cameras),
+            "position": [float(p) for p in positions],
+            "min": np.round(stats["min"], 2).tolist(),
+            "max": np.round(stats["max"], 2).tolist(),
+            "percentiles": {str(p): np.round(stats["percentiles"][:, c], 2).tolist() for p, c in zip(self.requested, columns)},
+        }
+        for name in ("mean", "std"):
+            if name in stats:
+                record[name] = np.round(stats[name], 2).tolist()
+        if "hotspot" in stats:
+            rows, hot_columns = np.divmod(stats["hotspot"], self.columns)
+            record["hotspot"] = {"row": rows.tolist(), "column": hot_columns.tolist()}
+        if "histogram" in stats:
+            record["histogram"] = {"range": list(self.histogram_range), "counts": stats["histogram"].tolist()}
+        return record
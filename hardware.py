@@ -0,0 +1,187 @@
+"""Hardware backends of the thermal camera system.
+
+A backend gives access to the I2C bus of the cameras, to the motor driver
+and to the GPIO of the home switch. The backend is chosen by name, or by the
+``THERMALCAMERA_BACKEND`` environment variable:
+
+- ``pi``: the rig, on a Raspberry Pi (default);
+- ``simulated``: simulated cameras, motor and switch, running as fast as
+  possible with the moves on a virtual clock;
+- ``simulated-realtime``: the same hardware at the speed of the rig.
+"""
+
+import os
+import time
+
+from simulation import (
+    SimulatedClock,
+    SimulatedGPIO,
+    SimulatedHomeSwitch,
+    SimulatedI2C,
+    SimulatedMLX90640,
+    SimulatedMotorKit,
+    SimulatedRoom,
+    SimulatedStepper,
+)
+
+BACKEND_VARIABLE = "THERMALCAMERA_BACKEND"
+SWITCH_PIN = 23
+
+
+class PiBackend:
+    """Hardware of the rig, the Raspberry Pi libraries are imported on creation.
+
+    Attributes
+    ----------
+    gpio : module
+        ``RPi.GPIO``.
+    """
+
+    def __init__(self):
+        import board
+        import busio
+        import RPi.GPIO
+        from adafruit_motorkit import MotorKit
+
+        self._board = board
+        self._busio = busio
+        self._motor_kit = MotorKit
+        self.gpio = RPi.GPIO
+
+    def camera_bus(self):
+        """Create the I2C bus of a camera."""
+        return self._busio.I2C(self._board.SCL, self._board.SDA, frequency=int(1e6))
+
+    def motor_kit(self):
+        """Create the motor driver."""
+        return self._motor_kit(i2c=self._board.I2C(), steppers_microsteps=10)
+
+    @staticmethod
+    def clock():
+        """Monotonic clock of the moves in seconds."""
+        return time.monotonic()
+
+    @staticmethod
+    def sleep(duration):
+        """Sleep between the steps of a move."""
+        time.sleep(duration)
+
+
+class SimulatedBackend:
+    """Simulated cameras, stepper motor and home switch.
+
+    The cameras look at a ``SimulatedRoom`` from the angle of the motor plus
+    their yaw, so the frames follow the motor.
+
+    Parameters
+    ----------
+    addresses : list of int
+        I2C addresses of the cameras.
+    yaws : list of float
+        Yaw of each camera in degrees at motor angle 0.
+    angle : float
+        Initial angle of the motor in degrees, the home switch is at 0.
+    realtime : bool
+        If True, the cameras deliver frames at their refresh rate, the bus
+        runs at 1 MHz and the moves take real time. Otherwise everything runs
+        as fast as possible, the moves on a virtual clock.
+    room : SimulatedRoom, optional
+        Scene around the rig.
+    seed : int
+        Seed of the random generators.
+
+    Attributes
+    ----------
+    stepper : simulation.SimulatedStepper
+        Motor, its ``angle`` is the true angle.
+    switch : simulation.SimulatedHomeSwitch
+        Home switch.
+    cameras : dict
+        ``SimulatedMLX90640`` at each address.
+    gpio : simulation.SimulatedGPIO
+        GPIO of the home switch.
+    """
+
+    def __init__(self, addresses=(0x30, 0x31, 0x32, 0x33), yaws=None, angle=0.0, realtime=False, room=None, seed=0):
+        self.realtime = realtime
+        self._clock = None if realtime else SimulatedClock()
+        self.room = SimulatedRoom() if room is None else room
+        self.switch = SimulatedHomeSwitch(angle=angle, clock=self.clock, seed=seed)
+        self.stepper = SimulatedStepper(angle=angle, switch=self.switch, step_time=0.001 if realtime else 0.0)
+        yaws = [90.0 * i for i in range(len(addresses))] if yaws is None else yaws
+        self.cameras = {
+            address: SimulatedMLX90640(
+                scene=self._scene(yaw), realtime=realtime, seed=None if seed is None else seed + i
+            )
+            for i, (address, yaw) in enumerate(zip(addresses, yaws))
+        }
+        self._bus = SimulatedI2C(self.cameras, frequency=1e6 if realtime else None)
+        self.gpio = SimulatedGPIO({SWITCH_PIN: self.switch})
+
+    def _scene(self, yaw):
+        return lambda: self.room.view(self._angle() + yaw)
+
+    def _angle(self):
+        return self.stepper.angle
+
+    def follow(self, angle):
+        """Make the cameras look from another motor angle.
+
+        Parameters
+        ----------
+        angle : callable
+            Function returning the motor angle in degrees, e.g. the position
+            shared by the process moving the motor with the acquisition
+            process.
+        """
+        self._angle = angle
+
+    def camera_bus(self):
+        """Get the I2C bus of the cameras, shared by all of them."""
+        return self._bus
+
+    def motor_kit(self):
+        """Create the motor driver."""
+        return SimulatedMotorKit(self.stepper)
+
+    def clock(self):
+        """Clock of the moves in seconds, virtual unless in real time."""
+        return time.monotonic() if self._clock is None else self._clock.monotonic()
+
+    def sleep(self, duration):
+        """Sleep between the steps of a move, virtual unless in real time."""
+        if self._clock is None:
+            time.sleep(duration)
+        else:
+            self._clock.sleep(duration)
+
+
+BACKENDS = {
+    "pi": PiBackend,
+    "simulated": SimulatedBackend,
+    "simulated-realtime": lambda: SimulatedBackend(realtime=True),
+}
+
+
+def create_backend(backend=None):
+    """Create a hardware backend.
+
+    Parameters
+    ----------
+    backend : str or object, optional
+        Name of the backend, one of ``BACKENDS``, or a backend object which is
+        returned as is. By default, the ``THERMALCAMERA_BACKEND`` environment
+        variable or ``pi``.
+
+    Returns
+    -------
+    backend : object
+        Hardware backend.
+    """
+    if backend is None:
+        backend = os.environ.get(BACKEND_VARIABLE, "pi")
+    if not isinstance(backend, str):
+        return backend
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend}, must be one of {list(BACKENDS)}")
+    return BACKENDS[backend]()
@@ -0,0 +1,152 @@
+"""Homing of the stepper motor on the home switch."""
+
+import time
+import logging
+from collections import namedtuple
+
+from motion import execute, plan_move
+
+HomingReport = namedtuple("HomingReport", ["found", "fast_steps", "backoff_steps", "slow_steps", "duration"])
+
+
+class EdgeSwitch:
+    """Home switch read through the GPIO edge detection.
+
+    The rising edges are latched by the GPIO driver, so a press is not missed
+    between two reads. If edge detection is not available, the switch is
+    polled instead.
+
+    Parameters
+    ----------
+    gpio : module
+        ``RPi.GPIO`` or a compatible module, with the pin already set up.
+    pin : int
+        GPIO pin of the switch.
+    """
+
+    def __init__(self, gpio, pin):
+        self.gpio = gpio
+        self.pin = pin
+        try:
+            gpio.add_event_detect(pin, gpio.RISING)
+            self.edge_detection = True
+        except (RuntimeError, AttributeError) as e:
+            logging.warning(f"No edge detection on pin {pin}, polling the switch: {e}")
+            self.edge_detection = False
+
+    def pressed(self):
+        """Get the current state of the switch."""
+        return self.gpio.input(self.pin) == self.gpio.HIGH
+
+    def reset(self):
+        """Forget the edges detected so far."""
+        if self.edge_detection:
+            self.gpio.event_detected(self.pin)
+
+    def triggered(self):
+        """Check whether the switch was pressed since the last call or reset."""
+        if self.edge_detection:
+            return self.gpio.event_detected(self.pin)
+        return self.pressed()
+
+    def close(self):
+        """Stop the edge detection, so a new switch of the pin can start it again."""
+        if self.edge_detection:
+            self.gpio.remove_event_detect(self.pin)
+            self.edge_detection = False
+
+
+def home(
+    approach,
+    retreat,
+    switch,
+    max_steps,
+    fast_rate,
+    slow_rate,
+    backoff_steps,
+    start_rate=None,
+    acceleration=None,
+    clock=time.monotonic,
+    sleep=time.sleep,
+    cancelled=None,
+):
+    """Find the home switch with a fast and a slow approach.
+
+    The fast approach ramps up to ``fast_rate`` and stops on the first edge
+    of the switch, overshooting it by the switch latency. The motor then
+    backs off until the switch is released plus ``backoff_steps``, and
+    approaches again at ``slow_rate``, so the position fix does not depend on
+    the fast speed.
+
+    Parameters
+    ----------
+    approach, retreat : callable
+        Functions taking one step towards and away from the switch.
+    switch : EdgeSwitch
+        Home switch, or an object with the same ``pressed``, ``reset`` and
+        ``triggered`` methods.
+    max_steps : int
+        Maximum number of steps of the fast approach.
+    fast_rate, slow_rate : float
+        Speed of the fast and of the slow approach in steps per second.
+    backoff_steps : int
+        Steps backed off after the switch is released, larger than the
+        overshoot of the fast approach.
+    start_rate, acceleration : float, optional
+        Speed ramp of the fast approach and of the back-off, see
+        ``motion.step_schedule``.
+    clock, sleep : callable
+        Clock and sleep functions, see ``motion.execute``.
+    cancelled : callable, optional
+        Function returning True when the homing must be interrupted.
+
+    Returns
+    -------
+    report : HomingReport
+        Whether the switch was found, the steps of each phase and the duration
+        in seconds. The motor is home when ``found`` is True.
+    """
+    start = clock()
+    ramp = {"start_rate": start_rate, "acceleration": acceleration}
+
+    def aborted():
+        return cancelled is not None and cancelled()
+
+    def move(steps, step, rate, until, **profile):
+        """Move until a condition is met, returning the steps and whether it was."""
+        met = []
+
+        def check():
+            if aborted():
+                return True
+            met.append(until())
+            return met[-1]
+
+        plan = plan_move(steps, 1, rate, **profile)
+        report = execute(plan, step, check, clock, sleep)
+        return report.steps, bool(met and met[-1]) and not aborted()
+
+    def released():
+        return not switch.pressed()
+
+    # Leave the switch first if the motor is already on it
+    backoff = 0
+    if switch.pressed():
+        backoff, _ = move(4 * backoff_steps, retreat, fast_rate, released, **ramp)
+    switch.reset()
+    fast, found = move(max_steps, approach, fast_rate, switch.triggered, **ramp)
+    if aborted():
+        logging.warning("Homing cancelled.")
+        return HomingReport(False, fast, backoff, 0, clock() - start)
+    if not found:
+        logging.warning(f"Home switch not found within {max_steps} steps.")
+        return HomingReport(False, fast, backoff, 0, clock() - start)
+    # Back off until released, then by backoff_steps
+    steps, found = move(4 * backoff_steps, retreat, fast_rate, released, **ramp)
+    if not found:
+        logging.warning("Home switch not released while backing off.")
+        return HomingReport(False, fast, backoff + steps, 0, clock() - start)
+    backoff += steps + move(backoff_steps, retreat, fast_rate, lambda: False, **ramp)[0]
+    switch.reset()
+    slow, found = move(4 * backoff_steps, approach, slow_rate, switch.triggered)
+    return HomingReport(found, fast, backoff, slow, clock() - start)
@@ -0,0 +1,165 @@
+"""Motion planning of the stepper motor: step schedules and their execution."""
+
+import time
+from collections import namedtuple
+import numpy as np
+
+PROFILES = ("constant", "trapezoidal", "s-curve")
+
+MotionPlan = namedtuple("MotionPlan", ["steps", "direction", "deadlines", "planned_time"])
+MoveReport = namedtuple("MoveReport", ["steps", "planned_time", "actual_time", "max_lateness"])
+
+
+def shortest_path(current, target, wrap=False):
+    """Get the signed rotation from a position to another.
+
+    Parameters
+    ----------
+    current, target : float
+        Positions in degrees.
+    wrap : bool
+        If True, the positions are taken modulo 360 degrees and the shorter
+        way around the circle is chosen, ties going forward.
+
+    Returns
+    -------
+    angle : float
+        Rotation in degrees, positive forward.
+    """
+    angle = target - current
+    if wrap:
+        angle = (angle + 180) % 360 - 180
+        if angle == -180:
+            angle = 180.0
+    return angle
+
+
+def step_schedule(steps, max_rate, start_rate=None, acceleration=None, profile="trapezoidal"):
+    """Compute the time of each step and the end of a move.
+
+    The speed ramps up from ``start_rate`` to ``max_rate`` and down again
+    symmetrically, so short moves may never reach ``max_rate``. The
+    ``s-curve`` profile covers the same ramp distance with a smoothstep speed
+    ramp, so the acceleration starts and ends at zero, peaking at 1.5 times
+    ``acceleration``.
+
+    Parameters
+    ----------
+    steps : int
+        Number of steps of the move.
+    max_rate : float
+        Maximum speed in steps per second.
+    start_rate : float, optional
+        Speed at the start and at the end of the move, by default
+        ``max_rate``.
+    acceleration : float, optional
+        Acceleration in steps per second squared, required unless the profile
+        is ``constant`` or ``start_rate`` equals ``max_rate``.
+    profile : str
+        Speed profile, one of ``PROFILES``.
+
+    Returns
+    -------
+    times : numpy.ndarray
+        ``steps + 1`` times in seconds since the start of the move: when each
+        step must be taken, the first one at 0, and when the move ends, one
+        step period after the last step.
+    """
+    if profile not in PROFILES:
+        raise ValueError(f"Profile must be one of {PROFILES}")
+    start_rate = max_rate if start_rate is None or profile == "constant" else min(start_rate, max_rate)
+    if steps <= 0:
+        return np.zeros((1,))
+    if start_rate <= 0:
+        raise ValueError("Step rates must be positive")
+    distance = np.arange(steps, dtype=float)
+    if start_rate == max_rate:
+        rates = np.full((steps,), float(max_rate))
+    else:
+        if not acceleration or acceleration <= 0:
+            raise ValueError("A positive acceleration is required to change speed")
+        # Distance covered by each ramp, capped at half of the move
+        ramp = min((max_rate**2 - start_rate**2) / (2 * acceleration), steps / 2)
+        # Distance to the nearest end of the move, mid-step
+        edge = np.minimum(distance + 0.5, steps - distance - 0.5)
+        if profile == "trapezoidal":
+            rates = np.sqrt(start_rate**2 + 2 * acceleration * np.minimum(edge, ramp))
+        else:
+            full_ramp = (max_rate**2 - start_rate**2) / (2 * acceleration)
+            x = np.minimum(edge, ramp) / full_ramp
+            rates = start_rate + (max_rate - start_rate) * x * x * (3 - 2 * x)
+    # Each step waits for the period of the previous one
+    times = np.empty((steps + 1,))
+    times[0] = 0
+    np.cumsum(1 / rates, out=times[1:])
+    return times
+
+
+def plan_move(angle, step_angle, max_rate, start_rate=None, acceleration=None, profile="trapezoidal"):
+    """Plan a rotation.
+
+    Parameters
+    ----------
+    angle : float
+        Rotation in degrees, positive forward.
+    step_angle : float
+        Rotation of a step in degrees.
+    max_rate, start_rate, acceleration, profile
+        Speed profile, see ``step_schedule``.
+
+    Returns
+    -------
+    plan : MotionPlan
+        Number of steps, direction (``"fw"`` or ``"bw"``), deadline of each
+        step and planned duration of the move in seconds.
+    """
+    steps = int(round(abs(angle) / step_angle))
+    times = step_schedule(steps, max_rate, start_rate, acceleration, profile)
+    return MotionPlan(steps, "fw" if angle >= 0 else "bw", times[:-1], float(times[-1]))
+
+
+def execute(plan, step, until=None, clock=time.monotonic, sleep=time.sleep):
+    """Take the steps of a plan at their deadlines.
+
+    The deadlines are absolute, so the time taken by a step (the I2C
+    transfers to the motor driver) does not delay the following ones unless
+    it exceeds the step period.
+
+    Parameters
+    ----------
+    plan : MotionPlan
+        Plan of the move.
+    step : callable
+        Function taking one step, called without arguments.
+    until : callable, optional
+        Function called at each deadline before stepping, and at the end of
+        the move, the move stops as soon as it returns True. Checking at the
+        deadline leaves a step period for the effect of the previous step.
+    clock : callable
+        Monotonic clock in seconds.
+    sleep : callable
+        Function sleeping for a duration in seconds.
+
+    Returns
+    -------
+    report : MoveReport
+        Number of steps taken, planned and actual duration of the move in seconds,
+        and maximum delay of a step after its deadline.
+    """
+    start = clock()
+    max_lateness = 0.0
+    steps = 0
+    # The end of the move leaves the period of the last step to the motor
+    for deadline in plan.deadlines.tolist() + [plan.planned_time]:
+        remaining = start + deadline - clock()
+        if remaining > 0:
+            sleep(remaining)
+            remaining = start + deadline - clock()
+        if until is not None and until():
+            break
+        if steps == plan.steps:
+            break
+        max_lateness = max(max_lateness, -remaining)
+        step()
+        steps += 1
+    return MoveReport(steps, plan.planned_time, clock() - start, max_lateness)
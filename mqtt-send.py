@@ -1,33 +1,35 @@
 import time
-import struct
-import numpy as np
-import matplotlib.pyplot as plt
-import board
-import busio
-import adafruit_mlx90640
+import argparse
 
 import paho.mqtt.client as mqtt
 
+from frame_format import encode_bundle
+from publisher import MQTTPublisher
 from thermalcamera import ThermalCamera
 
-# MQTT
-broker = "192.168.0.45"
-brokerport = 1883
+parser = argparse.ArgumentParser()
+parser.add_argument("--broker", type=str, default="192.168.0.45", help="MQTT broker address")
+parser.add_argument("--brokerport", type=int, default=1883, help="MQTT broker port")
+parser.add_argument("--bundle", action="store_true", help="Publish the raw frames of a cycle as one message")
+args = parser.parse_args()
 
 thermal_camera = ThermalCamera()
 
+# One connection for all the frames, reconnected by the publisher
+publisher = MQTTPublisher(mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, "thermalcam"))
+publisher.connect(args.broker, args.brokerport)
+
 while True:
-    for i, camera in enumerate(thermal_camera.mlx_dict):
+    frames = []
+    for i, camera in enumerate(thermal_camera.frame_rings):
         try:
-            b_array = thermal_camera.get_frame_as_bytes(camera)
-            mqqttclient = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1,"thermalcam")
-            mqqttclient.connect(broker, brokerport)
-            camera_name = camera.replace("-", "")
-            address = thermal_camera.addresses[i]
-            ret = mqqttclient.publish(f"/thermalcamera/{camera_name}/image/{address}", b_array)
-            # print(f"/thermalcamera/{camera_name}/image/{address}")
-            # print(ret)
-            # print("Done")
-            time.sleep(0.1)
+            frames.append((camera, thermal_camera.get_frame_as_bytes(camera), thermal_camera.addresses[i]))
         except ValueError:
             continue
+    if args.bundle:
+        publisher.publish("/thermalcamera/frames/raw", encode_bundle([(camera, data) for camera, data, _ in frames]))
+    else:
+        for camera, data, address in frames:
+            camera_name = camera.replace("-", "")
+            publisher.publish(f"/thermalcamera/{camera_name}/image/{address}", data)
+    time.sleep(0.1)
@@ -1,13 +1,23 @@
 import time
-import struct
 import json
-import base64
 import logging
+import functools
 import threading
+import contextlib
 import paho.mqtt.client as mqtt
-import numpy as np
 
+from alarms import AlarmEngine
+from archive import FrameArchiveWriter
+from change_detection import ChangeDetector
+from commands import CommandExecutor
+from frame_format import FORMATS, encode_bundle, encode_frame, encode_panorama_region
+from frame_stats import FrameStatistics
+from pipeline import Pipeline, StageTimer
+from publisher import MQTTPublisher
+from stitching import PanoramaStitcher
+from streaming import StreamScheduler
 from thermalcamera import ThermalCamera
+from timeseries import StatisticsStore, rows_to_dict
 
 logging.basicConfig(
     level=logging.INFO,
@@ -21,9 +31,37 @@ class ThermalCameraAPI:
     TOPIC_CMD = "/thermalcamera/cmd/#"
     TOPIC_ROOT = "/thermalcamera"
     TOPIC_STATE = "/thermalcamera/state"
-
-    def __init__(self):
+    TOPIC_PANORAMA = "/thermalcamera/panorama"
+    TOPIC_RESULT = "/thermalcamera/result"
+    TOPIC_STATS = "/thermalcamera/stats"
+    TOPIC_ALARM = "/thermalcamera/alarm"
+    TOPIC_LAYOUT = "/thermalcamera/layout"
+    TOPIC_BUNDLE = "/thermalcamera/frames"
+    TOPIC_HISTORY = "/thermalcamera/history"
+    ARCHIVE_DIRECTORY = "archive"
+    HISTORY_DIRECTORY = "history"
+    # Commands on the same resource run one at a time, the others run concurrently
+    COMMAND_RESOURCES = {
+        "rotate": "motor",
+        "go_to": "motor",
+        "calibrate": "motor",
+        "set_absolute_position": "motor",
+        "export_absolute_position": "motor",
+        "import_absolute_position": "motor",
+        "init": "motor",
+        "release": "motor",
+        "run": "motor",
+        "get_frame": "camera",
+        "get_frames": "camera",
+    }
+    DEFAULT_RESOURCE = "control"
+
+    def __init__(self, backend=None, acquisition="thread"):
         self.thermal_camera = None
+        # Hardware backend of the thermal camera, see hardware.create_backend
+        self.backend = backend
+        # Acquisition of the frames, see ThermalCamera.ACQUISITIONS
+        self.acquisition = acquisition
         self.command_handlers = {
             "get_frame": self.get_frame,
             "get_switch_state": self.get_switch_state,
@@ -38,17 +76,73 @@ class ThermalCameraAPI:
             "release": self.release,
             "run": self.run,
             "stop": self.stop,
+            "set_format": self.set_format,
+            "get_panorama": self.get_panorama,
+            "reset_panorama": self.reset_panorama,
+            "set_stream": self.set_stream,
+            "set_filter": self.set_filter,
+            "set_change_detection": self.set_change_detection,
+            "set_statistics": self.set_statistics,
+            "set_alarms": self.set_alarms,
+            "set_publisher": self.set_publisher,
+            "get_history": self.get_history,
         }
         self.running = False
         self.monitoring = False
         self.streaming = False
         self.run_thread = None
+        # Correlation id of the run command of the scan
+        self.run_id = None
         self.monitor_thread = None
-        self.stream_thread = None
+        self.stream_scheduler = None
+        # Unchanged frames are not streamed once a threshold is set
+        self.change_detector = ChangeDetector()
+        # Statistics of the frames, one record per acquisition cycle
+        self.statistics = FrameStatistics()
+        # Alarm rules evaluated on every frame, published on TOPIC_ALARM
+        self.alarms = AlarmEngine()
         self.client = None
-
-        # Temporary code for creating a dataset for stitching
-        self.stitching_data = {}
+        # Format of the published frames, negotiated with set_format
+        self.frame_format = "json"
+        # Whether the frames of an acquisition cycle are published as one bundle on TOPIC_BUNDLE
+        self.bundle = False
+        self.stitcher = PanoramaStitcher()
+        # Archive of the frames acquired during a run
+        self.archive_writer = None
+        # Rolled up statistics of every frame, opened by init
+        self.history = None
+        # Timing of the stages of the last run
+        self.scan_timer = None
+        # Commands run off the MQTT thread, moves are interrupted by cancel
+        self.executor = None
+        self.motion_interrupt = threading.Event()
+        # Readers of the frame rings of the camera, which init waits for
+        self._readers = 0
+        self._replacing = False
+        self._camera_condition = threading.Condition()
+
+    @contextlib.contextmanager
+    def _reading(self):
+        """Read the frames of the camera, not while init replaces it."""
+        with self._camera_condition:
+            self._camera_condition.wait_for(lambda: not self._replacing)
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._camera_condition:
+                self._readers -= 1
+                self._camera_condition.notify_all()
+
+    def _read_record(self, camera, **kwargs):
+        """Get a filtered frame record, see ``ThermalCamera.get_filtered_record``.
+
+        The frame is copied out of the frame ring, which init may free once
+        the record is returned.
+        """
+        with self._reading():
+            record = self.thermal_camera.get_filtered_record(camera, **kwargs)
+            return record._replace(frame=record.frame.copy())
 
     def publish_state(self, client):
         try:
@@ -58,7 +152,27 @@ class ThermalCameraAPI:
                     "position": self.thermal_camera.absolute_position,
                     "switch_state": self.thermal_camera.get_switch_state(),
                     "streaming": int(self.streaming),
+                    "stream": self.stream_scheduler.stats() if self.stream_scheduler is not None else None,
+                    "change_detection": {**self.change_detector.config(), **self.change_detector.stats()},
+                    "statistics": self.statistics.config(),
+                    "alarms": [{"rule": rule, "camera": camera} for rule, camera in self.alarms.active()],
+                    "format": self.frame_format,
+                    "bundle": self.bundle,
+                    "frame_cache": self.thermal_camera.frame_cache.stats(),
+                    "filter": next(iter(self.thermal_camera.frame_filters.values())).config(),
                 }
+                last_move = self.thermal_camera.last_move
+                if last_move is not None:
+                    state["last_move"] = last_move._asdict()
+                last_homing = self.thermal_camera.last_homing
+                if last_homing is not None:
+                    state["last_homing"] = last_homing._asdict()
+                if self.scan_timer is not None:
+                    state["scan_timing"] = self.scan_timer.summary()
+                if self.executor is not None:
+                    state["commands"] = self.executor.metrics()
+                if isinstance(client, MQTTPublisher):
+                    state["publisher"] = client.stats()
                 client.publish(self.TOPIC_STATE, json.dumps(state), retain=True)
         except Exception as e:
             logging.error(f"Error when publishing the state: {e}")
@@ -72,13 +186,14 @@ class ThermalCameraAPI:
 
         def on_message(client, userdata, msg):
             if msg.topic.startswith(self.TOPIC_CMD.replace("#", "")):
+                command = msg.topic.split("/")[-1]
                 try:
-                    command = msg.topic.split("/")[-1]
                     payload = json.loads(msg.payload)
                     logging.info(f"Received command {command} with payload {payload}")
-                    self.command_handlers[command](client, payload)
+                    # Only queued here: the commands run on the executor threads
+                    self.submit_command(client, command, payload)
                 except Exception as e:
-                    logging.error(f"Error when executing command {command}: {e}")
+                    logging.error(f"Error when submitting command {command}: {e}")
             elif msg.topic.startswith(self.TOPIC_STATE):
                 pass
 
@@ -88,11 +203,81 @@ class ThermalCameraAPI:
             logging.info(f"Disconnected with result code {rc}")
 
         client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, "thermalcam")
-        client.on_connect = on_connect
         client.on_message = on_message
-        client.on_disconnect = on_disconnect
-        client.connect(broker, brokerport)
-        return client
+        # One connection for all the messages, kept up by the publisher,
+        # which does not drop the replies to the commands like the frames
+        publisher = MQTTPublisher(client, keep=(self.TOPIC_RESULT, self.TOPIC_HISTORY))
+        publisher.on_connect = on_connect
+        publisher.on_disconnect = on_disconnect
+        self.start_executor(publisher)
+        publisher.connect(broker, brokerport)
+        self.client = publisher
+        return publisher
+
+    def start_executor(self, client):
+        """Create the executor of the commands, publishing their results and the alarms."""
+
+        def publish_result(result):
+            client.publish(self.TOPIC_RESULT, json.dumps(result))
+
+        def publish_alarm(event):
+            client.publish(self.TOPIC_ALARM, json.dumps(event), qos=1)
+
+        self.executor = CommandExecutor(publish_result, {"motor": self.motion_interrupt})
+        self.alarms.publish = publish_alarm
+
+    def submit_command(self, client, command, payload):
+        """Queue a command, or cancel one right away.
+
+        The optional ``id`` of the payload is the correlation id of the
+        results published on ``TOPIC_RESULT``. The scan moves the motor
+        outside of the executor: the other motor commands fail while it runs.
+        """
+        job_id = payload.get("id")
+        if command == "cancel":
+            self.cancel(client, payload)
+        elif command not in self.command_handlers:
+            logging.error(f"Unknown command {command}")
+            client.publish(
+                self.TOPIC_RESULT,
+                json.dumps({"id": job_id, "command": command, "status": "error", "error": "unknown command"}),
+            )
+        else:
+            handler = functools.partial(self.command_handlers[command], client)
+            resource = self.COMMAND_RESOURCES.get(command, self.DEFAULT_RESOURCE)
+            if resource == "motor" and command != "run":
+                handler = functools.partial(self._unless_running, command, handler)
+            job_id = self.executor.submit(command, resource, handler, payload, job_id)
+            if command == "run":
+                self.run_id = job_id
+
+    def _unless_running(self, command, handler, payload):
+        # Checked when executed, a command queued behind a run also fails
+        self._wait_scan(command)
+        handler(payload)
+
+    def _wait_scan(self, command):
+        """Refuse a command during a scan, after waiting for a stopped scan to finish."""
+        run_thread = self.run_thread
+        if not self.running and run_thread is not None:
+            # A cancelled or stopped scan still finishes its last position
+            run_thread.join(timeout=5.0)
+        if self.running or (run_thread is not None and run_thread.is_alive()):
+            logging.error(f"Cannot execute {command} during a scan, stop or cancel it first.")
+            raise ValueError
+
+    def cancel(self, client, payload):
+        spec = {
+            "target": {"type": str, "default": None, "optional": True},
+        }
+        params = self.extract_params(payload, spec)
+        if self.running and params["target"] in (None, self.run_id):
+            # The run command returned when the scan started
+            self.running = False
+            self.motion_interrupt.set()
+            return
+        if not self.executor.cancel(params["target"]):
+            logging.warning(f"No command to cancel {params['target'] or 'on the motor'}.")
 
     def extract_params(self, payload, param_specs):
         result = {}
@@ -121,6 +306,7 @@ class ThermalCameraAPI:
         spec = {
             "angle": {"type": float},
             "direction": {"type": str, "default": "fw", "optional": True},
+            "profile": {"type": str, "default": None, "optional": True},
         }
         params = self.extract_params(payload, spec)
         self.thermal_camera.rotate(**params)
@@ -128,6 +314,8 @@ class ThermalCameraAPI:
     def go_to(self, client, payload):
         spec = {
             "position": {"type": float},
+            "wrap": {"type": bool, "default": False, "optional": True},
+            "profile": {"type": str, "default": None, "optional": True},
         }
         params = self.extract_params(payload, spec)
         # self.stop_monitor_stream_threads()
@@ -161,102 +349,252 @@ class ThermalCameraAPI:
     def get_frame(self, client, payload):
         spec = {
             "camera": {"type": str},
+            "format": {"type": str, "default": None, "optional": True},
+            "settle": {"type": bool, "default": True, "optional": True},
         }
         params = self.extract_params(payload, spec)
         camera = params["camera"]
-
-        enc_image = base64.b64encode(self.thermal_camera.get_frame_as_bytes(camera)).decode("utf-8")
-        result = {
-            "image": enc_image,
-            "position": self.thermal_camera.absolute_position,
-        }
-
-        # Temporary code for creating a dataset for stitching
-        position = result["position"]
-        image = base64.b64decode(result["image"])
-        image = [struct.unpack("f", image[i : i + 4])[0] for i in range(0, len(image), 4)]
-        image = np.flip(np.rot90(np.array(image).reshape(24, 32)), axis=0).tolist()
-        if position not in self.stitching_data:
-            self.stitching_data[position] = {}
-        if camera not in self.stitching_data[position]:
-            self.stitching_data[position][camera] = []
-        self.stitching_data[position][camera].append(image)
-
-        min_temp = float(np.min(image))
-        max_temp = float(np.max(image))
-        low_temp = float(np.percentile(image,5))
-        high_temp = float(np.percentile(image,95))
-        result["min_temperature"] = min_temp
-        result["max_temperature"] = max_temp
-        result["percentile05_temperature"] = low_temp
-        result["percentile95_temperature"] = high_temp
-
-        client.publish(f"{self.TOPIC_ROOT}/{camera}", json.dumps(result))
+        fmt = params["format"] or self.frame_format
+
+        # With a filter, one clean frame is published instead of several noisy ones
+        record = self._read_record(camera, settle=params["settle"])
+        client.publish(f"{self.TOPIC_ROOT}/{camera}", self._frame_message(camera, record, fmt))
+
+    def _frame_message(self, camera, record, fmt, changes=None, stats=None):
+        """Stitch, archive and record the statistics of a frame, and encode its message.
+
+        With a ``ChangeDetector``, None is returned for an unchanged frame,
+        and the message may be a delta frame. The header statistics are
+        computed unless given.
+        """
+        frame = record.frame
+        position = record.position
+        self.stitcher.add_frame(camera, frame, position)
+        archive_writer = self.archive_writer
+        if archive_writer is not None:
+            archive_writer.append(camera, frame, record.timestamp, position, record.sequence)
+        self.alarms.evaluate(camera, frame, position, record.timestamp)
+
+        if stats is None:
+            stats = self.statistics.header(self.statistics.compute([frame]), 0)
+        history = self.history
+        if history is not None:
+            history.add(camera, record.timestamp, position, stats)
+        if changes is not None:
+            return changes.encode(camera, record, stats, fmt)
+        return encode_frame(frame, camera, position, record.timestamp, record.sequence, stats, fmt)
+
+    def _cycle_messages(self, records, fmt):
+        """Encode the frames of an acquisition cycle and the record of their statistics.
+
+        Parameters
+        ----------
+        records : list of tuple
+            ``(camera, record)`` of each frame.
+        fmt : str
+            Format of the frame messages.
+
+        Returns
+        -------
+        messages : list of tuple
+            ``(topic, payload)`` of the frames, or of their bundle, then of
+            the statistics.
+        """
+        statistics = self.statistics
+        # All the statistics of all the cameras in one pass
+        stats = statistics.compute([record.frame for _, record in records])
+        messages = [
+            (f"{self.TOPIC_ROOT}/{camera}", self._frame_message(camera, record, fmt, stats=statistics.header(stats, i)))
+            for i, (camera, record) in enumerate(records)
+        ]
+        if self.bundle:
+            payloads = [(camera, payload) for (camera, _), (_, payload) in zip(records, messages)]
+            messages = [(self.TOPIC_BUNDLE, encode_bundle(payloads))]
+        cycle = statistics.record(
+            stats,
+            [camera for camera, _ in records],
+            max(record.timestamp for _, record in records),
+            [record.position for _, record in records],
+        )
+        messages.append((self.TOPIC_STATS, json.dumps(cycle)))
+        return messages
 
     def get_frames(self, client, payload):
-        for camera in self.thermal_camera.mlx_dict:
-            self.get_frame(client, {"camera": camera})
+        spec = {
+            "format": {"type": str, "default": None, "optional": True},
+            "settle": {"type": bool, "default": True, "optional": True},
+        }
+        params = self.extract_params(payload, spec)
+        fmt = params["format"] or self.frame_format
+        records = [
+            (camera, self._read_record(camera, settle=params["settle"])) for camera in self.thermal_camera.frame_rings
+        ]
+        for topic, message in self._cycle_messages(records, fmt):
+            client.publish(topic, message)
+
+    def set_format(self, client, payload):
+        spec = {
+            "format": {"type": str},
+        }
+        params = self.extract_params(payload, spec)
+        if params["format"] not in FORMATS:
+            logging.error(f"Frame format must be one of {list(FORMATS)}.")
+            raise ValueError
+        self.frame_format = params["format"]
+        self.publish_state(client)
+
+    def publish_panorama(self, client, full=False):
+        """Publish the regions of the panorama updated since the last call."""
+        for topic, message in self._panorama_messages(full):
+            client.publish(topic, message)
+
+    def _panorama_messages(self, full=False):
+        """Encode the messages of the regions of the panorama updated since the last call."""
+        if full:
+            regions = [(0, 0, self.stitcher.panorama())]
+        else:
+            regions = self.stitcher.changed_regions()
+        return [
+            (
+                self.TOPIC_PANORAMA,
+                encode_panorama_region(self.stitcher.shape, row, column, panorama, self.stitcher.resolution),
+            )
+            for row, column, panorama in regions
+        ]
+
+    def get_panorama(self, client, payload):
+        self.publish_panorama(client, full=True)
+
+    def reset_panorama(self, client, payload):
+        self.stitcher.reset()
 
     def init(self, client, payload):
         spec = {
             "absolute_position": {"type": float, "default": None, "optional": True},
+            "backend": {"type": str, "default": None, "optional": True},
+            "acquisition": {"type": str, "default": None, "optional": True},
         }
         params = self.extract_params(payload, spec)
-        self.thermal_camera = ThermalCamera(**params)
+        params["backend"] = params["backend"] or self.backend
+        params["acquisition"] = params["acquisition"] or self.acquisition
+        # The scan reads the frame rings of the camera
+        self._wait_scan("init")
+        if self.stream_scheduler is not None:
+            self.stream_scheduler.pause()
+        with self._camera_condition:
+            # The frame rings of the previous camera are freed once no one reads them
+            self._replacing = True
+            self._camera_condition.wait_for(lambda: self._readers == 0)
+        try:
+            if self.thermal_camera is not None:
+                # Stops the acquisition process of the previous camera
+                self.thermal_camera.close()
+                self.thermal_camera = None
+            self.thermal_camera = ThermalCamera(cancel_event=self.motion_interrupt, **params)
+        finally:
+            with self._camera_condition:
+                self._replacing = False
+                self._camera_condition.notify_all()
+        if self.history is None:
+            self.history = StatisticsStore(self.HISTORY_DIRECTORY)
+        self.publish_layouts(client)
+        if self.stream_scheduler is not None:
+            self.stream_scheduler.cameras = list(self.thermal_camera.frame_rings)
+            if not self.running:
+                self.stream_scheduler.resume()
+
+    def publish_layouts(self, client):
+        """Publish the orientation of the images of each camera, retained for the subscribers."""
+        for camera, pipeline in self.thermal_camera.pixel_pipelines.items():
+            client.publish(f"{self.TOPIC_LAYOUT}/{camera}", json.dumps(pipeline.layout()), retain=True)
 
     def release(self, client, payload):
         self.thermal_camera.release()
 
     def _run(self, client, payload):
+        """Scan loop, pipelined in three threads.
+
+        The motor moves to the next position and the frames are acquired
+        while the frames of the previous position are processed (stitching,
+        archiving, statistics and encoding) and published.
+        """
         spec = {
             "offset": {"type": float, "default": 0, "optional": True},
             "step": {"type": float, "default": 5, "optional": True},
             "wait": {"type": float, "default": 0.1, "optional": True},
             "direction": {"type": str, "default": "fw", "optional": True},
             "continuous": {"type": bool, "default": True, "optional": True},
+            "archive": {"type": bool, "default": True, "optional": True},
         }
         params = self.extract_params(payload, spec)
         offset = params["offset"]
         step = params["step"]
         wait = params["wait"]
-        direction = params["direction"]
         continuous = params["continuous"]
-        print(offset)
-        self.thermal_camera.go_to(offset)
-        while True:
-            if self.running is False:
-                logging.info("Stopping the run loop")
-                # Temporary code for creating a dataset for stitching
-                if self.stitching_data is not None:
-                    with open("stitching_data.json", "w") as f:
-                        json.dump(self.stitching_data, f)
-                break
-            print("Pos ", self.thermal_camera.absolute_position)
-            if self.thermal_camera.absolute_position > 360 and direction == "fw" :
-                direction = "bw"
-            if self.thermal_camera.absolute_position < 0 and direction == "bw" :
-                direction = "fw"
-#           if ( ((380 - self.thermal_camera.absolute_position) < 20) or (
- #              (-20 - self.thermal_camera.absolute_position) > -20
-#           ):  # ! Partially verified
-#           print("cond1 ", 380 - self.thermal_camera.absolute_position) 
-#           print("cond2 ", -20 - self.thermal_camera.absolute_position) 
-#               if continuous is False:
-#                   logging.info("Stopping the run loop")
-#                   self.running = False
-#                   break
-#               logging.info("Switch state reached, inverting direction")
-#               direction = "fw" if direction == "bw" else "bw"
-            print("current direction ", direction)
-            self.thermal_camera.rotate(step, direction=direction)
-            self.get_frames(client, payload)
-            time.sleep(wait)
+        fmt = payload.get("format") or self.frame_format
+        if params["archive"]:
+            self.archive_writer = FrameArchiveWriter(self.ARCHIVE_DIRECTORY)
+        timer = StageTimer()
+        self.scan_timer = timer
+
+        def scan():
+            direction = params["direction"]
+            logging.info(f"Scan starting at {offset}")
+            self.thermal_camera.go_to(offset)
+            while self.running:
+                if self.thermal_camera.absolute_position > 360 and direction == "fw":
+                    direction = "bw"
+                if self.thermal_camera.absolute_position < 0 and direction == "bw":
+                    direction = "fw"
+                logging.debug(f"Scan at {self.thermal_camera.absolute_position} going {direction}")
+                with timer.measure("motion"):
+                    self.thermal_camera.rotate(step, direction=direction)
+                with timer.measure("acquisition"):
+                    # Frames acquired after the move
+                    records = [
+                        (camera, self.thermal_camera.get_filtered_record(camera, settle=True, max_age=0))
+                        for camera in self.thermal_camera.frame_rings
+                    ]
+                yield records
+                time.sleep(wait)
+
+        def process(records):
+            messages = self._cycle_messages(records, fmt)
+            if self.archive_writer is not None:
+                self.archive_writer.flush()
+            return messages + self._panorama_messages()
+
+        def publish(messages):
+            for topic, message in messages:
+                client.publish(topic, message)
+
+        # The queues hold at most two positions, far less than the frame rings
+        pipeline = Pipeline(scan, [("processing", process), ("publishing", publish)], maxsize=2, name="scan", timer=timer)
+        pipeline.start()
+        pipeline.join()
+        # Set by a cancel after the last move
+        self.motion_interrupt.clear()
+        logging.info("Stopping the run loop")
+        logging.info(f"Scan stage timing: {timer.summary()}")
+        self.publish_panorama(client)
+        self.stitcher.save("panorama.npz")
+        archive_writer = self.archive_writer
+        if archive_writer is not None:
+            # Not while a get_frame of the camera worker appends
+            with archive_writer.lock:
+                self.archive_writer = None
+                archive_writer.close()
+        if self.stream_scheduler is not None and self.streaming:
+            self.stream_scheduler.resume()
 
     def run(self, client, payload):
         try:
             if self.running:
                 self.stop(client, payload)
             self.running = True
+            # The scan publishes the frames itself
+            if self.stream_scheduler is not None:
+                self.stream_scheduler.pause()
             self.run_thread = threading.Thread(target=self._run, args=(client, payload))
             self.run_thread.daemon = True
             self.run_thread.start()
@@ -284,22 +622,138 @@ class ThermalCameraAPI:
         self.monitor_thread.daemon = True
         self.monitor_thread.start()
 
-    def _send_images_loop(self, client):
-        while self.streaming:
-            try:
-                if self.running:
-                    continue
-                else:
-                    self.get_frames(client, {})
-            except Exception:
-                pass
-
-    def send_images(self, client):
+    def send_images(self, client, rate=1.0, max_inflight=8):
+        """Stream the frames of the cameras, paused during runs and before init."""
         self.streaming = True
         logging.info("Start images streaming loop in a separate thread")
-        self.stream_thread = threading.Thread(target=self._send_images_loop, args=(client,))
-        self.stream_thread.daemon = True
-        self.stream_thread.start()
+
+        streamed = {}
+
+        def acquire(camera):
+            # Each frame is streamed once, even if read for another consumer
+            record = self._read_record(camera, newer_than=streamed.get(camera))
+            streamed[camera] = record.sequence
+            return record
+
+        def publish(camera, record):
+            message = self._frame_message(camera, record, self.frame_format, self.change_detector)
+            if message is None:
+                return False
+            return client.publish(f"{self.TOPIC_ROOT}/{camera}", message)
+
+        cameras = list(self.thermal_camera.frame_rings) if self.thermal_camera is not None else []
+        self.stream_scheduler = StreamScheduler(cameras, acquire, publish, rate, max_inflight)
+        self.stream_scheduler.start()
+        if self.thermal_camera is None or self.running:
+            self.stream_scheduler.pause()
+
+    def set_stream(self, client, payload):
+        spec = {
+            "rate": {"type": float, "default": None, "optional": True},
+            "max_inflight": {"type": int, "default": None, "optional": True},
+        }
+        params = self.extract_params(payload, spec)
+        if self.stream_scheduler is None:
+            logging.error("Streaming is not started.")
+            raise ValueError
+        self.stream_scheduler.configure(**params)
+        self.publish_state(client)
+
+    def set_filter(self, client, payload):
+        spec = {
+            "mode": {"type": str, "default": None, "optional": True},
+            "length": {"type": int, "default": None, "optional": True},
+            "alpha": {"type": float, "default": None, "optional": True},
+        }
+        params = self.extract_params(payload, spec)
+        self.thermal_camera.configure_filter(**params)
+        self.publish_state(client)
+
+    def set_change_detection(self, client, payload):
+        spec = {
+            "threshold": {"type": float, "default": None, "optional": True},
+            "delta": {"type": bool, "default": None, "optional": True},
+            "keyframe_interval": {"type": float, "default": None, "optional": True},
+            "step": {"type": float, "default": None, "optional": True},
+        }
+        params = self.extract_params(payload, spec)
+        config = self.change_detector.config()
+        config.update({k: v for k, v in params.items() if v is not None})
+        # The next streamed frame of each camera is a keyframe
+        self.change_detector = ChangeDetector(**config)
+        self.publish_state(client)
+
+    def set_publisher(self, client, payload):
+        spec = {
+            "bundle": {"type": bool, "default": None, "optional": True},
+            "window": {"type": int, "default": None, "optional": True},
+            "buffer": {"type": int, "default": None, "optional": True},
+        }
+        params = self.extract_params(payload, spec)
+        if params["window"] is not None or params["buffer"] is not None:
+            if not isinstance(client, MQTTPublisher):
+                logging.error("The window and buffer need the publisher of connect_mqtt.")
+                raise ValueError
+            client.configure(params["window"], params["buffer"])
+        if params["bundle"] is not None:
+            self.bundle = params["bundle"]
+        self.publish_state(client)
+
+    def get_history(self, client, payload):
+        """Publish the recorded statistics of a time range on TOPIC_HISTORY.
+
+        ``start`` and ``stop`` are in seconds since the epoch, or relative to
+        now if negative, e.g. ``{"start": -604800, "summary": true}`` for the
+        extrema of each camera over the last week, see
+        ``StatisticsStore.query`` and ``StatisticsStore.summary``.
+        """
+        spec = {
+            "camera": {"type": str, "default": None, "optional": True},
+            "start": {"type": float, "default": None, "optional": True},
+            "stop": {"type": float, "default": None, "optional": True},
+            "resolution": {"type": float, "default": None, "optional": True},
+            "positions": {"type": bool, "default": False, "optional": True},
+            "summary": {"type": bool, "default": False, "optional": True},
+        }
+        params = self.extract_params(payload, spec)
+        if self.history is None:
+            logging.error("No statistics recorded, init first.")
+            raise ValueError
+        if params["summary"]:
+            resolution, rows = self.history.summary(params["camera"], params["start"], params["stop"], params["positions"])
+        else:
+            resolution, rows = self.history.query(
+                params["camera"], params["start"], params["stop"], params["resolution"], params["positions"]
+            )
+        result = {"id": payload.get("id"), "resolution": resolution, **rows_to_dict(rows)}
+        client.publish(self.TOPIC_HISTORY, json.dumps(result))
+
+    def set_statistics(self, client, payload):
+        spec = {
+            "percentiles": {"type": list, "default": None, "optional": True},
+            "mean": {"type": bool, "default": None, "optional": True},
+            "std": {"type": bool, "default": None, "optional": True},
+            "bins": {"type": int, "default": None, "optional": True},
+            "histogram_range": {"type": list, "default": None, "optional": True},
+            "hotspot": {"type": bool, "default": None, "optional": True},
+        }
+        params = self.extract_params(payload, spec)
+        config = self.statistics.config()
+        config.update({k: v for k, v in params.items() if v is not None})
+        cameras = len(self.thermal_camera.frame_rings) if self.thermal_camera is not None else len(self.statistics.frames)
+        self.statistics = FrameStatistics(cameras, **config)
+        self.publish_state(client)
+
+    def set_alarms(self, client, payload):
+        spec = {
+            "rules": {"type": list},
+        }
+        params = self.extract_params(payload, spec)
+        if params.get("rules") is None:
+            logging.error("The alarm rules must be a list.")
+            raise ValueError
+        self.alarms.configure(params["rules"])
+        self.publish_state(client)
 
     def stop_threads(self):
         self.monitoring = False
@@ -307,8 +761,10 @@ class ThermalCameraAPI:
         self.running = False
         if self.monitor_thread and self.monitor_thread.is_alive():
             self.monitor_thread.join(timeout=5.0)
-        if self.stream_thread and self.stream_thread.is_alive():
-            self.stream_thread.join(timeout=5.0)
+        if self.stream_scheduler is not None:
+            self.stream_scheduler.stop()
+        if self.executor is not None:
+            self.executor.stop()
         if self.run_thread and self.run_thread.is_alive():
             self.run_thread.join(timeout=5.0)
         logging.info("Threads stopped")
@@ -318,8 +774,8 @@ class ThermalCameraAPI:
         self.streaming = False
         if self.monitor_thread and self.monitor_thread.is_alive():
             self.monitor_thread.join(timeout=5.0)
-        if self.stream_thread and self.stream_thread.is_alive():
-            self.stream_thread.join(timeout=5.0)
+        if self.stream_scheduler is not None:
+            self.stream_scheduler.stop()
         logging.info("Monitoring and streaming threads stopped")
 
     def start_monitor_stream_threads(self):
@@ -336,15 +792,24 @@ if __name__ == "__main__":
     parser.add_argument("--broker", type=str, default="192.168.0.45", help="MQTT broker address")
     parser.add_argument("--brokerport", type=int, default=1883, help="MQTT broker port")
     parser.add_argument("--loglevel", "-log", type=str, default="WARNING", help="Logging level")
+    parser.add_argument("--backend", type=str, default=None, help="Hardware backend: pi, simulated or simulated-realtime")
+    parser.add_argument("--acquisition", type=str, default="thread", help="Frame acquisition: thread or process")
+    parser.add_argument("--bundle", action="store_true", help="Publish the frames of a cycle as one message")
     args = parser.parse_args()
 
     logging.getLogger().setLevel(args.loglevel)
 
-    api = ThermalCameraAPI()
+    api = ThermalCameraAPI(backend=args.backend, acquisition=args.acquisition)
+    api.bundle = args.bundle
+    # Connected and reconnected in the network thread of the client
     client = api.connect_mqtt(args.broker, args.brokerport)
 
     def signal_handler(sig, frame):
         api.stop_threads()
+        if api.thermal_camera is not None:
+            api.thermal_camera.close()
+        if api.history is not None:
+            api.history.close()
         client.disconnect()
         sys.exit(0)
 
@@ -352,7 +817,6 @@ if __name__ == "__main__":
     signal.signal(signal.SIGTERM, signal_handler)
 
     try:
-        client.loop_start()
         api.monitor_state(client)
         api.send_images(client)
         while True:
@@ -0,0 +1,187 @@
+"""Pipeline of stages running in their own threads, connected by bounded queues."""
+
+import time
+import queue
+import logging
+import threading
+from contextlib import contextmanager
+
+_END = object()
+
+
+class StageTimer:
+    """Accumulated durations of the stages of a pipeline.
+
+    Each stage accumulates its ``busy`` time, spent processing items, its
+    ``starved`` time, spent waiting for the previous stage, and its
+    ``blocked`` time, spent waiting for the next stage to accept an item. The
+    stage with the largest busy time per item sets the rate of the pipeline.
+    """
+
+    KINDS = ("busy", "starved", "blocked")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def add(self, stage, duration, kind="busy", items=0):
+        """Add a duration to a stage.
+
+        Parameters
+        ----------
+        stage : str
+            Name of the stage.
+        duration : float
+            Duration in seconds.
+        kind : str
+            One of ``KINDS``.
+        items : int
+            Number of items the duration accounts for.
+        """
+        with self._lock:
+            stats = self._stats.setdefault(stage, dict.fromkeys(("items",) + self.KINDS, 0))
+            stats[kind] += duration
+            stats["items"] += items
+
+    @contextmanager
+    def measure(self, stage, kind="busy", items=1):
+        """Measure the duration of a block, see ``add``."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start, kind, items)
+
+    def summary(self):
+        """Get the timing of each stage.
+
+        Returns
+        -------
+        summary : dict
+            Number of items and mean busy, starved and blocked time per item
+            in milliseconds of each stage, in order of first measurement.
+        """
+        with self._lock:
+            return {
+                stage: {
+                    "items": stats["items"],
+                    **{f"{kind}_ms": 1e3 * stats[kind] / max(stats["items"], 1) for kind in self.KINDS},
+                }
+                for stage, stats in self._stats.items()
+            }
+
+
+class Pipeline:
+    """Pipeline of a source and of processing stages.
+
+    The source and each stage run in their own thread. Queues of ``maxsize``
+    items between them bound the number of items in flight, so a slow stage
+    slows down the source instead of accumulating items.
+
+    Parameters
+    ----------
+    source : callable
+        Function returning an iterator over the items, running in the first
+        thread until exhausted or until the pipeline is stopped.
+    stages : list of tuple
+        ``(name, function)`` of each stage, ``function`` taking an item and
+        returning the item passed to the next stage, or None to drop it.
+    maxsize : int
+        Size of the queues between the stages.
+    name : str
+        Name of the source stage and prefix of the threads.
+    timer : StageTimer, optional
+        Timer of the stages, created if not given.
+    """
+
+    def __init__(self, source, stages, maxsize=2, name="source", timer=None):
+        self.source = source
+        self.stages = list(stages)
+        self.name = name
+        self.timer = StageTimer() if timer is None else timer
+        self._queues = [queue.Queue(maxsize) for _ in self.stages]
+        self._stopping = threading.Event()
+        self._failed = threading.Event()
+        self._threads = []
+
+    def start(self):
+        """Start the threads of the pipeline."""
+        outputs = self._queues + [None]
+        self._threads = [threading.Thread(target=self._run_source, args=(outputs[0],), name=self.name, daemon=True)]
+        for (name, function), inputs, output in zip(self.stages, self._queues, outputs[1:]):
+            thread = threading.Thread(
+                target=self._run_stage, args=(name, function, inputs, output), name=f"{self.name}-{name}", daemon=True
+            )
+            self._threads.append(thread)
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        """Ask the source to stop, the items in flight are still processed."""
+        self._stopping.set()
+
+    def join(self, timeout=None):
+        """Wait for all the stages to finish.
+
+        Returns
+        -------
+        finished : bool
+            Whether all the stages finished within the timeout.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(None if deadline is None else max(0, deadline - time.monotonic()))
+        return not any(thread.is_alive() for thread in self._threads)
+
+    def is_alive(self):
+        """Check whether a stage is still running."""
+        return any(thread.is_alive() for thread in self._threads)
+
+    def _put(self, stage, output, item):
+        """Pass an item to the next stage, unless a stage failed."""
+        if output is None:
+            return
+        with self.timer.measure(stage, "blocked", items=0):
+            while True:
+                try:
+                    output.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    # A failed stage does not drain its queue anymore
+                    if self._failed.is_set():
+                        return
+
+    def _run_source(self, output):
+        try:
+            items = iter(self.source())
+            while not self._stopping.is_set():
+                start = time.perf_counter()
+                item = next(items, _END)
+                if item is _END:
+                    break
+                self.timer.add(self.name, time.perf_counter() - start, items=1)
+                self._put(self.name, output, item)
+        except Exception as e:
+            logging.error(f"Error in the pipeline stage {self.name}: {e}")
+            self._failed.set()
+        finally:
+            self._stopping.set()
+            self._put(self.name, output, _END)
+
+    def _run_stage(self, name, function, inputs, output):
+        try:
+            while True:
+                with self.timer.measure(name, "starved", items=0):
+                    item = inputs.get()
+                if item is _END:
+                    break
+                with self.timer.measure(name):
+                    item = function(item)
+                if item is not None:
+                    self._put(name, output, item)
+        except Exception as e:
+            logging.error(f"Error in the pipeline stage {name}: {e}")
+            self._failed.set()
+            self._stopping.set()
+        finally:
+            self._put(name, output, _END)
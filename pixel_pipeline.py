@@ -0,0 +1,170 @@
+"""Per-camera pixel corrections and orientation, configured from a calibration file.
+
+The calibration file is a JSON object with an entry per camera, all the
+fields being optional::
+
+    {
+        "camera0": {
+            "rotations": 1,
+            "flip_axis": 0,
+            "crop": [0, 32, 2, 22],
+            "bad_pixels": [17, 402],
+            "gain": [1.0, ...],
+            "offset": [0.0, ...]
+        }
+    }
+
+- ``rotations`` and ``flip_axis``: orientation of the image, as
+  ``np.flip(np.rot90(frame.reshape(24, 32), rotations), flip_axis)``, the
+  mounting of the rig by default (``flip_axis`` null for no flip);
+- ``crop``: ``[first_row, last_row, first_column, last_column]`` of the
+  oriented image, exclusive ends;
+- ``bad_pixels``: raw indices of the dead pixels, replaced by the mean of
+  their valid neighbours;
+- ``gain`` and ``offset``: flat-field correction of the 768 raw pixels,
+  ``gain * frame + offset``.
+
+The pixels marked bad by the driver (-273.15) or failed (NaN) are left as
+they are, and are not used to replace the dead pixels.
+"""
+
+import os
+import json
+import numpy as np
+
+SHAPE = (24, 32)
+# The driver marks its bad pixels with -273.15
+INVALID = -273
+
+
+class PixelPipeline:
+    """Precomputed pixel corrections and orientation of a camera.
+
+    The corrections, applied in place on the raw frames when they are
+    acquired, are a gain and offset per valid pixel followed by the
+    replacement of the bad pixels, as preloaded arrays. The orientation and the crop are
+    combined into one gather index, applied on demand by ``orient``.
+
+    Parameters
+    ----------
+    rotations : int
+        Number of quarter turns of ``np.rot90``.
+    flip_axis : int, optional
+        Axis of ``np.flip`` after the rotation, None for no flip.
+    crop : sequence of int, optional
+        Rows and columns kept of the oriented image.
+    bad_pixels : sequence of int
+        Raw indices of the bad pixels.
+    gain, offset : array_like, optional
+        Flat-field correction of each raw pixel.
+    shape : tuple of int
+        Rows and columns of the raw frames.
+
+    Attributes
+    ----------
+    index : numpy.ndarray
+        Raw pixel index of each pixel of the oriented and cropped image.
+    """
+
+    def __init__(self, rotations=1, flip_axis=0, crop=None, bad_pixels=(), gain=None, offset=None, shape=SHAPE):
+        pixels = shape[0] * shape[1]
+        index = np.rot90(np.arange(pixels).reshape(shape), rotations)
+        if flip_axis is not None:
+            index = np.flip(index, flip_axis)
+        if crop is not None:
+            row0, row1, column0, column1 = crop
+            index = index[row0:row1, column0:column1]
+            if index.size == 0:
+                raise ValueError(f"Empty crop {list(crop)}")
+        self.index = np.ascontiguousarray(index)
+        self.gain = None if gain is None else np.asarray(gain, dtype=np.float32).reshape(pixels)
+        self.offset = None if offset is None else np.asarray(offset, dtype=np.float32).reshape(pixels)
+        self.bad_pixels = np.unique(np.asarray(bad_pixels, dtype=np.intp))
+        # 4-neighbours of each bad pixel, padded with the pixel itself, never valid
+        rows, columns = np.divmod(self.bad_pixels, shape[1])
+        neighbours = np.repeat(self.bad_pixels[:, None], 4, axis=1)
+        for k, (dr, dc) in enumerate(((-1, 0), (1, 0), (0, -1), (0, 1))):
+            r, c = rows + dr, columns + dc
+            inside = (r >= 0) & (r < shape[0]) & (c >= 0) & (c < shape[1])
+            neighbours[inside, k] = (r * shape[1] + c)[inside]
+        self._neighbours = neighbours
+
+    @property
+    def image_shape(self):
+        """Rows and columns of the oriented and cropped image."""
+        return self.index.shape
+
+    def correct(self, frame):
+        """Correct a raw frame in place.
+
+        Parameters
+        ----------
+        frame : numpy.ndarray
+            Raw float32 frame, e.g. a slot of a ``FrameRing``.
+
+        Returns
+        -------
+        frame : numpy.ndarray
+            The corrected frame.
+        """
+        valid = np.isfinite(frame)
+        valid &= frame > INVALID
+        valid[self.bad_pixels] = False
+        if self.gain is not None:
+            np.multiply(frame, self.gain, out=frame, where=valid)
+        if self.offset is not None:
+            np.add(frame, self.offset, out=frame, where=valid)
+        if len(self.bad_pixels):
+            usable = valid[self._neighbours]
+            values = np.where(usable, frame[self._neighbours], 0).sum(axis=1)
+            # A pixel without valid neighbours becomes NaN, ignored downstream
+            with np.errstate(invalid="ignore", divide="ignore"):
+                frame[self.bad_pixels] = values / usable.sum(axis=1)
+        return frame
+
+    def orient(self, frame, out=None):
+        """Get the oriented and cropped image of a frame with one gather.
+
+        Parameters
+        ----------
+        frame : numpy.ndarray
+            Raw frame.
+        out : numpy.ndarray, optional
+            Array of shape ``image_shape`` to write the image into.
+
+        Returns
+        -------
+        image : numpy.ndarray
+            Oriented and cropped image.
+        """
+        return np.take(frame, self.index, out=out)
+
+    def layout(self):
+        """Get the orientation of the images, for the subscribers of the raw frames."""
+        return {"shape": list(self.image_shape), "index": self.index.ravel().tolist()}
+
+
+def load_pixel_pipelines(path, cameras):
+    """Create the pixel pipeline of each camera from a calibration file.
+
+    Parameters
+    ----------
+    path : str
+        Path of the JSON calibration file, the cameras get the default
+        orientation and no correction if it does not exist.
+    cameras : list of str
+        Names of the cameras.
+
+    Returns
+    -------
+    pipelines : dict
+        ``PixelPipeline`` of each camera.
+    """
+    calibration = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            calibration = json.load(f)
+    unknown = set(calibration) - set(cameras)
+    if unknown:
+        raise ValueError(f"Unknown cameras {sorted(unknown)} in the pixel calibration {path}")
+    return {camera: PixelPipeline(**calibration.get(camera, {})) for camera in cameras}
@@ -0,0 +1,132 @@
+"""Crash-safe journal of the absolute position of the stepper motor."""
+
+import os
+import time
+import logging
+import threading
+
+
+class PositionJournal:
+    """Append-only journal of the motor position, bounded in size.
+
+    Each line is ``"%Y-%m-%d %H:%M:%S,position"``, the format of the historical
+    ``absolute_position.csv``. During a move, ``record`` only keeps the latest
+    position in memory and appends it at most once every ``interval`` seconds,
+    without syncing; ``sync`` is the durability point, called at the end of a
+    move, on stop and on disconnect. When the file grows over ``max_bytes``,
+    it is atomically replaced by a file holding only the last position.
+
+    Parameters
+    ----------
+    path : str
+        Path of the journal.
+    interval : float
+        Minimum time in seconds between two writes during a move.
+    max_bytes : int
+        Size in bytes above which the journal is compacted.
+    """
+
+    TAIL_BYTES = 4096
+
+    def __init__(self, path, interval=0.5, max_bytes=64 * 1024):
+        self.path = path
+        self.interval = interval
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._position = self.last_position()
+        self._pending = False
+        self._last_write = time.monotonic()
+        self._file = None
+        if self._position is not None and os.path.getsize(path) > max_bytes:
+            self._compact()
+
+    def last_position(self):
+        """Read the last position written to the journal.
+
+        Only the end of the file is read, and a line truncated by a crash is
+        ignored.
+
+        Returns
+        -------
+        position : float or None
+            Last position in degrees, None if the journal is missing or empty.
+        """
+        try:
+            with open(self.path, "rb") as f:
+                f.seek(0, os.SEEK_END)
+                size = f.tell()
+                f.seek(max(0, size - self.TAIL_BYTES))
+                tail = f.read()
+        except FileNotFoundError:
+            return None
+        # The last line is incomplete if the file does not end with a newline
+        lines = tail.split(b"\n")[:-1]
+        for line in reversed(lines):
+            try:
+                return float(line.rsplit(b",", 1)[1])
+            except (IndexError, ValueError):
+                continue
+        return None
+
+    def record(self, position):
+        """Record a new position, written later if the last write is recent.
+
+        Parameters
+        ----------
+        position : float
+            Position in degrees.
+        """
+        with self._lock:
+            self._position = position
+            self._pending = True
+            if time.monotonic() - self._last_write >= self.interval:
+                self._write()
+
+    def sync(self, position=None):
+        """Write the latest position and wait for it to be on disk.
+
+        Parameters
+        ----------
+        position : float, optional
+            Position in degrees, by default the last recorded one.
+        """
+        with self._lock:
+            if position is not None:
+                self._position = position
+                self._pending = True
+            if self._pending:
+                self._write()
+            if self._file is not None:
+                os.fsync(self._file.fileno())
+
+    def close(self):
+        """Sync and close the journal."""
+        self.sync()
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _write(self):
+        """Append the latest position, the lock must be held."""
+        if self._file is None:
+            self._file = open(self.path, "a")
+        self._file.write(f"{time.strftime('%Y-%m-%d %H:%M:%S')},{self._position}\n")
+        self._file.flush()
+        self._pending = False
+        self._last_write = time.monotonic()
+        if self._file.tell() > self.max_bytes:
+            self._compact()
+
+    def _compact(self):
+        """Replace the journal with a file holding only the latest position."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        temporary = f"{self.path}.tmp"
+        with open(temporary, "w") as f:
+            f.write(f"{time.strftime('%Y-%m-%d %H:%M:%S')},{self._position}\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self.path)
+        logging.info(f"Compacted the position journal {self.path}.")
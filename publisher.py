@@ -0,0 +1,269 @@
+"""Shared MQTT publisher with one long-lived connection."""
+
+import logging
+import threading
+from collections import deque
+
+import paho.mqtt.client as mqtt
+
+
+class _Message:
+    """Message accepted by the publisher, sent now or later."""
+
+    __slots__ = ("topic", "payload", "qos", "retain", "droppable", "info", "dropped")
+
+    def __init__(self, topic, payload, qos, retain, droppable):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+        self.droppable = droppable
+        self.info = None
+        self.dropped = False
+
+    def is_published(self):
+        """Whether the message is sent, or dropped, like ``MQTTMessageInfo.is_published``."""
+        return self.dropped or (self.info is not None and self.info.is_published())
+
+
+class MQTTPublisher:
+    """One long-lived MQTT connection shared by all the publishers of the process.
+
+    The client reconnects by itself with an exponential backoff. The
+    messages published while offline, or while ``window`` messages are
+    already in flight, wait in a buffer. Only the QoS 0 messages, not
+    retained and not on the ``keep`` topics, can be dropped: beyond
+    ``buffer`` of them, the oldest ones are, as the latest frames are the
+    most useful. A retained message waiting to be sent is replaced by the
+    next one on its topic, as the broker keeps only the latest. The other
+    messages, e.g. alarms and command results, are kept up to ``kept`` of
+    them, beyond which the oldest ones are dropped with a warning. The
+    buffer is sent in order once connected and as the in-flight messages
+    are sent. A message is in flight until written to the socket for QoS 0
+    and until acknowledged for QoS 1 and 2; the QoS 0 messages in flight
+    when the connection drops are lost.
+
+    It has the ``publish``, ``subscribe``, ``loop_start``, ``loop_stop`` and
+    ``disconnect`` methods of the client, so it can be used in place of it.
+    ``publish`` never blocks and returns an object with the
+    ``is_published`` method of ``MQTTMessageInfo``.
+
+    Parameters
+    ----------
+    client : paho.mqtt.client.Client
+        Client, its ``on_connect``, ``on_disconnect`` and ``on_publish``
+        callbacks are taken over, see the attributes.
+    window : int
+        Maximum number of messages in flight.
+    buffer : int
+        Maximum number of droppable messages waiting to be sent.
+    kept : int
+        Maximum number of the other messages waiting to be sent.
+    min_delay, max_delay : float
+        Minimum and maximum delay in seconds between two connection attempts.
+    keep : tuple of str
+        Prefixes of the topics of the QoS 0 messages never dropped.
+
+    Attributes
+    ----------
+    on_connect, on_disconnect : callable
+        Callbacks of the client, called with the same arguments, e.g. to
+        subscribe again after a reconnection.
+    """
+
+    def __init__(self, client, window=16, buffer=256, min_delay=1, max_delay=60, keep=(), kept=1024):
+        self.client = client
+        self.keep = tuple(keep)
+        self.on_connect = None
+        self.on_disconnect = None
+        self.connected = False
+        self.published = 0
+        self.sent = 0
+        self.dropped = 0
+        self.replaced = 0
+        self.connections = 0
+        self._pending = deque()
+        # Number of droppable messages in _pending
+        self._droppable = 0
+        # Retained message waiting in _pending for each topic
+        self._retained = {}
+        self._inflight = {}
+        # Messages sent before being registered as in flight
+        self._early = set()
+        self._lock = threading.Lock()
+        # A single thread sends at a time, without holding _lock: the client
+        # calls on_publish holding its own locks, which publish needs
+        self._sending = threading.Lock()
+        self._dirty = False
+        self.configure(window, buffer, kept)
+        client.reconnect_delay_set(min_delay, max_delay)
+        client.on_connect = self._on_connect
+        client.on_disconnect = self._on_disconnect
+        client.on_publish = self._on_publish
+
+    def configure(self, window=None, buffer=None, kept=None):
+        """Change the in-flight window or the buffer sizes."""
+        if (window is not None and window < 1) or (buffer is not None and buffer < 0) or (kept is not None and kept < 1):
+            raise ValueError("The window and kept must be positive and the buffer positive or zero")
+        with self._lock:
+            if window is not None:
+                self.window = window
+            if buffer is not None:
+                self.buffer = buffer
+            if kept is not None:
+                self.kept = kept
+            self._trim()
+        self._drain()
+
+    def connect(self, host, port=1883, keepalive=60):
+        """Connect in the network thread of the client, retrying until it succeeds."""
+        self.client.connect_async(host, port, keepalive)
+        self.client.loop_start()
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        """Publish a message, or buffer it while offline or the window is full."""
+        droppable = qos == 0 and not retain and not topic.startswith(self.keep)
+        message = _Message(topic, payload, qos, retain, droppable)
+        with self._lock:
+            self.published += 1
+            if retain:
+                previous = self._retained.get(topic)
+                if previous is not None:
+                    self._pending.remove(previous)
+                    previous.dropped = True
+                    self.replaced += 1
+                self._retained[topic] = message
+            self._pending.append(message)
+            self._droppable += droppable
+            self._trim()
+        self._drain()
+        return message
+
+    def subscribe(self, topic, qos=0):
+        return self.client.subscribe(topic, qos)
+
+    def loop_start(self):
+        return self.client.loop_start()
+
+    def loop_stop(self):
+        return self.client.loop_stop()
+
+    def disconnect(self):
+        return self.client.disconnect()
+
+    def stats(self):
+        """Get the connection state and the message counts.
+
+        Returns
+        -------
+        stats : dict
+            Whether connected, number of connections, messages published,
+            sent, dropped by the full buffer or the connection losses,
+            replaced by a newer retained one, in flight and waiting, of which
+            droppable, and the window and buffer sizes.
+        """
+        with self._lock:
+            return {
+                "connected": self.connected,
+                "connections": self.connections,
+                "published": self.published,
+                "sent": self.sent,
+                "dropped": self.dropped,
+                "replaced": self.replaced,
+                "inflight": len(self._inflight),
+                "pending": len(self._pending),
+                "droppable": self._droppable,
+                "window": self.window,
+                "buffer": self.buffer,
+                "kept": self.kept,
+            }
+
+    def _trim(self):
+        excess = len(self._pending) - self._droppable - self.kept
+        if self._droppable <= self.buffer and excess <= 0:
+            return
+        pending = deque()
+        for message in self._pending:
+            if message.droppable and self._droppable > self.buffer:
+                self._droppable -= 1
+            elif not message.droppable and excess > 0:
+                excess -= 1
+                logging.warning(f"MQTT buffer full, dropping a message of {message.topic}")
+            else:
+                pending.append(message)
+                continue
+            message.dropped = True
+            self.dropped += 1
+            if self._retained.get(message.topic) is message:
+                del self._retained[message.topic]
+        self._pending = pending
+
+    def _drain(self):
+        """Send the waiting messages while connected and the window allows."""
+        while True:
+            # Set before trying, so the thread sending drains again
+            self._dirty = True
+            if not self._sending.acquire(blocking=False):
+                return
+            try:
+                self._dirty = False
+                while True:
+                    with self._lock:
+                        if not (self.connected and self._pending and len(self._inflight) < self.window):
+                            break
+                        message = self._pending.popleft()
+                        self._droppable -= message.droppable
+                        if self._retained.get(message.topic) is message:
+                            del self._retained[message.topic]
+                    info = self.client.publish(message.topic, message.payload, message.qos, message.retain)
+                    with self._lock:
+                        if info.rc == mqtt.MQTT_ERR_NO_CONN:
+                            # Disconnected before the callback, sent after the reconnection
+                            self._pending.appendleft(message)
+                            self._droppable += message.droppable
+                            if message.retain:
+                                self._retained.setdefault(message.topic, message)
+                            self.connected = False
+                            break
+                        message.info = info
+                        if info.mid in self._early:
+                            self._early.discard(info.mid)
+                            self.sent += 1
+                        else:
+                            self._inflight[info.mid] = message
+            finally:
+                self._sending.release()
+            if not self._dirty:
+                return
+
+    def _on_connect(self, client, userdata, flags, rc, *args):
+        if rc == 0:
+            with self._lock:
+                self.connected = True
+                self.connections += 1
+            self._drain()
+        else:
+            logging.error(f"MQTT connection refused with result code {rc}")
+        if self.on_connect is not None:
+            self.on_connect(client, userdata, flags, rc, *args)
+
+    def _on_disconnect(self, client, userdata, *args):
+        with self._lock:
+            self.connected = False
+            # The client sends the QoS 1 and 2 messages again, not the QoS 0 ones
+            for mid, message in list(self._inflight.items()):
+                if message.qos == 0:
+                    del self._inflight[mid]
+                    message.dropped = True
+                    self.dropped += 1
+            self._early.clear()
+        if self.on_disconnect is not None:
+            self.on_disconnect(client, userdata, *args)
+
+    def _on_publish(self, client, userdata, mid, *args):
+        with self._lock:
+            if self._inflight.pop(mid, None) is not None:
+                self.sent += 1
+            else:
+                self._early.add(mid)
+        self._drain()
@@ -0,0 +1,312 @@
+"""Recording and replay of the messages published by the thermal camera system.
+
+A recording is a binary log, little-endian, starting with the magic
+``b"TR"`` and a uint8 format version, followed by entries:
+
+====== ======= =====================================================
+Offset Type    Content
+====== ======= =====================================================
+0      uint8   kind: ``MESSAGE`` or ``TOPIC``
+1      float64 reception time (seconds since the epoch)
+9      uint16  topic number
+11     uint8   QoS in the bits 0-1, retain flag in the bit 2
+12     uint32  length of the data
+16             data: the payload of a message, the UTF-8 name of a topic
+====== ======= =====================================================
+
+A ``TOPIC`` entry gives the name of a topic number before its first message,
+so each message only carries its topic number. The log is only appended to,
+a message lost in a crash can only be the last one: the readers ignore an
+incomplete entry, and a recorder appending to the recording removes it.
+"""
+
+import time
+import struct
+import logging
+import argparse
+import threading
+from collections import deque, namedtuple
+
+MAGIC = b"TR"
+VERSION = 1
+FILE_HEADER = struct.Struct("<2sB")
+ENTRY = struct.Struct("<BdHBI")
+MESSAGE = 0
+TOPIC = 1
+RETAIN = 0x04
+
+RecordedMessage = namedtuple("RecordedMessage", ["timestamp", "topic", "payload", "qos", "retain"])
+
+
+class StreamRecorder:
+    """Recorder appending the received messages to a recording.
+
+    ``on_message`` is the ``on_message`` callback of an MQTT client
+    subscribed to ``topic`` (see ``subscribe``), and only appends to a
+    buffered file.
+
+    Parameters
+    ----------
+    path : str
+        Path of the recording, created or appended to.
+    topic : str
+        Topic filter of the recorded messages.
+    exclude : tuple of str
+        Prefixes of the topics not recorded, the commands by default, so a
+        replay does not move the motor of a running service.
+    """
+
+    def __init__(self, path, topic="/thermalcamera/#", exclude=("/thermalcamera/cmd/",)):
+        self.path = path
+        self.topic = topic
+        self.exclude = tuple(exclude)
+        self.messages = 0
+        self.bytes = 0
+        self._topics = {}
+        self._lock = threading.Lock()
+        self._file = open(path, "ab")
+        if self._file.tell() == 0:
+            self._file.write(FILE_HEADER.pack(MAGIC, VERSION))
+        else:
+            # Topic numbers of the previous recording
+            end = FILE_HEADER.size
+            for kind, _, number, _, data in _entries(path):
+                if kind == TOPIC:
+                    self._topics[data.decode("utf-8")] = number
+                end += ENTRY.size + len(data)
+            # Without the incomplete entry of a crash
+            self._file.truncate(end)
+
+    def subscribe(self, client):
+        """Subscribe an MQTT client to the recorded topics."""
+        client.subscribe(self.topic)
+
+    def on_message(self, client, userdata, msg):
+        self.record(msg.topic, msg.payload, msg.qos, msg.retain)
+
+    def record(self, topic, payload, qos=0, retain=False, timestamp=None):
+        """Append a message to the recording.
+
+        Parameters
+        ----------
+        topic : str
+            Topic of the message.
+        payload : bytes or str
+            Payload of the message.
+        qos : int
+            Quality of service of the message.
+        retain : bool
+            Whether the message is retained.
+        timestamp : float, optional
+            Reception time in seconds since the epoch, now by default.
+        """
+        if topic.startswith(self.exclude):
+            return
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        timestamp = time.time() if timestamp is None else timestamp
+        with self._lock:
+            number = self._topics.get(topic)
+            if number is None:
+                number = self._topics[topic] = len(self._topics)
+                name = topic.encode("utf-8")
+                self._file.write(ENTRY.pack(TOPIC, timestamp, number, 0, len(name)) + name)
+            self._file.write(ENTRY.pack(MESSAGE, timestamp, number, qos | (RETAIN if retain else 0), len(payload)))
+            self._file.write(payload)
+            self.messages += 1
+            self.bytes += len(payload)
+
+    def flush(self):
+        """Write the buffered messages to the file."""
+        with self._lock:
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def _entries(path):
+    """Iterate over the ``(kind, timestamp, topic number, flags, data)`` entries of a recording."""
+    with open(path, "rb") as f:
+        header = f.read(FILE_HEADER.size)
+        if len(header) < FILE_HEADER.size:
+            return
+        magic, version = FILE_HEADER.unpack(header)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a recording of a supported version")
+        while True:
+            entry = f.read(ENTRY.size)
+            if len(entry) < ENTRY.size:
+                return
+            kind, timestamp, number, flags, length = ENTRY.unpack(entry)
+            data = f.read(length)
+            if len(data) < length:
+                return
+            yield kind, timestamp, number, flags, data
+
+
+def read_recording(path):
+    """Read the messages of a recording.
+
+    Parameters
+    ----------
+    path : str
+        Path of the recording.
+
+    Yields
+    ------
+    message : RecordedMessage
+        Message, in the order of reception.
+    """
+    topics = {}
+    for kind, timestamp, number, flags, data in _entries(path):
+        if kind == TOPIC:
+            topics[number] = data.decode("utf-8")
+        else:
+            yield RecordedMessage(timestamp, topics[number], data, flags & 0x03, bool(flags & RETAIN))
+
+
+class StreamReplayer:
+    """Replayer publishing the messages of a recording again.
+
+    The messages are published with their original spacing divided by
+    ``speed``, or one after the other as fast as the client sends them
+    with ``speed=None``. At most ``max_inflight`` messages wait to be sent:
+    the replay slows down to the client instead of queueing the whole
+    recording in memory.
+
+    Parameters
+    ----------
+    path : str
+        Path of the recording.
+    client : paho.mqtt.client.Client
+        Client publishing the messages, or any object with its ``publish``
+        method, e.g. an ``MQTTPublisher`` or a consumer under test.
+    speed : float, optional
+        Replay speed, 1 for real time, None for as fast as possible.
+    max_inflight : int
+        Maximum number of messages waiting to be sent.
+    """
+
+    def __init__(self, path, client, speed=1.0, max_inflight=64):
+        if speed is not None and speed <= 0:
+            raise ValueError("The replay speed must be positive")
+        self.path = path
+        self.client = client
+        self.speed = speed
+        self.max_inflight = max_inflight
+        self._stopping = threading.Event()
+
+    def stop(self):
+        """Stop the replay."""
+        self._stopping.set()
+
+    def run(self, topics=None):
+        """Replay the recording.
+
+        Parameters
+        ----------
+        topics : list of str, optional
+            Prefixes of the replayed topics, all by default.
+
+        Returns
+        -------
+        stats : dict
+            Messages and payload bytes replayed, duration in seconds,
+            sustained messages and megabytes per second, and the 99th
+            percentile and maximum delay in milliseconds of the messages
+            behind their schedule.
+        """
+        self._stopping.clear()
+        inflight = deque()
+        delays = []
+        messages = nbytes = 0
+        first = None
+        start = time.monotonic()
+        for message in read_recording(self.path):
+            if self._stopping.is_set():
+                break
+            if topics is not None and not message.topic.startswith(tuple(topics)):
+                continue
+            if self.speed is not None:
+                if first is None:
+                    first = message.timestamp
+                due = start + (message.timestamp - first) / self.speed
+                delay = due - time.monotonic()
+                if delay > 0:
+                    self._stopping.wait(delay)
+                delays.append(max(0.0, time.monotonic() - due))
+            info = self.client.publish(message.topic, message.payload, message.qos, message.retain)
+            messages += 1
+            nbytes += len(message.payload)
+            if info is not None:
+                inflight.append(info)
+            self._wait(inflight, self.max_inflight - 1)
+        self._wait(inflight, 0)
+        duration = time.monotonic() - start
+        delays.sort()
+        return {
+            "messages": messages,
+            "bytes": nbytes,
+            "duration": duration,
+            "messages_per_s": messages / duration if duration > 0 else 0.0,
+            "mb_per_s": nbytes / duration / 1e6 if duration > 0 else 0.0,
+            "late_p99_ms": 1e3 * delays[int(0.99 * (len(delays) - 1))] if delays else 0.0,
+            "late_max_ms": 1e3 * delays[-1] if delays else 0.0,
+        }
+
+    def _wait(self, inflight, limit):
+        """Wait until at most ``limit`` messages are in flight."""
+        while inflight and not self._stopping.is_set():
+            if inflight[0].is_published():
+                inflight.popleft()
+            elif len(inflight) > limit:
+                time.sleep(0.0005)
+            else:
+                break
+
+
+if __name__ == "__main__":
+    import paho.mqtt.client as mqtt
+
+    from publisher import MQTTPublisher
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("mode", choices=["record", "replay"], help="Record the messages or replay a recording")
+    parser.add_argument("path", type=str, help="Path of the recording")
+    parser.add_argument("--broker", type=str, default="192.168.0.45", help="MQTT broker address")
+    parser.add_argument("--brokerport", type=int, default=1883, help="MQTT broker port")
+    parser.add_argument("--speed", type=float, default=1.0, help="Replay speed, 0 for as fast as possible")
+    parser.add_argument("--loglevel", "-log", type=str, default="WARNING", help="Logging level")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(args.loglevel)
+
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1)
+    if args.mode == "record":
+        recorder = StreamRecorder(args.path)
+        client.on_connect = lambda client, userdata, flags, rc: recorder.subscribe(client)
+        client.on_message = recorder.on_message
+        client.connect(args.broker, args.brokerport)
+        try:
+            client.loop_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            client.disconnect()
+            recorder.close()
+            print(f"Recorded {recorder.messages} messages, {recorder.bytes} bytes")
+    else:
+        publisher = MQTTPublisher(client)
+        publisher.connect(args.broker, args.brokerport)
+        while not publisher.connected:
+            time.sleep(0.1)
+        replayer = StreamReplayer(args.path, publisher, speed=args.speed or None)
+        try:
+            print(replayer.run())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            publisher.disconnect()
+            publisher.loop_stop()
@@ -0,0 +1,680 @@
+"""Simulated hardware for running the thermal camera system without a Raspberry Pi."""
+
+import time
+import socket
+import threading
+import numpy as np
+
+# Calibration words of a plausible MLX90640, the per-pixel words are generated.
+_EEPROM_WORDS = {
+    10: 0x0000,  # calibration mode: chess pattern
+    16: 0x4210,  # offset scales and alphaPTAT
+    17: 0xFFBB,  # offset reference
+    32: 0x79A6,  # alpha scales
+    33: 0x3E80,  # alpha reference
+    48: 0x18EF,  # gain
+    49: 0x2FF1,  # vPTAT25
+    50: 0x5952,  # KvPTAT and KtPTAT
+    51: 0x9D68,  # kVdd and vdd25
+    52: 0x2222,  # Kv
+    53: 0x2863,  # interleaved/chess corrections
+    54: 0x5050,  # Kta rows/columns
+    55: 0x5050,
+    56: 0x2433,  # resolution, Kv and Kta scales
+    57: 0x004D,  # compensation pixel alpha
+    58: 0x03B5,  # compensation pixel offset
+    59: 0x0120,  # compensation pixel Kv and Kta
+    60: 0xF020,  # KsTa and TGC
+    61: 0xE6E6,  # KsTo
+    62: 0xE6E6,
+    63: 0x2889,  # corner temperatures
+}
+# Raw PTAT reading of the simulated sensors
+_PTAT = 1711
+
+
+def _signed(value, bits):
+    """Two's complement of the ``bits`` wide fields of an integer array."""
+    return np.where(value >= 1 << (bits - 1), value - (1 << bits), value)
+
+
+def synthetic_eeprom(seed=None, bad_pixels=()):
+    """Generate the EEPROM content of a simulated MLX90640.
+
+    The calibration words are fixed, the per-pixel offset, sensitivity and Kta
+    are random. Row and column corrections are left at zero.
+
+    Parameters
+    ----------
+    seed : int
+        Seed of the random generator.
+    bad_pixels : iterable of int
+        Pixels flagged as broken.
+
+    Returns
+    -------
+    eeprom : numpy.ndarray
+        Array containing the 832 EEPROM words.
+    """
+    rng = np.random.default_rng(seed)
+    eeprom = np.zeros((832,), dtype=np.uint16)
+    for index, word in _EEPROM_WORDS.items():
+        eeprom[index] = word
+    offset = rng.integers(-8, 9, 768) & 0x3F
+    alpha = rng.integers(-8, 9, 768) & 0x3F
+    kta = rng.integers(-3, 4, 768) & 0x07
+    # A zero word marks a broken pixel
+    alpha[(offset == 0) & (alpha == 0) & (kta == 0)] = 1
+    eeprom[64:] = (offset << 10) | (alpha << 4) | (kta << 1)
+    eeprom[64 + np.asarray(bad_pixels, dtype=int)] = 0
+    return eeprom
+
+
+class SimulatedMLX90640:
+    """Register-level model of an MLX90640 thermal camera.
+
+    Every time a new subpage is due, the RAM is filled with the raw readings
+    that an ideal sensor with the calibration of ``eeprom`` would give for the
+    temperatures returned by ``scene``. The inversion ignores the Kta, Kv and
+    KsTo corrections: at a die temperature of 25 C the measured temperatures
+    match the scene within 0.1 C, the error grows by about 0.1 C per degree of
+    die temperature away from it.
+
+    Parameters
+    ----------
+    eeprom : numpy.ndarray
+        EEPROM content, generated with ``synthetic_eeprom`` if not given.
+    scene : callable
+        Function returning the 768 temperatures in Celsius seen by the camera.
+    die_temperature : float
+        Temperature of the sensor in Celsius.
+    noise : float
+        Standard deviation of the temperature noise in Celsius.
+    realtime : bool
+        Whether subpages are delivered at the configured refresh rate.
+    seed : int
+        Seed of the random generators.
+    """
+
+    def __init__(self, eeprom=None, scene=None, die_temperature=25.0, noise=0.1, realtime=False, seed=None):
+        self.eeprom = synthetic_eeprom(seed) if eeprom is None else np.asarray(eeprom, dtype=np.uint16)
+        self.scene = scene if scene is not None else self.default_scene
+        self.die_temperature = die_temperature
+        self.noise = noise
+        self.realtime = realtime
+        self.ram = np.zeros((832,), dtype=np.uint16)
+        # Chess pattern, 18 bit resolution, 1 Hz
+        self.control = 0x1881
+        self.status = 0x0000
+        # The driver reads the status twice right after clearing the data
+        # ready flag (write check and retry check): those reads must not see
+        # a new subpage, otherwise the driver keeps retrying.
+        self._reads_since_clear = 2
+        self._rng = np.random.default_rng(seed)
+        self._next_subpage = time.monotonic()
+        self._decode_calibration()
+
+    @staticmethod
+    def default_scene():
+        """Room temperature background with a warm spot."""
+        row, column = np.divmod(np.arange(768), 32)
+        return 22 + 0.1 * column + 12 * np.exp(-((row - 12) ** 2 + (column - 16) ** 2) / 20)
+
+    @property
+    def subpage_period(self):
+        """Time between two subpages in seconds."""
+        rate = (self.control >> 7) & 0x07
+        return 2.0 / 2**rate
+
+    def _decode_calibration(self):
+        ee = self.eeprom.astype(np.int64)
+        pixels = ee[64:]
+        self._offset = _signed(pixels >> 10, 6) * 2 ** (ee[16] & 0x000F) + _signed(ee[17], 16)
+        cp_alpha = (ee[57] & 0x03FF) / 2 ** (((ee[32] & 0xF000) >> 12) + 27)
+        tgc = _signed(ee[60] & 0x00FF, 8) / 32
+        alpha = (_signed((pixels & 0x03F0) >> 4, 6) * 2 ** (ee[32] & 0x000F) + ee[33]) / 2 ** (
+            ((ee[32] & 0xF000) >> 12) + 30
+        )
+        self._alpha = alpha - tgc * cp_alpha
+        self._gain = int(ee[48])
+        self._vdd = (int(ee[51] & 0x00FF) - 256) * 32 - 8192
+        self._vptat25 = int(ee[49])
+        self._ktptat = int(_signed(ee[50] & 0x03FF, 10)) / 8
+        self._alpha_ptat = int(ee[16] & 0xF000) / 2**14 + 8
+        self._cp_offset = int(_signed(ee[58] & 0x03FF, 10))
+
+    def _new_subpage(self):
+        if self.realtime:
+            delay = self._next_subpage - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self._next_subpage = max(self._next_subpage, time.monotonic()) + self.subpage_period
+        ta = self.die_temperature
+        ptat_art = (ta - 25) * self._ktptat + self._vptat25
+        ta4 = (ta + 273.15) ** 4
+        tr4 = (ta - 8 + 273.15) ** 4
+        ta_tr = tr4 - (tr4 - ta4) / 0.95
+        temperature = np.asarray(self.scene(), dtype=np.float64)
+        if self.noise:
+            temperature = temperature + self._rng.normal(0, self.noise, temperature.shape)
+        raw = self._offset + 0.95 * self._alpha * ((temperature + 273.15) ** 4 - ta_tr)
+        self.ram[:768] = np.clip(np.round(raw), -32768, 32767).astype(np.int16).view(np.uint16)
+        self.ram[768] = round(_PTAT * 2**18 / ptat_art - _PTAT * self._alpha_ptat) & 0xFFFF
+        self.ram[776] = self._cp_offset & 0xFFFF
+        self.ram[778] = self._gain & 0xFFFF
+        self.ram[800] = _PTAT
+        self.ram[808] = self._cp_offset & 0xFFFF
+        self.ram[810] = self._vdd & 0xFFFF
+        self.status = (self.status ^ 0x0001) | 0x0008
+
+    def read_words(self, address, count):
+        """Read ``count`` words starting from ``address``."""
+        if address == 0x8000:
+            if not self.status & 0x0008:
+                if self._reads_since_clear >= 2:
+                    self._new_subpage()
+                self._reads_since_clear += 1
+            words = [self.status]
+        elif address == 0x800D:
+            words = [self.control]
+        elif 0x2400 <= address < 0x2400 + 832:
+            words = self.eeprom[address - 0x2400 : address - 0x2400 + count]
+        elif 0x0400 <= address < 0x0400 + 832:
+            words = self.ram[address - 0x0400 : address - 0x0400 + count]
+        else:
+            words = [0] * count
+        return np.asarray(words, dtype=">u2")[:count]
+
+    def write_word(self, address, value):
+        """Write ``value`` at ``address``."""
+        if address == 0x8000:
+            self.status = (self.status & ~0x0038) | (value & 0x0038)
+            if not value & 0x0008:
+                self._reads_since_clear = 0
+        elif address == 0x800D:
+            self.control = value
+
+
+class SimulatedI2C:
+    """In-process I2C bus with the interface of ``busio.I2C``.
+
+    Parameters
+    ----------
+    devices : dict
+        Simulated devices keyed by I2C address.
+    frequency : float, optional
+        Clock frequency in Hz used to simulate the transfer time, transfers
+        are instantaneous if not given.
+    """
+
+    def __init__(self, devices=None, frequency=None):
+        self.devices = dict(devices or {})
+        self.frequency = frequency
+        self._lock = threading.Lock()
+
+    def _transfer(self, nbytes):
+        # Address byte plus data bytes, 9 clock cycles each
+        if self.frequency:
+            time.sleep(9 * (nbytes + 1) / self.frequency)
+
+    def try_lock(self):
+        return self._lock.acquire(blocking=False)
+
+    def unlock(self):
+        self._lock.release()
+
+    def _device(self, address):
+        try:
+            return self.devices[address]
+        except KeyError:
+            raise OSError(f"No simulated device at address 0x{address:x}")
+
+    def writeto(self, address, buffer, *, start=0, end=None):
+        data = bytes(buffer[start:end])
+        device = self._device(address)
+        self._transfer(len(data))
+        if len(data) == 4:
+            device.write_word(int.from_bytes(data[:2], "big"), int.from_bytes(data[2:], "big"))
+
+    def writeto_then_readfrom(
+        self, address, buffer_out, buffer_in, *, out_start=0, out_end=None, in_start=0, in_end=None
+    ):
+        register = int.from_bytes(bytes(buffer_out[out_start:out_end]), "big")
+        in_end = len(buffer_in) if in_end is None else in_end
+        self._transfer(len(buffer_out[out_start:out_end]) + in_end - in_start + 1)
+        words = self._device(address).read_words(register, (in_end - in_start) // 2)
+        buffer_in[in_start:in_end] = words.tobytes()
+
+    def readfrom_into(self, address, buffer, *, start=0, end=None):
+        self._device(address)
+
+    def deinit(self):
+        pass
+
+
+class SimulatedHomeSwitch:
+    """Home switch actuated by a simulated motor.
+
+    The switch is pressed over an arc of ``width`` degrees ending at
+    ``home``, so it is reached at ``home`` when moving backward. Each press
+    actuates at a slightly different angle (``jitter``), and the GPIO sees it
+    ``latency`` seconds later (switch travel and debouncing).
+
+    Parameters
+    ----------
+    home : float
+        Angle in degrees at which the switch is reached moving backward.
+    width : float
+        Angular width in degrees of the pressed arc.
+    jitter : float
+        Standard deviation in degrees of the actuation angle.
+    latency : float
+        Delay in seconds between the actuation and the GPIO edge.
+    angle : float
+        Initial angle of the motor in degrees.
+    clock : callable
+        Clock in seconds.
+    seed : int, optional
+        Seed of the random jitter.
+
+    Attributes
+    ----------
+    angle : float
+        Angle of the motor in degrees.
+    """
+
+    def __init__(self, home=0.0, width=3.0, jitter=0.01, latency=0.001, angle=90.0, clock=time.monotonic, seed=None):
+        self.home = home
+        self.width = width
+        self.jitter = jitter
+        self.latency = latency
+        self.angle = angle
+        self._clock = clock
+        self._rng = np.random.default_rng(seed)
+        self._threshold = self._rng.normal(0, jitter)
+        self._edge_time = None
+        self._last_check = clock()
+        self.step(0)
+        if self._edge_time is not None:
+            self._edge_time -= latency
+
+    def step(self, angle):
+        """Move the motor by an angle in degrees."""
+        self.angle += angle
+        distance = (self.angle - self.home + 180) % 360 - 180
+        contact = -self.width <= distance <= self._threshold
+        if contact and self._edge_time is None:
+            self._edge_time = self._clock() + self.latency
+        elif not contact and self._edge_time is not None:
+            self._edge_time = None
+            self._threshold = self._rng.normal(0, self.jitter)
+
+    def pressed(self):
+        """Get the state of the switch seen by the GPIO."""
+        return self._edge_time is not None and self._clock() >= self._edge_time
+
+    def reset(self):
+        """Forget the edges detected so far."""
+        self._last_check = self._clock()
+
+    def triggered(self):
+        """Check whether the GPIO saw a press since the last call or reset."""
+        now = self._clock()
+        edge = self._edge_time is not None and self._last_check < self._edge_time <= now
+        self._last_check = now
+        return edge
+
+
+class SimulatedClock:
+    """Virtual clock, sleeping only advances its time.
+
+    Used to run moves and homing without waiting for the motor.
+
+    Parameters
+    ----------
+    start : float
+        Initial time in seconds.
+    """
+
+    def __init__(self, start=0.0):
+        self._time = start
+        self._lock = threading.Lock()
+
+    def monotonic(self):
+        """Get the current time in seconds."""
+        return self._time
+
+    def sleep(self, duration):
+        """Advance the time by ``duration`` seconds."""
+        if duration > 0:
+            with self._lock:
+                self._time += duration
+
+
+class SimulatedRoom:
+    """Synthetic thermal scene around the rig.
+
+    The background temperature varies smoothly with the azimuth, and hot
+    spots sit at fixed azimuths and elevations, so the frames depend on the
+    motor position.
+
+    Parameters
+    ----------
+    background : float
+        Mean background temperature in Celsius.
+    hot_spots : list of tuple
+        ``(azimuth, elevation, temperature, size)`` of each hot spot, angles
+        and size in degrees, temperature above the background in Celsius.
+    fov : tuple of float
+        Horizontal and vertical field of view of the cameras in degrees.
+    """
+
+    HOT_SPOTS = [(30.0, 0.0, 15.0, 4.0), (140.0, 10.0, 40.0, 2.0), (250.0, -15.0, 8.0, 8.0)]
+
+    def __init__(self, background=22.0, hot_spots=None, fov=(35.0, 55.0)):
+        self.background = background
+        self.hot_spots = np.array(self.HOT_SPOTS if hot_spots is None else hot_spots, dtype=float).reshape(-1, 4)
+        # The upright image is the transpose of the raw frame: raw rows are
+        # horizontal, raw columns are vertical from the top
+        row, column = np.divmod(np.arange(768), 32)
+        self._azimuth = (row - 11.5) * fov[0] / 24
+        self._elevation = (15.5 - column) * fov[1] / 32
+
+    def view(self, azimuth):
+        """Get the 768 raw pixel temperatures seen by a camera.
+
+        Parameters
+        ----------
+        azimuth : float
+            Azimuth in degrees the camera points to.
+
+        Returns
+        -------
+        temperatures : numpy.ndarray
+            Temperatures in Celsius in the order of the raw frame.
+        """
+        pixel_azimuth = azimuth + self._azimuth
+        temperature = self.background + 2 * np.sin(np.radians(pixel_azimuth))
+        for spot_azimuth, elevation, excess, size in self.hot_spots:
+            distance = (pixel_azimuth - spot_azimuth + 180) % 360 - 180
+            temperature += excess * np.exp(-(distance**2 + (self._elevation - elevation) ** 2) / (2 * size**2))
+        return temperature
+
+
+class SimulatedStepper:
+    """Stepper motor with the interface of ``adafruit_motor.stepper.StepperMotor``.
+
+    Parameters
+    ----------
+    microsteps : int
+        Microsteps per full step of 1.8 degrees.
+    angle : float
+        Initial angle in degrees.
+    switch : SimulatedHomeSwitch, optional
+        Home switch actuated by the motor.
+    step_time : float
+        Time in seconds taken by a step, the I2C transfers to the driver.
+    """
+
+    FORWARD = 1
+    BACKWARD = 2
+    SINGLE = 1
+    DOUBLE = 2
+    INTERLEAVE = 3
+    MICROSTEP = 4
+
+    def __init__(self, microsteps=10, angle=0.0, switch=None, step_time=0.0):
+        self.microsteps = microsteps
+        self.angle = angle
+        self.switch = switch
+        self.step_time = step_time
+        self.steps = 0
+        self.released = True
+
+    def onestep(self, *, direction=FORWARD, style=SINGLE):
+        """Take a step, returning the position in microsteps."""
+        if style == self.MICROSTEP:
+            increment = 1
+        elif style == self.INTERLEAVE:
+            increment = self.microsteps // 2
+        else:
+            increment = self.microsteps
+        if direction == self.BACKWARD:
+            increment = -increment
+        angle = increment * 1.8 / self.microsteps
+        if self.step_time:
+            time.sleep(self.step_time)
+        self.steps += increment
+        self.angle += angle
+        self.released = False
+        if self.switch is not None:
+            self.switch.step(angle)
+        return self.steps
+
+    def release(self):
+        """Release the coils."""
+        self.released = True
+
+
+class SimulatedMotorKit:
+    """Motor driver with the interface of ``adafruit_motorkit.MotorKit``."""
+
+    def __init__(self, stepper):
+        self.stepper1 = stepper
+
+
+class SimulatedGPIO:
+    """GPIO with the subset of the ``RPi.GPIO`` interface used by the system.
+
+    Parameters
+    ----------
+    switches : dict
+        ``SimulatedHomeSwitch`` connected to each pin.
+    """
+
+    BCM = 11
+    BOARD = 10
+    IN = 1
+    OUT = 0
+    PUD_OFF = 20
+    PUD_DOWN = 21
+    PUD_UP = 22
+    LOW = 0
+    HIGH = 1
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+    def __init__(self, switches):
+        self.switches = switches
+        # Pins with edge detection
+        self.detecting = set()
+
+    def setmode(self, mode):
+        pass
+
+    def setup(self, pin, direction, pull_up_down=PUD_OFF):
+        pass
+
+    def input(self, pin):
+        return self.HIGH if self.switches[pin].pressed() else self.LOW
+
+    def add_event_detect(self, pin, edge):
+        if edge != self.RISING:
+            raise RuntimeError("Only rising edges are simulated")
+        if pin in self.detecting:
+            # Like RPi.GPIO
+            raise RuntimeError("Conflicting edge detection already enabled for this GPIO channel")
+        self.detecting.add(pin)
+        self.switches[pin].reset()
+
+    def remove_event_detect(self, pin):
+        self.detecting.discard(pin)
+
+    def event_detected(self, pin):
+        return self.switches[pin].triggered()
+
+    def cleanup(self):
+        pass
+
+
+class RecordingMQTTClient:
+    """MQTT client recording the published messages instead of sending them.
+
+    Parameters
+    ----------
+    messages_per_s : float, optional
+        If given, the messages are sent one after the other at this rate, like
+        through a slow broker or network, and ``publish`` returns an object
+        with the ``is_published`` method of ``MQTTMessageInfo``.
+
+    Attributes
+    ----------
+    messages : list of tuple
+        ``(time, topic, payload)`` of each published message, ``time`` from
+        ``time.time``.
+    """
+
+    def __init__(self, messages_per_s=None):
+        self.messages = []
+        self.messages_per_s = messages_per_s
+        self._sent = time.monotonic()
+        self._lock = threading.Lock()
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        with self._lock:
+            self.messages.append((time.time(), topic, payload))
+            if self.messages_per_s is None:
+                return None
+            self._sent = max(self._sent, time.monotonic()) + 1 / self.messages_per_s
+            return _MessageInfo(self._sent)
+
+    def subscribe(self, topic, qos=0):
+        pass
+
+
+class _MessageInfo:
+    """Published message sent at a given time."""
+
+    def __init__(self, sent):
+        self._sent = sent
+
+    def is_published(self):
+        return time.monotonic() >= self._sent
+
+
+class SimulatedBroker:
+    """Minimal MQTT 3.1.1 broker on localhost, recording the published messages.
+
+    It accepts the connections, acknowledges the subscriptions and the QoS 1
+    messages, and answers the pings, without forwarding anything. The
+    connections can be dropped and refused to exercise the reconnections.
+
+    Parameters
+    ----------
+    port : int
+        TCP port, any free port by default.
+
+    Attributes
+    ----------
+    messages : list of tuple
+        ``(topic, payload)`` of each received message.
+    packets : int
+        Number of received packets.
+    bytes : int
+        Number of received bytes.
+    """
+
+    def __init__(self, port=0):
+        self.messages = []
+        self.packets = 0
+        self.bytes = 0
+        self._lock = threading.Lock()
+        self._connections = []
+        self._server = socket.create_server(("127.0.0.1", port))
+        self.port = self._server.getsockname()[1]
+        self._running = True
+        self.accepting = True
+        threading.Thread(target=self._accept, name="broker", daemon=True).start()
+
+    def _accept(self):
+        while self._running:
+            try:
+                connection, _ = self._server.accept()
+            except OSError:
+                break
+            if not self.accepting:
+                connection.close()
+                continue
+            with self._lock:
+                self._connections.append(connection)
+            threading.Thread(target=self._serve, args=(connection,), daemon=True).start()
+
+    @staticmethod
+    def _read(connection, n):
+        data = b""
+        while len(data) < n:
+            chunk = connection.recv(n - len(data))
+            if not chunk:
+                raise ConnectionError
+            data += chunk
+        return data
+
+    def _serve(self, connection):
+        try:
+            while True:
+                kind = self._read(connection, 1)[0]
+                length, shift, header = 0, 0, 1
+                while True:
+                    byte = self._read(connection, 1)[0]
+                    header += 1
+                    length += (byte & 0x7F) << shift
+                    shift += 7
+                    if not byte & 0x80:
+                        break
+                body = self._read(connection, length)
+                with self._lock:
+                    self.packets += 1
+                    self.bytes += header + length
+                packet = kind >> 4
+                if packet == 1:
+                    connection.sendall(b"\x20\x02\x00\x00")
+                elif packet == 3:
+                    size = int.from_bytes(body[:2], "big")
+                    topic = body[2 : 2 + size].decode()
+                    qos = (kind >> 1) & 0x03
+                    start = 2 + size + (2 if qos else 0)
+                    with self._lock:
+                        self.messages.append((topic, body[start:]))
+                    if qos == 1:
+                        connection.sendall(b"\x40\x02" + body[2 + size : start])
+                elif packet == 8:
+                    # One granted QoS 0 per topic filter
+                    connection.sendall(b"\x90\x03" + body[:2] + b"\x00")
+                elif packet == 12:
+                    connection.sendall(b"\xd0\x00")
+                elif packet == 14:
+                    break
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            connection.close()
+            with self._lock:
+                if connection in self._connections:
+                    self._connections.remove(connection)
+
+    def drop(self):
+        """Close the current connections, as a broker restart or a network loss."""
+        with self._lock:
+            connections = list(self._connections)
+        for connection in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def close(self):
+        """Stop the broker."""
+        self._running = False
+        self.drop()
+        self._server.close()
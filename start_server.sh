@@ -1,2 +1,5 @@
 #!/bin/bash
-gunicorn -w 1 -b 0.0.0.0:5004 app:app &
+# One worker owns the cameras, its threads serve the requests and the streams.
+# Each /stream client holds a thread: keep THERMALCAMERA_MAX_STREAMS (24 by
+# default) below --threads, the other requests need the remaining ones.
+gunicorn -w 1 --threads 32 -b 0.0.0.0:5004 'app:create_app()' &
@@ -0,0 +1,213 @@
+"""Online stitching of the thermal camera frames into a cylindrical panorama."""
+
+import threading
+import numpy as np
+
+# Yaw and pitch in degrees of each camera when the motor is at 0 degrees
+DEFAULT_LAYOUT = {
+    "camera0": (0.0, 0.0),
+    "camera1": (90.0, 0.0),
+    "camera2": (180.0, 0.0),
+    "camera3": (270.0, 0.0),
+}
+
+
+def oriented_pixel_index():
+    """Raw pixel index of each pixel of the upright image.
+
+    The cameras are mounted rotated: the upright image is
+    ``np.flip(np.rot90(frame.reshape(24, 32)), axis=0)``, 32 rows by 24 columns.
+    """
+    return np.flip(np.rot90(np.arange(24 * 32).reshape(24, 32)), axis=0)
+
+
+class PanoramaStitcher:
+    """Incremental stitcher of the frames of the rotating rig.
+
+    The panorama is a fixed grid on a cylinder around the rotation axis:
+    columns are azimuth angles, rows are heights on the unit cylinder. For
+    each camera, the cells seen at motor position 0 and the pixel they sample
+    are precomputed, so adding a frame only shifts the columns by the motor
+    position and accumulates a weighted sum per cell. Pixels are weighted
+    higher at the center of the image to soften the seams. Memory does not
+    depend on the number of frames.
+
+    Parameters
+    ----------
+    layout : dict
+        Yaw and pitch in degrees of each camera at motor position 0.
+    fov : tuple of float
+        Horizontal and vertical field of view in degrees of the upright image.
+    resolution : float
+        Angular size of a panorama cell in degrees.
+    max_weight : float, optional
+        If given, the accumulated weight of a cell is capped, turning the mean
+        into an exponential average that follows changes of the scene.
+
+    Attributes
+    ----------
+    shape : tuple of int
+        Number of rows and columns of the panorama.
+    heights : numpy.ndarray
+        Height on the unit cylinder of the center of each row, top to bottom.
+    """
+
+    def __init__(self, layout=None, fov=(35.0, 55.0), resolution=0.5, max_weight=None):
+        self.layout = dict(DEFAULT_LAYOUT if layout is None else layout)
+        self.fov = fov
+        self.resolution = resolution
+        self.max_weight = max_weight
+        columns = int(round(360 / resolution))
+        # Height of the cylinder covered by the tilted cameras
+        pitch = max(abs(p) for _, p in self.layout.values())
+        max_height = np.tan(np.radians(min(pitch + fov[1] / 2 + resolution, 80)))
+        step = np.radians(resolution)
+        rows = 2 * int(np.ceil(max_height / step))
+        self.shape = (rows, columns)
+        # First row at the top
+        self.heights = (rows / 2 - 0.5 - np.arange(rows)) * step
+        self._sum = np.zeros(self.shape)
+        self._weight = np.zeros(self.shape)
+        self._dirty_columns = np.zeros((columns,), dtype=bool)
+        self._dirty_rows = [rows, 0]
+        self._lock = threading.Lock()
+        self._footprints = {camera: self._footprint(*orientation) for camera, orientation in self.layout.items()}
+
+    def _footprint(self, yaw, pitch):
+        """Cells seen by a camera at motor position 0 and the pixels they sample."""
+        rows, columns = self.shape
+        index = oriented_pixel_index()
+        height, width = index.shape
+        fx = (width / 2) / np.tan(np.radians(self.fov[0] / 2))
+        fy = (height / 2) / np.tan(np.radians(self.fov[1] / 2))
+        # Columns around the camera yaw, relative to it
+        half_width = int(np.ceil(self.fov[0] / self.resolution))
+        offsets = np.arange(-half_width, half_width + 1)
+        azimuth = np.radians(offsets * self.resolution)
+        az, h = np.meshgrid(azimuth, self.heights)
+        # Ray of each cell, in the frame of the camera rotated by its pitch
+        x, y, z = np.sin(az), h, np.cos(az)
+        cos_p, sin_p = np.cos(np.radians(pitch)), np.sin(np.radians(pitch))
+        y, z = y * cos_p - z * sin_p, y * sin_p + z * cos_p
+        with np.errstate(divide="ignore", invalid="ignore"):
+            u = np.where(z > 0, x / z * fx + (width - 1) / 2, -1)
+            v = np.where(z > 0, (height - 1) / 2 - y / z * fy, -1)
+        u = np.rint(u).astype(int)
+        v = np.rint(v).astype(int)
+        seen = (u >= 0) & (u < width) & (v >= 0) & (v < height)
+        cell_rows, cell_offsets = np.nonzero(seen)
+        u, v = u[seen], v[seen]
+        # Triangular weight, maximum at the center of the image
+        weight = (1 - np.abs(2 * u / (width - 1) - 1) + 0.05) * (1 - np.abs(2 * v / (height - 1) - 1) + 0.05)
+        yaw_column = int(round(yaw / self.resolution))
+        return (
+            cell_rows,
+            offsets[cell_offsets] + yaw_column,
+            index[v, u],
+            weight,
+            (int(cell_rows.min()), int(cell_rows.max()) + 1) if len(cell_rows) else (0, 0),
+        )
+
+    def add_frame(self, camera, frame, position):
+        """Accumulate a frame into the panorama.
+
+        Parameters
+        ----------
+        camera : str
+            Name of the camera.
+        frame : numpy.ndarray
+            Raw 768-pixel frame in Celsius.
+        position : float
+            Motor position in degrees.
+        """
+        if not np.isfinite(position):
+            # Read while the motor moved, the frame has no place in the panorama
+            return
+        rows, column_offsets, pixels, weight, row_span = self._footprints[camera]
+        columns = (column_offsets + int(round(position / self.resolution))) % self.shape[1]
+        cells = rows * self.shape[1] + columns
+        values = frame[pixels]
+        # Bad pixels (-273.15) and failed pixels (NaN) do not contribute
+        valid = values > -273
+        weight = np.where(valid, weight, 0)
+        values = np.where(valid, values, 0)
+        total = self._sum.reshape(-1)
+        total_weight = self._weight.reshape(-1)
+        with self._lock:
+            # A camera sees each cell once, so the cells are unique
+            total[cells] += weight * values
+            total_weight[cells] += weight
+            if self.max_weight is not None:
+                scale = self.max_weight / np.maximum(total_weight[cells], self.max_weight)
+                total[cells] *= scale
+                total_weight[cells] *= scale
+            self._dirty_columns[columns] = True
+            self._dirty_rows = [min(self._dirty_rows[0], row_span[0]), max(self._dirty_rows[1], row_span[1])]
+
+    def panorama(self, rows=slice(None), columns=slice(None)):
+        """Get the mean temperature of the cells, NaN where nothing was seen.
+
+        Parameters
+        ----------
+        rows, columns : slice
+            Region of the panorama.
+
+        Returns
+        -------
+        panorama : numpy.ndarray
+            Float32 mean temperatures.
+        """
+        with self._lock:
+            total = self._sum[rows, columns]
+            weight = self._weight[rows, columns]
+            with np.errstate(divide="ignore", invalid="ignore"):
+                return np.where(weight > 0, total / weight, np.nan).astype(np.float32)
+
+    def changed_regions(self):
+        """Get the regions updated since the last call.
+
+        Returns
+        -------
+        regions : list of tuple
+            ``(row0, column0, panorama)`` of each updated region, where
+            ``panorama`` is the float32 region starting at that cell. A region
+            crossing the 360 degrees boundary is split in two.
+        """
+        with self._lock:
+            dirty = self._dirty_columns.copy()
+            row0, row1 = self._dirty_rows
+            self._dirty_columns[:] = False
+            self._dirty_rows = [self.shape[0], 0]
+        if row0 >= row1:
+            return []
+        # Runs of consecutive updated columns
+        edges = np.diff(np.concatenate(([0], dirty.view(np.int8), [0])))
+        starts = np.flatnonzero(edges == 1)
+        stops = np.flatnonzero(edges == -1)
+        return [
+            (row0, int(start), self.panorama(slice(row0, row1), slice(start, stop))) for start, stop in zip(starts, stops)
+        ]
+
+    def reset(self):
+        """Clear the panorama."""
+        with self._lock:
+            self._sum[:] = 0
+            self._weight[:] = 0
+            self._dirty_columns[:] = True
+            self._dirty_rows = [0, self.shape[0]]
+
+    def save(self, path):
+        """Save the panorama to a NumPy ``.npz`` file.
+
+        Parameters
+        ----------
+        path : str
+            Path of the file.
+        """
+        np.savez_compressed(
+            path,
+            panorama=self.panorama(),
+            weight=self._weight,
+            heights=self.heights,
+            resolution=self.resolution,
+        )
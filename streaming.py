@@ -0,0 +1,168 @@
+"""Rate-controlled streaming of the camera frames."""
+
+import time
+import logging
+import threading
+from collections import deque
+
+
+class StreamScheduler:
+    """Stream the frames of the cameras at a fixed rate with backpressure.
+
+    A thread publishes a frame of each camera every ``1 / rate`` seconds,
+    sleeping on events in between. When ``max_inflight`` messages returned by
+    ``publish`` are not yet sent (slow broker or network), frames are dropped
+    instead of queued. A camera falling behind skips its missed slots instead
+    of bursting. Errors are counted and logged, the first of each kind and
+    then every ``LOG_EVERY``.
+
+    Parameters
+    ----------
+    cameras : list of str
+        Names of the cameras.
+    acquire : callable
+        Function taking a camera name and returning its latest frame record.
+    publish : callable
+        Function taking a camera name and a frame record, and returning the
+        ``MQTTMessageInfo`` of the published message, None if it is already
+        sent, or False if the frame was not published because it did not
+        change.
+    rate : float
+        Frames per second of each camera.
+    max_inflight : int
+        Maximum number of messages waiting to be sent.
+    """
+
+    LOG_EVERY = 100
+
+    def __init__(self, cameras, acquire, publish, rate=1.0, max_inflight=8):
+        self.cameras = list(cameras)
+        self.acquire = acquire
+        self.publish = publish
+        self.rate = rate
+        self.max_inflight = max_inflight
+        self.published = 0
+        self.dropped = 0
+        self.skipped = 0
+        self.unchanged = 0
+        self.errors = {}
+        self.last_error = None
+        self._inflight = deque()
+        self._active = threading.Event()
+        self._stopping = threading.Event()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def configure(self, rate=None, max_inflight=None):
+        """Change the rate or the in-flight limit, taken into account immediately."""
+        if rate is not None:
+            if rate <= 0:
+                raise ValueError("The streaming rate must be positive")
+            self.rate = rate
+        if max_inflight is not None:
+            self.max_inflight = max_inflight
+        self._wake.set()
+
+    def start(self):
+        """Start streaming in a thread."""
+        self._stopping.clear()
+        self._active.set()
+        self._thread = threading.Thread(target=self._loop, name="stream", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5.0):
+        """Stop streaming and wait for the thread."""
+        self._stopping.set()
+        self._active.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def pause(self):
+        """Suspend streaming, e.g. while a scan publishes the frames."""
+        self._active.clear()
+        self._wake.set()
+
+    def resume(self):
+        """Resume streaming."""
+        self._active.set()
+
+    @property
+    def paused(self):
+        return not self._active.is_set()
+
+    def inflight(self):
+        """Number of published messages not sent yet."""
+        # Messages may be sent out of order with QoS > 0
+        self._inflight = deque(info for info in self._inflight if not info.is_published())
+        return len(self._inflight)
+
+    def stats(self):
+        """Get the streaming statistics.
+
+        Returns
+        -------
+        stats : dict
+            Rate, frames published, dropped by the backpressure, skipped by
+            falling behind and not published because unchanged, messages in
+            flight and error counts by kind.
+        """
+        return {
+            "rate": self.rate,
+            "paused": self.paused,
+            "published": self.published,
+            "dropped": self.dropped,
+            "skipped": self.skipped,
+            "unchanged": self.unchanged,
+            "inflight": len(self._inflight),
+            "errors": dict(self.errors),
+            "last_error": self.last_error,
+        }
+
+    def _error(self, kind, error):
+        count = self.errors.get(kind, 0) + 1
+        self.errors[kind] = count
+        self.last_error = f"{kind}: {error}"
+        if count == 1 or count % self.LOG_EVERY == 0:
+            logging.error(f"Streaming {kind} error ({count} so far): {error}")
+
+    def _loop(self):
+        deadlines = {camera: time.monotonic() for camera in self.cameras}
+        while not self._stopping.is_set():
+            if not self._active.is_set():
+                self._active.wait()
+                # Start afresh rather than catching up the paused time
+                deadlines = dict.fromkeys(self.cameras, time.monotonic())
+                continue
+            camera = min(deadlines, key=deadlines.get)
+            delay = deadlines[camera] - time.monotonic()
+            if delay > 0:
+                self._wake.clear()
+                # Woken early by a new configuration, a pause or a stop
+                if self._wake.wait(delay):
+                    continue
+            period = 1 / self.rate
+            now = time.monotonic()
+            missed = int((now - deadlines[camera]) // period)
+            self.skipped += missed
+            deadlines[camera] += (missed + 1) * period
+            if self.inflight() >= self.max_inflight:
+                self.dropped += 1
+                continue
+            try:
+                record = self.acquire(camera)
+            except Exception as e:
+                self._error("acquisition", e)
+                continue
+            if self._stopping.is_set() or not self._active.is_set():
+                continue
+            try:
+                info = self.publish(camera, record)
+                if info is False:
+                    self.unchanged += 1
+                    continue
+                self.published += 1
+                if info is not None:
+                    self._inflight.append(info)
+            except Exception as e:
+                self._error("publish", e)
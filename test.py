@@ -1,14 +1,56 @@
 """Unit tests for the ThermalCamera class."""
+import os
+import json
+import time
+import threading
+import tempfile
 import unittest
 from unittest.mock import MagicMock
 import numpy as np
-from thermalcamera import ThermalCamera
+import adafruit_mlx90640
+import paho.mqtt.client as mqtt
+
+# Simulated hardware unless the tests run on the rig with THERMALCAMERA_BACKEND=pi
+os.environ.setdefault("THERMALCAMERA_BACKEND", "simulated")
+from acquisition import SharedFrameRing
+from alarms import AlarmEngine
+from archive import FrameArchive, FrameArchiveWriter
+from change_detection import ChangeDetector
+from commands import CommandExecutor
+from denoising import TemporalFilter
+from homing import home
+from motion import execute, plan_move, shortest_path, step_schedule
+from pipeline import Pipeline
+from pixel_pipeline import PixelPipeline
+from position_journal import PositionJournal
+from frame_format import FORMATS, FrameDecoder, decode_bundle, decode_frame, encode_bundle, encode_frame
+from frame_server import FrameServer
+from frame_stats import FrameStatistics
+from publisher import MQTTPublisher
+from recording import StreamRecorder, StreamReplayer, read_recording
+from stitching import PanoramaStitcher, oriented_pixel_index
+from streaming import StreamScheduler
+from simulation import RecordingMQTTClient, SimulatedBroker, SimulatedHomeSwitch, SimulatedI2C, SimulatedMLX90640, synthetic_eeprom
+from thermalcamera import FastMLX90640, FrameCache, FrameRecord, FrameRing, ThermalCamera
+from timeseries import StatisticsStore
+from benchmark import benchmark_end_to_end
+from app import create_app
+from mqtt_api import ThermalCameraAPI
+from viewer import FrameReceiver, FrameViewer
 
 
 class TestThermalCamera(unittest.TestCase):
     def setUp(self):
+        # The position journal and the calibration cache are written to the working directory
+        self.cwd = os.getcwd()
+        self.directory = tempfile.TemporaryDirectory()
+        os.chdir(self.directory.name)
         self.camera = ThermalCamera(absolute_position=0)
 
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.directory.cleanup()
+
     def test_initial_absolute_position(self):
         self.assertAlmostEqual(self.camera.absolute_position, 0)
 
@@ -29,19 +71,19 @@ class TestThermalCamera(unittest.TestCase):
         self.assertAlmostEqual(self.camera.absolute_position, initial_position)
 
     def test_get_frame(self):
-        frame = self.camera.get_frame(camera="camera-0")
+        frame = self.camera.get_frame(camera="camera0")
         self.assertIsInstance(frame, type(np.array([])))
         self.assertEqual(len(frame), 24 * 32)
 
     def test_get_frame_as_bytes(self):
-        frame_bytes = self.camera.get_frame_as_bytes(camera="camera-0")
+        frame_bytes = self.camera.get_frame_as_bytes(camera="camera0")
         self.assertIsInstance(frame_bytes, bytearray)
         # Calculate expected length based on the length of the frame (floats * 4 bytes)
         expected_length = 24 * 32 * 4
         self.assertEqual(len(frame_bytes), expected_length)
 
     def test_get_frame_as_image(self):
-        frame_image = self.camera.get_frame_as_image(camera="camera-0")
+        frame_image = self.camera.get_frame_as_image(camera="camera0")
         self.assertIsInstance(frame_image, type(np.array([])))
         self.assertEqual(frame_image.shape, (24, 32))
 
@@ -49,6 +91,1075 @@ class TestThermalCamera(unittest.TestCase):
         switch_state = self.camera.get_switch_state()
         self.assertIsInstance(switch_state, bool)
 
+    def test_filtered_frame(self):
+        self.camera.configure_filter(mode="mean", length=4)
+        record = self.camera.get_filtered_record("camera0", settle=True)
+        self.assertEqual(self.camera.frame_filters["camera0"].count, 4)
+        raw = self.camera.frame_rings["camera0"].frames[: record.sequence + 1]
+        np.testing.assert_allclose(record.frame, raw.mean(axis=0), atol=1e-4)
+        with self.assertRaises(ValueError):
+            self.camera.configure_filter(mode="gaussian")
+
+    def test_pixel_calibration(self):
+        with open(ThermalCamera.PIXEL_CALIBRATION, "w") as f:
+            json.dump({"camera0": {"crop": [0, 30, 2, 22], "offset": [100.0] * 768, "bad_pixels": [5]}}, f)
+        camera = ThermalCamera(absolute_position=0)
+        self.assertEqual(camera.get_oriented_image("camera0").shape, (30, 20))
+        self.assertGreater(camera.get_frame("camera0").min(), 100)
+        self.assertLess(camera.get_frame("camera1").max(), 100)
+
+    def test_process_acquisition(self):
+        camera = ThermalCamera(absolute_position=0, acquisition="process")
+        try:
+            self.assertIsInstance(camera.frame_rings["camera0"], SharedFrameRing)
+            camera.absolute_position = 90.0
+            record = camera.get_frame_record("camera1", max_age=0)
+            self.assertEqual(record.position, 90.0)
+            # The acquisition process looks from the position of this process
+            np.testing.assert_allclose(record.frame, self.camera.get_frame_record("camera2").frame, atol=1)
+            # A view of the shared memory, released before closing it
+            del record
+        finally:
+            camera.close()
+        with self.assertRaises(ValueError):
+            ThermalCamera(absolute_position=0, acquisition="process", backend=self.camera.backend)
+
+    def test_calibrate(self):
+        self.camera.go_to(60)
+        report = self.camera.calibrate()
+        self.assertTrue(report.found)
+        self.assertAlmostEqual(self.camera.absolute_position, 0)
+        self.assertTrue(self.camera.get_switch_state())
+
+    def test_switch_edge_detection(self):
+        self.assertTrue(self.camera.switch.edge_detection)
+        # One edge detection per pin, like RPi.GPIO, the second camera polls
+        self.assertFalse(ThermalCamera(absolute_position=0, backend=self.camera.backend).switch.edge_detection)
+        self.camera.close()
+        self.assertTrue(ThermalCamera(absolute_position=0, backend=self.camera.backend).switch.edge_detection)
+
+    def test_close_syncs_the_journal(self):
+        # Recorded during a move, not yet written
+        self.camera.absolute_position = 45.0
+        self.camera.close()
+        self.assertIsNone(self.camera.position_journal._file)
+        self.assertAlmostEqual(PositionJournal(ThermalCamera.POSITION_JOURNAL).last_position(), 45.0)
+
+
+class TestFastMLX90640(unittest.TestCase):
+    def setUp(self):
+        self.device = SimulatedMLX90640(eeprom=synthetic_eeprom(0, bad_pixels=[100, 300]), die_temperature=35.0, seed=0)
+        bus = SimulatedI2C({0x33: self.device})
+        self.fast = FastMLX90640(bus, 0x33)
+        # The Adafruit driver accumulates the bad pixels of every instance
+        adafruit_mlx90640.MLX90640.brokenPixels = []
+        adafruit_mlx90640.MLX90640.outlierPixels = []
+        self.adafruit = adafruit_mlx90640.MLX90640(bus, 0x33)
+
+    def test_same_temperatures_as_adafruit(self):
+        for control in (0x1881, 0x0881):  # chess and interleaved patterns
+            for sub_page in (0, 1):
+                self.device.control = control
+                self.device._new_subpage()
+                words = np.concatenate([self.device.ram, [control, sub_page]]).astype(np.uint16)
+                expected = np.zeros((768,))
+                result = np.zeros((768,))
+                self.adafruit._CalculateTo(words.tolist(), 0.95, 22.0, expected)
+                self.fast._CalculateTo(words, 0.95, 22.0, result)
+                np.testing.assert_allclose(result, expected, rtol=0, atol=FastMLX90640.TOLERANCE)
+
+    def test_calibration_cache(self):
+        bus = SimulatedI2C({0x33: self.device})
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cold = FastMLX90640(bus, 0x33, cache_dir=cache_dir)
+            warm = FastMLX90640(bus, 0x33, cache_dir=cache_dir)
+            for name in FastMLX90640._CALIBRATION_PARAMETERS:
+                self.assertEqual(getattr(warm, name), getattr(cold, name))
+            # A different EEPROM at the same address must not use the cache
+            bus.devices[0x33] = SimulatedMLX90640(seed=1)
+            other = FastMLX90640(bus, 0x33, cache_dir=cache_dir)
+            self.assertNotEqual(other.checksum, cold.checksum)
+            self.assertNotEqual(other.offset, cold.offset)
+            # Cameras at the same address saving the cache concurrently
+            threads = [
+                threading.Thread(target=FastMLX90640, args=(SimulatedI2C({0x33: SimulatedMLX90640(seed=seed)}), 0x33, cache_dir))
+                for seed in range(4)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(os.listdir(cache_dir), ["mlx90640_0x33.json"])
+            with open(os.path.join(cache_dir, "mlx90640_0x33.json")) as f:
+                self.assertEqual(set(json.load(f)["parameters"]), set(FastMLX90640._CALIBRATION_PARAMETERS))
+
+    def test_get_frame(self):
+        frame = np.zeros((768,))
+        self.fast.getFrame(frame)
+        self.assertEqual(frame[100], -273.15)
+        np.testing.assert_allclose(np.delete(frame, [100, 300]), np.delete(self.device.scene(), [100, 300]), atol=3)
+
+
+class TestFrameRing(unittest.TestCase):
+    def test_frames_are_written_in_place(self):
+        ring = FrameRing(size=2)
+        for i in range(3):
+            index, buffer = ring.acquire()
+            buffer[:] = i
+            self.assertEqual(ring.commit(index, position=10.0 * i), i)
+        self.assertEqual(ring.latest(), 0)
+        self.assertTrue(np.shares_memory(buffer, ring.frames))
+        np.testing.assert_array_equal(ring.frames[:, 0], [2, 1])
+        np.testing.assert_array_equal(ring.sequence, [2, 1])
+        self.assertEqual(ring.position[ring.latest()], 20.0)
+
+
+    def test_shared_ring(self):
+        ring = SharedFrameRing(size=2)
+        reader = SharedFrameRing(size=2, name=ring.name)
+        try:
+            index, buffer = ring.acquire()
+            buffer[:] = 3.0
+            ring.commit(index, 45.0, timestamp=1.0)
+            frame, *metadata = reader.record(reader.latest())
+            self.assertEqual(metadata, [0, 1.0, 45.0])
+            self.assertTrue(np.all(frame == 3.0))
+            del frame, buffer
+        finally:
+            reader.close()
+            ring.close()
+
+
+class TestFrameCache(unittest.TestCase):
+    def setUp(self):
+        self.position = 0.0
+        self.reads = 0
+
+        ring = FrameRing(size=4)
+
+        def read(camera):
+            self.reads += 1
+            index, buffer = ring.acquire()
+            time.sleep(0.05)
+            buffer[:] = self.reads
+            ring.commit(index, self.position)
+            return ring.record(index)
+
+        self.cache = FrameCache({"camera0": ring}, read, lambda: self.position, ttl=10.0)
+
+    def test_concurrent_readers_share_a_read(self):
+        records = []
+        threads = [threading.Thread(target=lambda: records.append(self.cache.get("camera0"))) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.reads, 1)
+        self.assertEqual({record.sequence for record in records}, {0})
+        self.assertEqual(self.cache.stats()["camera0"], {"reads": 1, "hits": 7})
+
+    def test_freshness(self):
+        first = self.cache.get("camera0")
+        self.assertEqual(self.cache.get("camera0").sequence, first.sequence)
+        self.assertEqual(self.cache.get("camera0", newer_than=first.sequence).sequence, 1)
+        self.assertEqual(self.cache.next("camera0").sequence, 2)
+        # Frames taken at another position are not served
+        self.position = 10.0
+        record = self.cache.get("camera0")
+        self.assertEqual((record.sequence, record.position), (3, 10.0))
+        self.assertEqual(self.reads, 4)
+
+
+class TestTemporalFilter(unittest.TestCase):
+    def test_modes(self):
+        frames = np.random.default_rng(0).normal(25, 1, (10, 24 * 32)).astype(np.float32)
+        expected = {
+            "mean": frames[-4:].mean(axis=0),
+            "median": np.median(frames[-4:], axis=0),
+            "none": frames[-1],
+        }
+        for mode, frame in expected.items():
+            frame_filter = TemporalFilter(mode, length=4)
+            for sequence, raw in enumerate(frames):
+                output = frame_filter.update(raw, 0.0, sequence)
+            np.testing.assert_allclose(output, frame, atol=1e-4)
+        frame_filter = TemporalFilter("ema", alpha=0.5)
+        frame_filter.update(frames[0], 0.0)
+        np.testing.assert_allclose(frame_filter.update(frames[1], 0.0), (frames[0] + frames[1]) / 2, atol=1e-5)
+
+    def test_reset(self):
+        frame_filter = TemporalFilter("mean", length=2)
+        frame_filter.update(np.zeros(768), 0.0, sequence=0)
+        frame_filter.update(np.ones(768), 0.0, sequence=1)
+        # The same frame is not added twice
+        frame_filter.update(np.ones(768), 0.0, sequence=1)
+        self.assertTrue(frame_filter.settled)
+        np.testing.assert_allclose(frame_filter.output, 0.5)
+        # Moving resets the filter
+        np.testing.assert_allclose(frame_filter.update(np.full(768, 3.0), 5.0, sequence=2), 3.0)
+        self.assertEqual(frame_filter.count, 1)
+        # A frame read during a move is passed through, without reset
+        np.testing.assert_allclose(frame_filter.update(np.full(768, 9.0), np.nan, sequence=3), 9.0)
+        self.assertEqual((frame_filter.count, frame_filter.position), (1, 5.0))
+
+
+class TestPixelPipeline(unittest.TestCase):
+    def test_orientation(self):
+        frame = np.arange(768, dtype=np.float32)
+        np.testing.assert_array_equal(PixelPipeline().orient(frame), oriented_pixel_index())
+        np.testing.assert_array_equal(
+            PixelPipeline(crop=[1, 5, 2, 4]).orient(frame), np.flip(np.rot90(frame.reshape(24, 32)), 0)[1:5, 2:4]
+        )
+        np.testing.assert_array_equal(PixelPipeline(rotations=0, flip_axis=None).orient(frame), frame.reshape(24, 32))
+
+    def test_correction(self):
+        # Pixels 33 and 34 are neighbours, 0 is in a corner
+        pipeline = PixelPipeline(bad_pixels=[0, 33, 34], gain=np.full(768, 2.0), offset=np.ones(768))
+        frame = np.arange(768, dtype=np.float32)
+        frame[33] = np.nan
+        expected = 2 * np.arange(768, dtype=np.float32) + 1
+        expected[0] = (expected[1] + expected[32]) / 2
+        expected[33] = (expected[1] + expected[65] + expected[32]) / 3
+        expected[34] = (expected[2] + expected[66] + expected[35]) / 3
+        np.testing.assert_allclose(pipeline.correct(frame), expected, rtol=1e-6)
+        # The pixels bad for the driver or failed are left as they are and not used
+        frame = np.arange(768, dtype=np.float32)
+        frame[[2, 66]] = -273.15, np.inf
+        frame[1] = frame[32] = np.nan
+        expected = 2 * np.arange(768, dtype=np.float32) + 1
+        expected[[2, 66]] = -273.15, np.inf
+        expected[1] = expected[32] = np.nan
+        expected[0] = np.nan
+        expected[34] = expected[35]
+        expected[33] = expected[65]
+        np.testing.assert_allclose(pipeline.correct(frame), expected, rtol=1e-6)
+
+
+class TestFrameFormat(unittest.TestCase):
+    def test_round_trip(self):
+        frame = np.linspace(-20, 300, 768, dtype=np.float32)
+        frame[5] = -273.15
+        stats = {
+            "min_temperature": -20.0,
+            "max_temperature": 300.0,
+            "percentile05_temperature": -4.0,
+            "percentile95_temperature": 284.0,
+        }
+        for fmt, atol in (("json", 0), ("float32", 0), ("uint16", 0.006)):
+            payload = encode_frame(frame, "camera3", 92.5, 1700000000.25, 42, stats, fmt)
+            message = decode_frame(payload.encode() if fmt == "json" else payload, camera=3)
+            self.assertEqual(message.camera, 3)
+            self.assertEqual(message.position, 92.5)
+            self.assertEqual(message.timestamp, 1700000000.25)
+            self.assertEqual(message.sequence, 42)
+            self.assertEqual(message.max_temperature, 300.0)
+            np.testing.assert_allclose(message.image, frame, atol=atol, rtol=0)
+        self.assertEqual(len(encode_frame(frame, "camera3", 0, 0, 0, stats, "uint16")), 40 + 2 * 768)
+        self.assertEqual(set(FORMATS), {"json", "float32", "uint16"})
+
+    def test_bundle(self):
+        frames = np.random.default_rng(0).normal(25, 2, (3, 768)).astype(np.float32)
+        stats = {"min_temperature": 20.0, "max_temperature": 30.0, "percentile05_temperature": 21.0, "percentile95_temperature": 29.0}
+        messages = [(f"camera{i}", encode_frame(frame, f"camera{i}", 0.0, 0.0, i, stats, "float32")) for i, frame in enumerate(frames)]
+        messages.append(("camera3", encode_frame(frames[0], "camera3", 0.0, 0.0, 3, stats, "json")))
+        bundle = decode_bundle(encode_bundle(messages))
+        self.assertEqual([camera for camera, _ in bundle], [0, 1, 2, 3])
+        for (camera, payload), frame in zip(bundle, [*frames, frames[0]]):
+            message = decode_frame(payload, camera=camera)
+            self.assertEqual(message.sequence, camera)
+            np.testing.assert_array_equal(message.image, frame)
+        with self.assertRaises(ValueError):
+            decode_bundle(b"XX" + encode_bundle(messages)[2:])
+
+
+class TestFrameStatistics(unittest.TestCase):
+    def test_batch(self):
+        frames = np.random.default_rng(1).normal(30, 5, (3, 768)).astype(np.float32)
+        frames[2, 100] = 90.0
+        statistics = FrameStatistics(percentiles=(1, 50, 99.5), bins=10, histogram_range=(0, 100))
+        stats = statistics.compute(list(frames))
+        np.testing.assert_allclose(stats["percentiles"], np.percentile(frames, statistics.percentiles, axis=1).T, atol=1e-4)
+        np.testing.assert_array_equal(stats["min"], frames.min(axis=1))
+        np.testing.assert_allclose(stats["std"], frames.std(axis=1), rtol=1e-5)
+        np.testing.assert_array_equal(stats["histogram"], [np.histogram(f, 10, (0, 100))[0] for f in frames])
+        header = statistics.header(stats, 1)
+        self.assertAlmostEqual(header["percentile95_temperature"], np.percentile(frames[1], 95), places=4)
+        record = statistics.record(stats, ["camera0", "camera1", "camera2"], 1.0, [0.0, 0.0, 0.0])
+        self.assertEqual(set(record["percentiles"]), {"1", "50", "99.5"})
+        self.assertEqual((record["hotspot"]["row"][2], record["hotspot"]["column"][2]), (3, 4))
+        self.assertEqual(record["max"][2], 90.0)
+        json.dumps(record)
+
+
+class TestAlarmEngine(unittest.TestCase):
+    def frame(self, hot=None, temperature=60.0):
+        frame = np.full(768, 25.0, dtype=np.float32)
+        if hot is not None:
+            frame[hot] = temperature
+        return frame
+
+    def test_threshold_hysteresis_and_hold(self):
+        engine = AlarmEngine([{"name": "hot", "camera": "camera1", "threshold": 50, "hysteresis": 5, "hold": 1.0}])
+        events = []
+        engine.publish = events.append
+        hot = self.frame(hot=300)
+        self.assertEqual(engine.evaluate("camera0", hot, 0.0, 0.0), [])
+        self.assertEqual(engine.evaluate("camera1", hot, 0.0, 0.0), [])
+        [event] = engine.evaluate("camera1", hot, 0.0, 1.5)
+        self.assertEqual((event["state"], event["value"]), ("raised", 60.0))
+        # Pixel 300 is at row 12, column 9 of the upright image
+        self.assertEqual((event["row"], event["column"]), (12, 9))
+        self.assertEqual(engine.active(), [("hot", "camera1")])
+        # Within the hysteresis, then cleared after the hold time
+        self.assertEqual(engine.evaluate("camera1", self.frame(300, 47.0), 0.0, 2.0), [])
+        self.assertEqual(engine.evaluate("camera1", self.frame(), 0.0, 3.0), [])
+        self.assertEqual(engine.evaluate("camera1", self.frame(), 0.0, 4.0)[0]["state"], "cleared")
+        self.assertEqual([event["state"] for event in events], ["raised", "cleared"])
+
+    def test_region_sector_and_rate(self):
+        rules = [
+            {"name": "corner", "region": [0, 4, 0, 4], "threshold": 50},
+            {"name": "sector", "sector": [350, 10], "threshold": 50},
+            {"name": "rise", "rate": 2.0},
+        ]
+        engine = AlarmEngine(rules)
+        # Pixel 300 is outside the corner, camera0 at 0 degrees looks at the sector
+        raised = {event["rule"] for event in engine.evaluate("camera0", self.frame(300), 0.0, 0.0)}
+        self.assertEqual(raised, {"sector"})
+        self.assertEqual(engine.evaluate("camera2", self.frame(), 0.0, 0.0), [])
+        raised = {event["rule"] for event in engine.evaluate("camera2", self.frame(300), 0.0, 1.0)}
+        self.assertEqual(raised, {"rise"})
+        # camera2 looks at the sector after a half turn, the rate is not compared across positions
+        raised = {event["rule"] for event in engine.evaluate("camera2", self.frame(300), 180.0, 2.0)}
+        self.assertEqual(raised, {"sector"})
+        # Without position, the sector and the rate are not evaluated
+        self.assertEqual(engine.evaluate("camera0", self.frame(), np.nan, 3.0), [])
+        self.assertEqual(engine.evaluate("camera0", self.frame(300, 1000.0), np.nan, 4.0), [])
+
+
+class TestChangeDetector(unittest.TestCase):
+    def record(self, frame, sequence):
+        return FrameRecord(frame.astype(np.float32), sequence, float(sequence), 0.0)
+
+    def test_threshold_and_delta(self):
+        stats = dict.fromkeys(
+            ["min_temperature", "max_temperature", "percentile05_temperature", "percentile95_temperature"], 0.0
+        )
+        detector = ChangeDetector(threshold=0.5, delta=True, keyframe_interval=10.0, step=0.05)
+        decoder = FrameDecoder()
+        frame = np.full(768, 25.0)
+        payloads = [detector.encode("camera1", self.record(frame, 0), stats, "float32")]
+        # Unchanged frame
+        self.assertIsNone(detector.encode("camera1", self.record(frame + 0.1, 1), stats, "float32"))
+        frame[10] = 30.0
+        payloads.append(detector.encode("camera1", self.record(frame, 2), stats, "float32"))
+        self.assertLess(len(payloads[1]), len(payloads[0]) / 10)
+        # A delta frame without its keyframe is skipped
+        self.assertIsNone(FrameDecoder().decode(payloads[1]))
+        # A full frame replying to get_frame does not replace the keyframe of the stream
+        reply = encode_frame((frame + 5).astype(np.float32), "camera1", 0.0, 1.0, 1, stats, "float32")
+        messages = [decoder.decode(payload) for payload in [payloads[0], reply, payloads[1]]]
+        np.testing.assert_allclose(messages[2].image, frame, atol=0.025)
+        # Periodic keyframe
+        payloads.append(detector.encode("camera1", self.record(frame, 12), stats, "float32"))
+        self.assertEqual(len(payloads[2]), len(payloads[0]))
+        self.assertEqual(
+            detector.stats(), {"keyframes": 2, "deltas": 1, "unchanged": 1, "bytes": sum(map(len, payloads))}
+        )
+
+
+class TestPanoramaStitcher(unittest.TestCase):
+    def setUp(self):
+        self.stitcher = PanoramaStitcher(layout={"camera0": (0.0, 0.0)}, resolution=1.0)
+
+    def test_weighted_mean(self):
+        frame = np.full((768,), 20.0, dtype=np.float32)
+        frame[7] = -273.15
+        self.stitcher.add_frame("camera0", frame, 90.0)
+        frame[frame > -273] = 30.0
+        self.stitcher.add_frame("camera0", frame, 90.0)
+        # Read during a move, not added
+        self.stitcher.add_frame("camera0", frame + 100, np.nan)
+        panorama = self.stitcher.panorama()
+        self.assertEqual(panorama.shape, self.stitcher.shape)
+        seen = ~np.isnan(panorama)
+        self.assertTrue(seen[self.stitcher.shape[0] // 2, 90])
+        np.testing.assert_allclose(panorama[seen], 25.0, rtol=1e-6)
+        self.assertFalse(np.any(seen[:, 180]))
+
+    def test_changed_regions(self):
+        frame = np.full((768,), 20.0, dtype=np.float32)
+        self.stitcher.add_frame("camera0", frame, 0.0)
+        regions = self.stitcher.changed_regions()
+        # The footprint crosses the 360 degrees boundary
+        self.assertEqual(len(regions), 2)
+        self.assertEqual(regions[0][1], 0)
+        self.assertEqual(regions[1][1] + regions[1][2].shape[1], 360)
+        self.assertEqual(regions[1][1], 360 - regions[0][2].shape[1] + 1)
+        self.assertEqual(self.stitcher.changed_regions(), [])
+
+
+class TestFrameArchive(unittest.TestCase):
+    def test_query(self):
+        with tempfile.TemporaryDirectory() as directory:
+            writer = FrameArchiveWriter(directory, chunk_frames=5)
+            for i in range(12):
+                frame = np.full((768,), i, dtype=np.float32)
+                writer.append(f"camera{i % 2}", frame, 1000.0 + i, (i * 40) % 360, i)
+            writer.close()
+            # Partially written frame after a crash
+            with open(f"{directory}/frames_000002.f32", "ab") as f:
+                f.write(b"\0" * 100)
+            archive = FrameArchive(directory)
+            self.assertEqual(len(archive.chunks()), 3)
+            records, frames = archive.query()
+            self.assertEqual(len(records), 12)
+            np.testing.assert_array_equal(frames[:, 0], np.arange(12))
+            records, frames = archive.query(camera="camera1", start=1003.0, stop=1009.0)
+            np.testing.assert_array_equal(records["sequence"], [3, 5, 7])
+            np.testing.assert_array_equal(frames[:, -1], [3, 5, 7])
+            # Range wrapping around 0 degrees: positions 320, 0 and 40
+            records, _ = archive.query(min_position=300, max_position=40)
+            np.testing.assert_array_equal(records["sequence"], [0, 1, 8, 9, 10])
+            records, _ = archive.query(camera=3)
+            self.assertEqual(len(records), 0)
+
+    def test_concurrent_writers(self):
+        with tempfile.TemporaryDirectory() as directory:
+            writer = FrameArchiveWriter(directory, chunk_frames=7)
+
+            def append(camera):
+                for i in range(200):
+                    writer.append(camera, np.full((768,), camera * 1000 + i, dtype=np.float32), 1000.0 + i, 0.0, i)
+
+            threads = [threading.Thread(target=append, args=(camera,)) for camera in range(2)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            writer.close()
+            writer.append(0, np.zeros(768, dtype=np.float32), 0.0, 0.0)
+            records, frames = FrameArchive(directory).query()
+            self.assertEqual(len(records), 400)
+            # Each index record labels its own frame
+            np.testing.assert_array_equal(frames[:, 0], records["camera"] * 1000.0 + records["sequence"])
+
+
+class TestStatisticsStore(unittest.TestCase):
+    @staticmethod
+    def stats(value):
+        return {
+            "min_temperature": value - 5,
+            "max_temperature": value + 5,
+            "percentile05_temperature": value - 4,
+            "percentile95_temperature": value + 4,
+        }
+
+    def test_rollups(self):
+        start = time.time() // 3600 * 3600 - 2 * 3600
+        with tempfile.TemporaryDirectory() as directory:
+            store = StatisticsStore(directory)
+            # Two hours of one frame per camera and second, at 10 positions
+            for i in range(7200):
+                for camera in ("camera0", "camera1"):
+                    store.add(camera, start + i, 10.0 * (i % 10), self.stats(20.0 + (i % 100) / 10 + (camera == "camera1")))
+            store.add("camera0", start + 7200, float("nan"), self.stats(50.0))
+            resolution, rows = store.query("camera0", start, start + 60)
+            self.assertEqual(resolution, 1)
+            self.assertEqual(len(rows), 60)
+            self.assertEqual(rows["count"].tolist(), [1] * 60)
+            resolution, rows = store.query(start=start, stop=start + 7200)
+            self.assertEqual((resolution, len(rows)), (60, 240))
+            np.testing.assert_allclose(rows["count"], 60)
+            _, rows = store.query("camera1", start, start + 60, resolution=1, positions=True)
+            self.assertEqual(rows["position"][:3].tolist(), [0.0, 10.0, 20.0])
+            store.rows_read = 0
+            resolution, rows = store.summary(start=start, stop=start + 7201, max_points=10)
+            self.assertEqual(resolution, 3600)
+            # Only the hour rows of the two cameras and ten positions are read
+            self.assertLessEqual(store.rows_read, 40)
+            self.assertEqual(rows["count"].tolist(), [7201, 7200])
+            np.testing.assert_allclose(rows["max"], [55.0, 35.9], rtol=1e-6)
+            np.testing.assert_allclose(rows["p05"][1], 25.95 - 4, rtol=1e-6)
+            store.close()
+            # The bucket written again after a restart is merged
+            store = StatisticsStore(directory)
+            store.add("camera0", start + 7200.5, float("nan"), self.stats(10.0))
+            store.close()
+            _, rows = store.query("camera0", start + 7200, resolution=1)
+            self.assertEqual((len(rows), rows["count"][0], rows["min"][0]), (1, 2, 5.0))
+
+    def test_writers(self):
+        start = time.time() // 3600 * 3600 - 5 * 3600
+        with tempfile.TemporaryDirectory() as directory:
+            first, second = StatisticsStore(directory), StatisticsStore(directory)
+            second.add("camera1", start + 10, 0.0, self.stats(94.0))
+            for hour in range(1, 5):
+                first.add("camera1", start + hour * 3600, 0.0, self.stats(20.0))
+            first.close()
+            # Written after the newer hours of the other writer
+            second.close()
+            _, rows = first.query("camera1", start, start + 3600, resolution=3600)
+            self.assertEqual((len(rows), rows["max"][0]), (1, 99.0))
+            # A late frame of a written bucket keeps the rows of the file in order
+            first = StatisticsStore(directory)
+            first.add("camera0", start + 7200, 0.0, self.stats(20.0))
+            first.flush(start + 3 * 3600)
+            first.add("camera0", start + 3600, 0.0, self.stats(30.0))
+            first.close()
+            _, rows = first.query("camera0", start, resolution=3600)
+            self.assertEqual(rows["time"].tolist(), [start + 7200])
+            self.assertEqual(rows["count"].tolist(), [2])
+
+    def test_retention(self):
+        now = time.time()
+        with tempfile.TemporaryDirectory() as directory:
+            store = StatisticsStore(directory, retention={1: 3600, 60: None, 3600: None})
+            for t in (now - 3 * 86400, now - 86400):
+                store.add("camera0", t, 0.0, self.stats(20.0))
+            store.close()
+            store.expire()
+            self.assertEqual(len(store.query(start=now - 4 * 86400, resolution=1)[1]), 0)
+            self.assertEqual(len(store.query(start=now - 4 * 86400, resolution=60)[1]), 2)
+
+
+class TestPositionJournal(unittest.TestCase):
+    def test_batching_and_recovery(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = f"{directory}/absolute_position.csv"
+            journal = PositionJournal(path, interval=60)
+            self.assertIsNone(journal.last_position())
+            for i in range(1, 2001):
+                journal.record(i * 0.18)
+            # Nothing is written before the interval or the durability point
+            self.assertIsNone(journal.last_position())
+            journal.sync()
+            self.assertAlmostEqual(journal.last_position(), 360.0)
+            # Line truncated by a crash
+            with open(path, "a") as f:
+                f.write("2024-01-01 00:00:00,12")
+            self.assertAlmostEqual(PositionJournal(path).last_position(), 360.0)
+            journal.close()
+
+    def test_compaction(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = f"{directory}/absolute_position.csv"
+            journal = PositionJournal(path, interval=0, max_bytes=1024)
+            for i in range(1, 2001):
+                journal.record(i * 0.18)
+            journal.close()
+            self.assertLessEqual(os.path.getsize(path), 1024 + 64)
+            self.assertAlmostEqual(PositionJournal(path).last_position(), 360.0)
+
+
+class TestMotion(unittest.TestCase):
+    def test_step_schedule(self):
+        np.testing.assert_allclose(step_schedule(4, 250, profile="constant"), [0, 0.004, 0.008, 0.012, 0.016])
+        for profile in ["trapezoidal", "s-curve"]:
+            times = step_schedule(500, 500, 125, 2000, profile)
+            periods = np.diff(times)
+            self.assertEqual(len(times), 501)
+            self.assertTrue(np.all(periods > 0))
+            self.assertAlmostEqual(periods.min(), 1 / 500)
+            self.assertLessEqual(periods.max(), 1 / 125)
+            # Symmetric ramps
+            np.testing.assert_allclose(periods, periods[::-1])
+        # Too short to reach the maximum speed
+        self.assertGreater(np.diff(step_schedule(10, 500, 125, 2000)).min(), 1 / 500)
+        with self.assertRaises(ValueError):
+            step_schedule(10, 500, 125)
+
+    def test_shortest_path(self):
+        self.assertAlmostEqual(shortest_path(350, 10), -340)
+        self.assertAlmostEqual(shortest_path(350, 10, wrap=True), 20)
+        self.assertAlmostEqual(shortest_path(10, 350, wrap=True), -20)
+        self.assertAlmostEqual(shortest_path(720, 0, wrap=True), 0)
+        plan = plan_move(-90, 0.18, 250)
+        self.assertEqual((plan.steps, plan.direction), (500, "bw"))
+        self.assertAlmostEqual(plan.planned_time, 2.0)
+
+    def test_execute(self):
+        # Simulated clock, each step taking 3 ms
+        now = [0.0]
+        steps = []
+
+        def sleep(duration):
+            now[0] += duration
+
+        def step():
+            steps.append(now[0])
+            now[0] += 0.003
+
+        report = execute(plan_move(0.9, 0.18, 250), step, clock=lambda: now[0], sleep=sleep)
+        np.testing.assert_allclose(steps, [0, 0.004, 0.008, 0.012, 0.016])
+        self.assertAlmostEqual(report.actual_time, 0.02)
+        self.assertAlmostEqual(report.max_lateness, 0)
+
+
+class TestHoming(unittest.TestCase):
+    def setUp(self):
+        self.now = [0.0]
+        self.clock = lambda: self.now[0]
+
+    def sleep(self, duration):
+        self.now[0] += duration
+
+    def home(self, switch, max_steps=1000):
+        return home(
+            lambda: switch.step(-0.18),
+            lambda: switch.step(0.18),
+            switch,
+            max_steps,
+            fast_rate=500,
+            slow_rate=50,
+            backoff_steps=12,
+            start_rate=125,
+            acceleration=1000,
+            clock=self.clock,
+            sleep=self.sleep,
+        )
+
+    def test_home(self):
+        for angle in [90.0, 1.0, -1.0]:
+            switch = SimulatedHomeSwitch(angle=angle, jitter=0, latency=0.005, clock=self.clock)
+            report = self.home(switch)
+            self.assertTrue(report.found)
+            # The fast approach overshoots, the slow one is within one step
+            self.assertLessEqual(abs(switch.angle), 0.18 + 1e-9)
+            self.assertTrue(switch.pressed())
+
+    def test_not_found(self):
+        switch = SimulatedHomeSwitch(angle=90.0, clock=self.clock)
+        report = self.home(switch, max_steps=100)
+        self.assertFalse(report.found)
+        self.assertEqual(report.fast_steps, 100)
+
+
+class TestPipeline(unittest.TestCase):
+    def test_order_and_timing(self):
+        results = []
+        pipeline = Pipeline(
+            lambda: range(20),
+            [("square", lambda x: x * x), ("odd", lambda x: x if x % 2 else None), ("collect", results.append)],
+            maxsize=1,
+        )
+        pipeline.start()
+        self.assertTrue(pipeline.join(timeout=5))
+        self.assertEqual(results, [x * x for x in range(1, 20, 2)])
+        summary = pipeline.timer.summary()
+        self.assertEqual(summary["square"]["items"], 20)
+        self.assertEqual(summary["collect"]["items"], 10)
+
+    def test_stop_and_failure(self):
+        def source():
+            while True:
+                yield 1
+
+        pipeline = Pipeline(source, [("fail", lambda x: 1 / 0)])
+        pipeline.start()
+        self.assertTrue(pipeline.join(timeout=5))
+        pipeline = Pipeline(source, [("sleep", lambda x: time.sleep(0.001))])
+        pipeline.start()
+        pipeline.stop()
+        self.assertTrue(pipeline.join(timeout=5))
+
+
+class TestStreamScheduler(unittest.TestCase):
+    def stream(self, client, acquire=lambda camera: camera, **kwargs):
+        scheduler = StreamScheduler(
+            ["camera0", "camera1"], acquire, lambda camera, record: client.publish(camera, record), **kwargs
+        )
+        scheduler.start()
+        time.sleep(0.3)
+        scheduler.stop()
+        return scheduler
+
+    def test_rate(self):
+        client = RecordingMQTTClient()
+        scheduler = self.stream(client, rate=50)
+        # 2 cameras at 50 Hz for 0.3 s
+        self.assertGreater(scheduler.published, 20)
+        self.assertLess(scheduler.published, 40)
+        self.assertEqual(scheduler.dropped, 0)
+
+    def test_backpressure(self):
+        client = RecordingMQTTClient(messages_per_s=10)
+        scheduler = self.stream(client, rate=50, max_inflight=2)
+        self.assertGreater(scheduler.dropped, 0)
+        self.assertLessEqual(scheduler.published, 6)
+
+    def test_pause_and_errors(self):
+        client = RecordingMQTTClient()
+        scheduler = StreamScheduler(["camera0"], lambda camera: 1 / 0, client.publish, rate=100)
+        scheduler.start()
+        time.sleep(0.1)
+        scheduler.pause()
+        errors = scheduler.errors["acquisition"]
+        self.assertGreater(errors, 0)
+        time.sleep(0.1)
+        self.assertLessEqual(scheduler.errors["acquisition"], errors + 1)
+        scheduler.stop()
+        self.assertEqual(scheduler.published, 0)
+        self.assertIn("division by zero", scheduler.stats()["last_error"])
+
+
+class TestMQTTPublisher(unittest.TestCase):
+    def wait(self, condition, timeout=5):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                self.fail("Condition not met in time")
+            time.sleep(0.01)
+
+    def test_reconnect_and_buffer(self):
+        broker = SimulatedBroker()
+        publisher = MQTTPublisher(mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, "test"), buffer=3, min_delay=0.05, max_delay=0.2)
+        try:
+            publisher.connect("127.0.0.1", broker.port)
+            self.wait(lambda: publisher.connected)
+            first = publisher.publish("/test", b"first")
+            self.wait(first.is_published)
+            self.wait(lambda: len(broker.messages) == 1)
+            broker.accepting = False
+            broker.drop()
+            self.wait(lambda: not publisher.connected)
+            alarm = publisher.publish("/alarm", b"alarm", qos=1)
+            state = publisher.publish("/state", b"state", retain=True)
+            messages = [publisher.publish("/test", str(i)) for i in range(5)]
+            self.assertTrue(all(message.is_published() for message in messages[:2]))
+            self.assertFalse(alarm.is_published() or state.is_published())
+            self.assertEqual(publisher.stats()["pending"], 5)
+            broker.accepting = True
+            self.wait(lambda: all(message.is_published() for message in [alarm, state, *messages]))
+            self.wait(lambda: len(broker.messages) == 6)
+            stats = publisher.stats()
+            self.assertEqual(stats["connections"], 2)
+            self.assertEqual((stats["published"], stats["sent"], stats["dropped"]), (8, 6, 2))
+        finally:
+            publisher.disconnect()
+            publisher.loop_stop()
+            broker.close()
+
+    def test_offline_bounded(self):
+        publisher = MQTTPublisher(mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, "test"), buffer=3, kept=10)
+        states = [publisher.publish(f"/state{i % 2}", str(i), retain=True) for i in range(1000)]
+        self.assertTrue(all(state.is_published() for state in states[:-2]))
+        self.assertEqual(publisher.stats()["pending"], 2)
+        with self.assertLogs(level="WARNING"):
+            results = [publisher.publish("/result", str(i), qos=1) for i in range(20)]
+        stats = publisher.stats()
+        self.assertEqual((stats["pending"], stats["replaced"], stats["dropped"]), (10, 998, 12))
+        self.assertTrue(all(state.is_published() for state in states[-2:]))
+        self.assertFalse(any(result.is_published() for result in results[-10:]))
+
+
+class TestViewer(unittest.TestCase):
+    def test_newest_frames(self):
+        stats = {"min_temperature": 20.0, "max_temperature": 30.0, "percentile05_temperature": 21.0, "percentile95_temperature": 29.0}
+        frames = np.linspace(20, 30, 4 * 768, dtype=np.float32).reshape(4, 768)
+
+        def message(topic, payload):
+            return MagicMock(topic=topic, payload=payload)
+
+        receiver = FrameReceiver(maxsize=3)
+        for sequence in range(2):
+            receiver.on_message(None, None, message("/thermalcamera/camera1", encode_frame(frames[1], "camera1", 0, 0, sequence, stats)))
+        bundle = encode_bundle([(f"camera{i}", encode_frame(frames[i], f"camera{i}", 0, 0, 5, stats, "uint16")) for i in (0, 2)])
+        receiver.on_message(None, None, message("/thermalcamera/frames", bundle))
+        receiver.on_message(None, None, message("/thermalcamera/stats", b"{}"))
+        # Pushes the first two messages out of the queue
+        receiver.on_message(None, None, message("/thermalcamera/camera1", encode_frame(frames[1], "camera1", 0, 0, 2, stats)))
+        receiver.start()
+        deadline = time.monotonic() + 5
+        while receiver.stats()["decoded"] < 3 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        receiver.stop()
+        viewer = FrameViewer(receiver, cameras=4)
+        taken = receiver.take()
+        self.assertEqual(sorted(taken), [0, 1, 2])
+        self.assertEqual(taken[1].sequence, 2)
+        self.assertEqual(receiver.stats(), {"received": 5, "decoded": 3, "dropped": 2, "taken": 3, "errors": 0, "pending": 0})
+        receiver._frames = taken
+        self.assertTrue(viewer.update())
+        self.assertEqual(viewer.rendered, 3)
+        np.testing.assert_array_equal(viewer.colors(np.array([10.0, 20.0, 30.0, np.nan]), 20, 30), viewer.lut[[0, 0, 255, 0]])
+        upright = np.flip(np.rot90(frames[1].reshape(24, 32)), axis=0)
+        np.testing.assert_array_equal(viewer.images[1].get_array(), viewer.colors(upright, 20, 30))
+        viewer.fig.canvas.draw()
+        viewer.draw()
+
+
+class TestRecording(unittest.TestCase):
+    def test_record_and_replay(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "scan.rec")
+            recorder = StreamRecorder(path)
+            recorder.record("/thermalcamera/camera0", b"frame0", timestamp=100.0)
+            recorder.record("/thermalcamera/cmd/go_to", "{}", timestamp=100.1)
+            recorder.record("/thermalcamera/state", "{}", qos=1, retain=True, timestamp=100.2)
+            recorder.close()
+            # Appends to the recording, then crashes in the middle of a message
+            recorder = StreamRecorder(path)
+            recorder.record("/thermalcamera/camera0", b"frame1", timestamp=100.5)
+            recorder.record("/thermalcamera/camera1", b"frame2", timestamp=101.0)
+            recorder.close()
+            with open(path, "r+b") as f:
+                f.truncate(os.path.getsize(path) - 1)
+            messages = list(read_recording(path))
+            self.assertEqual([m.topic for m in messages], ["/thermalcamera/camera0", "/thermalcamera/state", "/thermalcamera/camera0"])
+            self.assertEqual((messages[1].qos, messages[1].retain), (1, True))
+            self.assertEqual(messages[2].payload, b"frame1")
+            recorder = StreamRecorder(path)
+            recorder.record("/thermalcamera/camera1", b"frame3", timestamp=101.0)
+            recorder.close()
+            self.assertEqual(list(read_recording(path))[-1].payload, b"frame3")
+
+            client = RecordingMQTTClient()
+            stats = StreamReplayer(path, client, speed=2.0).run()
+            self.assertEqual([payload for _, _, payload in client.messages], [b"frame0", b"{}", b"frame1", b"frame3"])
+            self.assertAlmostEqual(client.messages[-1][0] - client.messages[0][0], 0.5, delta=0.05)
+            self.assertEqual(stats["messages"], 4)
+            # Sent one after the other by the slow client
+            client = RecordingMQTTClient(messages_per_s=100)
+            stats = StreamReplayer(path, client, speed=None, max_inflight=1).run(topics=["/thermalcamera/camera"])
+            self.assertEqual(stats["messages"], 3)
+            self.assertGreater(stats["duration"], 0.015)
+
+
+class TestCommandExecutor(unittest.TestCase):
+    def setUp(self):
+        self.results = []
+        self.interrupt = threading.Event()
+        self.executor = CommandExecutor(self.results.append, {"motor": self.interrupt})
+
+    def tearDown(self):
+        self.executor.stop()
+
+    def finished(self, job_id):
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline:
+            for result in self.results:
+                if result["id"] == job_id and result["status"] != "accepted":
+                    return result
+            time.sleep(0.01)
+        self.fail(f"Command {job_id} not finished")
+
+    def test_serialization(self):
+        first = self.executor.submit("go_to", "motor", lambda payload: time.sleep(0.1), {})
+        second = self.executor.submit("go_to", "motor", lambda payload: time.sleep(0.1), {})
+        frame = self.executor.submit("get_frame", "camera", lambda payload: None, {}, job_id="frame")
+        self.assertEqual(frame, "frame")
+        self.assertLess(self.finished(frame)["queue_ms"], 50)
+        self.assertEqual(self.finished(first)["status"], "done")
+        self.assertGreater(self.finished(second)["queue_ms"], 90)
+        self.assertEqual(self.executor.metrics()["go_to"]["count"], 2)
+
+    def test_cancel_and_error(self):
+        running = self.executor.submit("go_to", "motor", lambda payload: self.interrupt.wait(5), {})
+        queued = self.executor.submit("rotate", "motor", lambda payload: self.fail("Cancelled command executed"), {})
+        failing = self.executor.submit("get_frame", "camera", lambda payload: 1 / 0, {})
+        self.assertTrue(self.executor.cancel(queued))
+        time.sleep(0.05)
+        self.assertTrue(self.executor.cancel())
+        self.assertEqual(self.finished(running)["status"], "cancelled")
+        self.assertEqual(self.finished(queued)["status"], "cancelled")
+        self.assertEqual(self.finished(failing)["status"], "error")
+        self.assertFalse(self.interrupt.is_set())
+
+    def test_api(self):
+        client = RecordingMQTTClient()
+        api = ThermalCameraAPI(backend="simulated")
+        api.start_executor(client)
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as directory:
+            os.chdir(directory)
+            try:
+                api.submit_command(client, "init", {"absolute_position": 0})
+                api.submit_command(client, "go_to", {"position": 90, "id": "move"})
+                api.submit_command(client, "unknown", {"id": "bad"})
+                api.executor.stop()
+                api.get_frames(client, {})
+                api.get_history(client, {"summary": True, "id": "history"})
+            finally:
+                os.chdir(cwd)
+        results = [json.loads(payload) for _, topic, payload in client.messages if topic == api.TOPIC_RESULT]
+        statuses = {(result["id"], result["status"]) for result in results}
+        self.assertIn(("move", "done"), statuses)
+        self.assertIn(("bad", "error"), statuses)
+        self.assertAlmostEqual(api.thermal_camera.absolute_position, 90)
+        history = [json.loads(payload) for _, topic, payload in client.messages if topic == api.TOPIC_HISTORY]
+        self.assertEqual(history[0]["id"], "history")
+        self.assertEqual(history[0]["count"], [1, 1, 1, 1])
+
+    def test_scan_holds_the_motor(self):
+        client = RecordingMQTTClient()
+        api = ThermalCameraAPI(backend="simulated")
+        api.start_executor(client)
+
+        def status(job_id):
+            deadline = time.monotonic() + 5
+            while time.monotonic() < deadline:
+                for _, topic, payload in list(client.messages):
+                    result = json.loads(payload) if topic == api.TOPIC_RESULT else {}
+                    if result.get("id") == job_id and result["status"] != "accepted":
+                        return result["status"]
+                time.sleep(0.01)
+            self.fail(f"Command {job_id} not finished")
+
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as directory:
+            os.chdir(directory)
+            try:
+                api.submit_command(client, "init", {"absolute_position": 0})
+                api.submit_command(client, "run", {"step": 1, "wait": 0, "archive": False, "id": "scan"})
+                api.submit_command(client, "go_to", {"position": 90, "id": "during"})
+                self.assertEqual(status("during"), "error")
+                with self.assertRaises(ValueError):
+                    api.init(client, {})
+                # Right after the cancel, executed once the scan finished its last position
+                api.submit_command(client, "cancel", {"target": "scan"})
+                api.submit_command(client, "go_to", {"position": 90, "id": "after"})
+                self.assertEqual(status("after"), "done")
+                self.assertFalse(api.run_thread.is_alive())
+                self.assertFalse(api.motion_interrupt.is_set())
+                api.stop_threads()
+            finally:
+                os.chdir(cwd)
+        self.assertAlmostEqual(api.thermal_camera.absolute_position, 90)
+
+    def test_stream_during_move(self):
+        client = RecordingMQTTClient()
+        api = ThermalCameraAPI(backend="simulated", acquisition="process")
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as directory:
+            os.chdir(directory)
+            try:
+                api.init(client, {"absolute_position": 0})
+                api.set_filter(client, {"mode": "mean", "length": 2})
+                api.send_images(client, rate=50, max_inflight=100)
+                # A move of 1 s in real time, the acquisition process reads frames during the whole move
+                api.thermal_camera.backend.clock = time.monotonic
+                api.thermal_camera.backend.sleep = time.sleep
+                api.go_to(client, {"position": 45})
+                published = api.stream_scheduler.published
+                deadline = time.monotonic() + 5
+                while api.stream_scheduler.published < published + 5:
+                    self.assertLess(time.monotonic(), deadline)
+                    time.sleep(0.01)
+                self.assertEqual(api.stream_scheduler.errors, {})
+            finally:
+                api.stop_threads()
+                api.thermal_camera.close()
+                os.chdir(cwd)
+        positions = [
+            json.loads(payload)["position"] for _, topic, payload in client.messages if topic.startswith(f"{api.TOPIC_ROOT}/camera")
+        ]
+        self.assertTrue(np.all(np.isfinite(positions)))
+
+    def test_init_while_streaming(self):
+        client = RecordingMQTTClient()
+        api = ThermalCameraAPI(backend="simulated", acquisition="process")
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as directory:
+            os.chdir(directory)
+            try:
+                api.init(client, {"absolute_position": 0})
+                api.send_images(client, rate=50, max_inflight=100)
+                for _ in range(2):
+                    published = api.stream_scheduler.published
+                    deadline = time.monotonic() + 5
+                    while api.stream_scheduler.published < published + 5:
+                        self.assertLess(time.monotonic(), deadline)
+                        time.sleep(0.01)
+                    # The frame rings of the acquisition process are freed under the stream
+                    api.init(client, {"absolute_position": 0})
+                self.assertFalse(api.stream_scheduler.paused)
+                self.assertEqual(api.stream_scheduler.errors, {})
+            finally:
+                api.stop_threads()
+                api.thermal_camera.close()
+                os.chdir(cwd)
+
+
+class TestFrameServer(unittest.TestCase):
+    def test_shared_acquisition(self):
+        acquired = []
+
+        def acquire(camera, sequence):
+            acquired.append(camera)
+            sequence = -1 if sequence is None else sequence
+            return FrameRecord(np.full(768, 20.0, dtype=np.float32), sequence + 1, time.time(), 0.0)
+
+        server = FrameServer(["camera0", "camera1"], acquire, rate=50)
+        streams = [server.updates(["camera1"], timeout=1.0) for _ in range(4)]
+        server.start()
+        try:
+            snapshots = [[next(stream) for _ in range(3)] for stream in streams]
+            self.assertEqual(server.clients, 4)
+            latest = server.latest("camera0")
+            self.assertEqual(decode_frame(latest.payload).sequence, latest.sequence)
+            self.assertNotEqual(server.wait("camera0", latest.etag, timeout=1.0).etag, latest.etag)
+        finally:
+            server.stop()
+        for stream, received in zip(streams, snapshots):
+            self.assertEqual([s.camera for s in received], ["camera1"] * 3)
+            self.assertEqual(len({s.etag for s in received}), 3)
+            # The stream ends with the server
+            self.assertEqual(list(stream), [])
+        # One acquisition per camera and cycle, whatever the clients
+        self.assertLessEqual(abs(acquired.count("camera0") - server.cycles), 1)
+        self.assertEqual(server.clients, 0)
+
+
+class TestRestApp(unittest.TestCase):
+    def test_frames_and_jobs(self):
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as directory:
+            os.chdir(directory)
+            try:
+                app = create_app(ThermalCamera(absolute_position=0), rate=20, max_streams=1)
+                client = app.test_client()
+                app.extensions["frame_server"].wait("camera0", timeout=5.0)
+                response = client.get("/frames/camera0")
+                self.assertEqual(response.status_code, 200)
+                etag = response.headers["ETag"]
+                self.assertEqual(client.get("/frames/camera0", headers={"If-None-Match": etag}).status_code, 304)
+                response = client.get("/frames/camera0?wait=5", headers={"If-None-Match": etag})
+                self.assertEqual(response.status_code, 200)
+                self.assertNotEqual(response.headers["ETag"], etag)
+                self.assertEqual(client.get("/frames/camera9").status_code, 404)
+                response = client.post("/move", json={"position": 90})
+                self.assertEqual(response.status_code, 202)
+                app.extensions["executor"].stop()
+                self.assertEqual(client.get(response.headers["Location"]).json["status"], "done")
+                self.assertAlmostEqual(client.get("/state").json["absolute_position"], 90)
+                self.assertEqual(client.post("/move", json={}).status_code, 400)
+                app.extensions["history"].flush(time.time() + 1)
+                history = client.get("/history?camera=camera0&start=-60&summary=1").json
+                self.assertEqual(history["camera"], [0])
+                self.assertGreater(history["count"][0], 0)
+                stream = client.get("/stream?cameras=camera1")
+                self.assertEqual(stream.status_code, 200)
+                self.assertIn(b"X-Camera: camera1", next(stream.response))
+                self.assertEqual(client.get("/stream").status_code, 503)
+                self.assertEqual(client.get("/stream?cameras=camera9").status_code, 503)
+                stream.close()
+                self.assertEqual(client.get("/stream?cameras=camera9").status_code, 404)
+                stream = client.get("/stream")
+                self.assertEqual(stream.status_code, 200)
+                stream.close()
+            finally:
+                app.extensions["frame_server"].stop()
+                os.chdir(cwd)
+
+
+class TestEndToEnd(unittest.TestCase):
+    def test_scan(self):
+        results = benchmark_end_to_end(duration=0.5, backend="simulated")
+        self.assertGreater(results["frames_per_s"], 0)
+        self.assertGreater(results["latency_ms"]["max"], 0)
+        self.assertEqual(set(results["stages"]), {"scan", "motion", "acquisition", "processing", "publishing"})
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -1,17 +1,29 @@
 """Thermal camera system basic operations."""
 
 import os
+import json
+import functools
 import time
+import zlib
 import logging
-import struct
-import board
-import busio
+import tempfile
+import threading
+from collections import namedtuple
+from collections.abc import Mapping
+import concurrent.futures
 import numpy as np
 from matplotlib import pyplot as plt
 import adafruit_mlx90640
+from adafruit_bus_device.i2c_device import I2CDevice
 from adafruit_motor import stepper
-from adafruit_motorkit import MotorKit
-import RPi.GPIO as GPIO
+
+from acquisition import AcquisitionProcess
+from hardware import SWITCH_PIN, create_backend
+from denoising import TemporalFilter
+from homing import EdgeSwitch, home
+from motion import execute, plan_move, shortest_path
+from pixel_pipeline import load_pixel_pipelines
+from position_journal import PositionJournal
 
 # Set up logging
 logging.basicConfig(
@@ -20,6 +32,676 @@ logging.basicConfig(
 )
 
 
+# The Adafruit driver extracts the calibration parameters from a module-level
+# EEPROM buffer, so the extraction of different cameras must not overlap.
+_EEPROM_LOCK = threading.Lock()
+
+CALIBRATION_CACHE = "mlx90640_calibration"
+
+
+def create_camera(backend, address, engine="numpy", cache_dir=CALIBRATION_CACHE):
+    """Create the driver of a thermal camera.
+
+    Parameters
+    ----------
+    backend : object
+        Hardware backend, see ``hardware.create_backend``.
+    address : int
+        Address of the camera.
+    engine : str
+        Temperature calculation engine, one of ``ThermalCamera.ENGINES``.
+    cache_dir : str
+        Directory of the calibration cache of the ``numpy`` engine.
+
+    Returns
+    -------
+    camera : adafruit_mlx90640.MLX90640
+        Camera driver.
+    """
+    i2c = backend.camera_bus()
+    if engine == "numpy":
+        camera = FastMLX90640(i2c, address=address, cache_dir=cache_dir)
+    else:
+        with _EEPROM_LOCK:
+            camera = adafruit_mlx90640.MLX90640(i2c, address=address)
+    camera.refresh_rate = adafruit_mlx90640.RefreshRate.REFRESH_1_HZ
+    return camera
+
+
+class FastMLX90640(adafruit_mlx90640.MLX90640):
+    """Drop-in replacement of the Adafruit MLX90640 driver with a NumPy engine.
+
+    The EEPROM readout and the calibration parameter extraction are the ones of
+    the Adafruit driver, but the per-pixel parameters are then turned into
+    arrays once, and the temperature of a subpage is computed with whole-array
+    operations instead of a Python loop over the 768 pixels. The raw frame data
+    is read from the sensor straight into a ``numpy.uint16`` buffer.
+
+    The temperatures agree with ``adafruit_mlx90640.MLX90640.getFrame`` within
+    ``TOLERANCE`` degrees Celsius. Pixels for which the Adafruit driver would
+    take the square root of a negative number are returned as NaN instead of
+    raising ``ValueError``.
+
+    The extracted parameters can be cached on disk, keyed by the address of
+    the camera and the checksum of its EEPROM: when the EEPROM did not change,
+    starting a camera only costs the EEPROM readout.
+
+    Parameters
+    ----------
+    i2c_bus : busio.I2C or simulation.SimulatedI2C
+        I2C bus the camera is connected to.
+    address : int
+        I2C address of the camera.
+    cache_dir : str, optional
+        Directory of the calibration parameter cache, no cache if not given.
+
+    Attributes
+    ----------
+    eeprom : numpy.ndarray
+        Copy of the 832 EEPROM words of the camera.
+    checksum : int
+        CRC32 of the EEPROM.
+    """
+
+    TOLERANCE = 1e-6
+    FRAME_WORDS = 834
+
+    # Per-pixel calibration attributes are class-level lists in the Adafruit
+    # driver, shared by every camera: they are reset per instance here.
+    _PER_INSTANCE_PARAMETERS = {
+        "ksTo": 5,
+        "ct": 5,
+        "alpha": 768,
+        "offset": 768,
+        "kta": 768,
+        "kv": 768,
+        "cpAlpha": 2,
+        "cpOffset": 2,
+        "ilChessC": 3,
+    }
+    # Attributes set by the Adafruit calibration parameter extraction
+    _CALIBRATION_PARAMETERS = (
+        "kVdd",
+        "vdd25",
+        "KvPTAT",
+        "KtPTAT",
+        "vPTAT25",
+        "alphaPTAT",
+        "gainEE",
+        "tgc",
+        "KsTa",
+        "resolutionEE",
+        "calibrationModeEE",
+        "ksTo",
+        "ct",
+        "alpha",
+        "alphaScale",
+        "offset",
+        "kta",
+        "ktaScale",
+        "kv",
+        "kvScale",
+        "cpAlpha",
+        "cpOffset",
+        "ilChessC",
+        "brokenPixels",
+        "outlierPixels",
+        "cpKta",
+        "cpKv",
+    )
+
+    def __init__(self, i2c_bus, address=0x33, cache_dir=None):
+        self.i2c_device = I2CDevice(i2c_bus, address)
+        for name, size in self._PER_INSTANCE_PARAMETERS.items():
+            setattr(self, name, [0] * size)
+        self.brokenPixels = []
+        self.outlierPixels = []
+        self._frame = np.zeros((self.FRAME_WORDS,), dtype=np.uint16)
+        self.eeprom = np.zeros((832,), dtype=np.uint16)
+        self._I2CReadArray(0x2400, self.eeprom)
+        self.checksum = zlib.crc32(self.eeprom.tobytes())
+        cache_file = None
+        if cache_dir is not None:
+            cache_file = os.path.join(cache_dir, f"mlx90640_0x{address:02x}.json")
+        if not self._load_calibration(cache_file):
+            with _EEPROM_LOCK:
+                adafruit_mlx90640.eeData[:] = self.eeprom.tolist()
+                self._ExtractParameters()
+            if cache_file is not None:
+                self._save_calibration(cache_file)
+        self._build_calibration_arrays()
+
+    def _load_calibration(self, cache_file):
+        """Load the calibration parameters from the cache.
+
+        Parameters
+        ----------
+        cache_file : str
+            Path of the cache file.
+
+        Returns
+        -------
+        loaded : bool
+            Whether valid parameters for this EEPROM were found.
+        """
+        if cache_file is None or not os.path.exists(cache_file):
+            return False
+        try:
+            with open(cache_file, "r") as f:
+                cache = json.load(f)
+            if cache["checksum"] != self.checksum:
+                logging.info(f"EEPROM of camera {hex(self.i2c_device.device_address)} changed, ignoring the cache.")
+                return False
+            for name in self._CALIBRATION_PARAMETERS:
+                setattr(self, name, cache["parameters"][name])
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning(f"Invalid calibration cache {cache_file}: {e}")
+            return False
+        return True
+
+    def _save_calibration(self, cache_file):
+        """Save the calibration parameters to the cache.
+
+        Parameters
+        ----------
+        cache_file : str
+            Path of the cache file.
+        """
+        cache = {
+            "address": self.i2c_device.device_address,
+            "checksum": self.checksum,
+            "parameters": {name: getattr(self, name) for name in self._CALIBRATION_PARAMETERS},
+        }
+        directory = os.path.dirname(cache_file) or "."
+        try:
+            os.makedirs(directory, exist_ok=True)
+            # A temporary file of its own, the cameras may be created concurrently
+            fd, path = tempfile.mkstemp(prefix=f"{os.path.basename(cache_file)}.", suffix=".tmp", dir=directory)
+        except OSError as e:
+            logging.warning(f"Could not save the calibration cache {cache_file}: {e}")
+            return
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(cache, f)
+            os.replace(path, cache_file)
+        except OSError as e:
+            logging.warning(f"Could not save the calibration cache {cache_file}: {e}")
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _build_calibration_arrays(self):
+        """Turn the extracted calibration parameters into NumPy arrays."""
+        pixel = np.arange(768)
+        self._il_pattern = pixel // 32 - (pixel // 64) * 2
+        self._chess_pattern = self._il_pattern ^ (pixel - (pixel // 2) * 2)
+        conversion_pattern = (
+            (pixel + 2) // 4 - (pixel + 3) // 4 + (pixel + 1) // 4 - pixel // 4
+        ) * (1 - 2 * self._il_pattern)
+        self._il_correction = self.ilChessC[2] * (2 * self._il_pattern - 1) - self.ilChessC[1] * conversion_pattern
+
+        self._offset = np.array(self.offset, dtype=np.float64)
+        self._kta = np.array(self.kta, dtype=np.float64) / 2**self.ktaScale
+        self._kv = np.array(self.kv, dtype=np.float64) / 2**self.kvScale
+        self._alpha = adafruit_mlx90640.SCALEALPHA * 2**self.alphaScale / np.array(self.alpha, dtype=np.float64)
+        self._bad_pixels = np.zeros((768,), dtype=bool)
+        self._bad_pixels[self.brokenPixels + self.outlierPixels] = True
+
+        self._ct = np.array(self.ct[:4], dtype=np.float64)
+        self._ks_to = np.array(self.ksTo[:4], dtype=np.float64)
+        alpha_corr_r2 = 1 + self.ksTo[1] * self.ct[2]
+        self._alpha_corr_r = np.array(
+            [
+                1 / (1 + self.ksTo[0] * 40),
+                1,
+                alpha_corr_r2,
+                alpha_corr_r2 * (1 + self.ksTo[2] * (self.ct[3] - self.ct[2])),
+            ]
+        )
+
+    def _I2CReadArray(self, addr, buffer, end=None):
+        """Read 16 bit words from the sensor directly into a NumPy array.
+
+        Parameters
+        ----------
+        addr : int
+            Address of the first word to read.
+        buffer : numpy.ndarray
+            ``uint16`` array to fill.
+        end : int, optional
+            Number of words to read, defaults to the length of ``buffer``.
+        """
+        remaining_words = len(buffer) if end is None else end
+        offset = 0
+        addrbuf = bytearray(2)
+        inbuf = bytearray(2 * adafruit_mlx90640.I2C_READ_LEN)
+        with self.i2c_device as i2c:
+            while remaining_words:
+                addrbuf[0] = addr >> 8
+                addrbuf[1] = addr & 0xFF
+                read_words = min(remaining_words, adafruit_mlx90640.I2C_READ_LEN)
+                i2c.write_then_readinto(addrbuf, inbuf, in_end=read_words * 2)
+                buffer[offset : offset + read_words] = np.frombuffer(inbuf, dtype=">u2", count=read_words)
+                offset += read_words
+                remaining_words -= read_words
+                addr += read_words
+
+    def _GetFrameData(self, frameData):
+        data_ready = 0
+        cnt = 0
+        status_register = [0]
+        control_register = [0]
+
+        while data_ready == 0:
+            self._I2CReadWords(0x8000, status_register)
+            data_ready = status_register[0] & 0x0008
+
+        while (data_ready != 0) and (cnt < 5):
+            self._I2CWriteWord(0x8000, 0x0030)
+            self._I2CReadArray(0x0400, frameData, end=832)
+            self._I2CReadWords(0x8000, status_register)
+            data_ready = status_register[0] & 0x0008
+            cnt += 1
+
+        if cnt > 4:
+            raise RuntimeError("Too many retries")
+
+        self._I2CReadWords(0x800D, control_register)
+        frameData[832] = control_register[0]
+        frameData[833] = status_register[0] & 0x0001
+        return int(frameData[833])
+
+    def getFrame(self, framebuf):
+        """Read both subpages of a frame and compute the pixel temperatures.
+
+        Parameters
+        ----------
+        framebuf : numpy.ndarray
+            768-element array filled with the temperatures in Celsius.
+        """
+        emissivity = 0.95
+        for _ in range(2):
+            status = self._GetFrameData(self._frame)
+            if status < 0:
+                raise RuntimeError("Frame data error")
+            # For a MLX90640 in the open air the shift is -8 degC.
+            tr = self._GetTa(self._frame.tolist()) - adafruit_mlx90640.OPENAIR_TA_SHIFT
+            self._CalculateTo(self._frame, emissivity, tr, framebuf)
+
+    def _CalculateTo(self, frameData, emissivity, tr, result):
+        """Compute the temperatures of the pixels of one subpage.
+
+        Parameters
+        ----------
+        frameData : numpy.ndarray
+            ``uint16`` array with the 834 words of the subpage.
+        emissivity : float
+            Emissivity of the observed objects.
+        tr : float
+            Reflected temperature in Celsius.
+        result : numpy.ndarray
+            768-element array where the subpage pixels are written.
+        """
+        # The scalar corrections reuse the Adafruit code on plain integers
+        words = frameData.tolist()
+        sub_page = words[833]
+        vdd = self._GetVdd(words)
+        ta = self._GetTa(words)
+
+        ta4 = ta + 273.15
+        ta4 *= ta4
+        ta4 *= ta4
+        tr4 = tr + 273.15
+        tr4 *= tr4
+        tr4 *= tr4
+        ta_tr = tr4 - (tr4 - ta4) / emissivity
+
+        gain = words[778]
+        if gain > 32767:
+            gain -= 65536
+        gain = self.gainEE / gain
+
+        mode = (words[832] & 0x1000) >> 5
+        ir_data_cp = [words[776], words[808]]
+        for i in range(2):
+            if ir_data_cp[i] > 32767:
+                ir_data_cp[i] -= 65536
+            ir_data_cp[i] *= gain
+        cp_offset = [self.cpOffset[0], self.cpOffset[1]]
+        if mode != self.calibrationModeEE:
+            cp_offset[1] += self.ilChessC[0]
+        for i in range(2):
+            ir_data_cp[i] -= cp_offset[i] * (1 + self.cpKta * (ta - 25)) * (1 + self.cpKv * (vdd - 3.3))
+
+        ir_data = frameData[:768].view(np.int16) * gain
+        ir_data -= self._offset * (1 + self._kta * (ta - 25)) * (1 + self._kv * (vdd - 3.3))
+        if mode != self.calibrationModeEE:
+            ir_data += self._il_correction
+        ir_data -= self.tgc * ir_data_cp[sub_page]
+        ir_data /= emissivity
+
+        alpha_compensated = self._alpha * (1 + self.KsTa * (ta - 25))
+        with np.errstate(invalid="ignore"):
+            sx = alpha_compensated**3 * (ir_data + alpha_compensated * ta_tr)
+            sx = np.sqrt(np.sqrt(sx)) * self.ksTo[1]
+            to = np.sqrt(np.sqrt(ir_data / (alpha_compensated * (1 - self.ksTo[1] * 273.15) + sx) + ta_tr)) - 273.15
+            torange = np.digitize(to, self._ct[1:4])
+            to = (
+                np.sqrt(
+                    np.sqrt(
+                        ir_data
+                        / (
+                            alpha_compensated
+                            * self._alpha_corr_r[torange]
+                            * (1 + self._ks_to[torange] * (to - self._ct[torange]))
+                        )
+                        + ta_tr
+                    )
+                )
+                - 273.15
+            )
+
+        pattern = self._il_pattern if mode == 0 else self._chess_pattern
+        sub_page_pixels = (pattern == sub_page) & ~self._bad_pixels
+        result[sub_page_pixels] = to[sub_page_pixels]
+        result[self._bad_pixels] = -273.15
+
+
+
+FrameRecord = namedtuple("FrameRecord", ["frame", "sequence", "timestamp", "position"])
+
+
+class FrameRing:
+    """Preallocated ring of float32 frame slots of a camera.
+
+    Frames are written in place into the next slot, so reading a frame does
+    not allocate: the returned arrays are views of the ring, valid until the
+    ring wraps around and the slot is reused. Copy a frame to keep it longer.
+
+    Parameters
+    ----------
+    size : int
+        Number of slots.
+    pixels : int
+        Number of pixels of a frame.
+
+    Attributes
+    ----------
+    frames : numpy.ndarray
+        ``(size, pixels)`` float32 array holding the frames.
+    sequence : numpy.ndarray
+        Sequence number of the frame in each slot, -1 if empty.
+    timestamp : numpy.ndarray
+        Acquisition time of the frame in each slot (seconds since the epoch).
+    position : numpy.ndarray
+        Motor position of the frame in each slot in degrees.
+    """
+
+    def __init__(self, size=16, pixels=24 * 32):
+        self.frames = np.zeros((size, pixels), dtype=np.float32)
+        self.sequence = np.full((size,), -1, dtype=np.int64)
+        self.timestamp = np.zeros((size,))
+        self.position = np.full((size,), np.nan)
+        self._count = 0
+        self._committed = 0
+        self._latest = None
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Reserve the next slot for writing.
+
+        Returns
+        -------
+        index : int
+            Index of the slot.
+        buffer : numpy.ndarray
+            View of the slot to write the frame into.
+        """
+        with self._lock:
+            index = self._count % len(self.frames)
+            self._count += 1
+            self.sequence[index] = -1
+        return index, self.frames[index]
+
+    def commit(self, index, position, timestamp=None):
+        """Publish the frame written into a slot.
+
+        Parameters
+        ----------
+        index : int
+            Index of the slot, as returned by ``acquire``.
+        position : float
+            Motor position in degrees when the frame was acquired.
+        timestamp : float, optional
+            Acquisition time, defaults to now.
+
+        Returns
+        -------
+        sequence : int
+            Sequence number of the frame.
+        """
+        with self._lock:
+            sequence = self._committed
+            self._committed += 1
+            self.sequence[index] = sequence
+            self.timestamp[index] = time.time() if timestamp is None else timestamp
+            self.position[index] = position
+            self._latest = index
+        return sequence
+
+    def record(self, index):
+        """Get the frame in a slot with its metadata.
+
+        Parameters
+        ----------
+        index : int
+            Index of the slot.
+
+        Returns
+        -------
+        record : FrameRecord
+            Frame view, sequence number, timestamp and position.
+        """
+        return FrameRecord(
+            self.frames[index],
+            int(self.sequence[index]),
+            float(self.timestamp[index]),
+            float(self.position[index]),
+        )
+
+    def latest(self):
+        """Get the latest committed slot.
+
+        Returns
+        -------
+        index : int
+            Index of the slot, None if no frame was committed yet.
+        """
+        return self._latest
+
+
+class FrameCache:
+    """Latest frames of the cameras, shared by all the frame consumers.
+
+    A reader gets the latest frame of a camera if it is fresh enough, and
+    otherwise the next one. A single reader at a time reads a camera, the
+    owner of its acquisition, while the others wait for its frame: concurrent
+    requests for the same camera make one bus read.
+
+    A frame is fresh if it was acquired at the current motor position, less
+    than ``max_age`` seconds ago and, when asked, after the frame with
+    sequence number ``newer_than``.
+
+    Parameters
+    ----------
+    rings : dict
+        ``FrameRing`` of each camera, holding the frames.
+    read : callable
+        Function taking a camera name, acquiring a new frame into the ring of
+        the camera and returning its ``FrameRecord``.
+    position : callable
+        Function returning the current motor position.
+    ttl : float
+        Default maximum age of a cached frame in seconds.
+    """
+
+    def __init__(self, rings, read, position, ttl=0.5):
+        self.rings = rings
+        self.read = read
+        self.position = position
+        self.ttl = ttl
+        self.reads = dict.fromkeys(rings, 0)
+        self.hits = dict.fromkeys(rings, 0)
+        self._conditions = {camera: threading.Condition() for camera in rings}
+        self._acquiring = dict.fromkeys(rings, False)
+
+    def latest(self, camera):
+        """Get the latest frame of a camera without reading it.
+
+        Returns
+        -------
+        record : FrameRecord
+            Latest frame, None if no frame was acquired yet.
+        """
+        ring = self.rings[camera]
+        index = ring.latest()
+        return None if index is None else ring.record(index)
+
+    def _fresh(self, record, newer_than, max_age):
+        # A frame read while the motor moved has no position, it is never fresh
+        return (
+            record is not None
+            and np.isfinite(record.position)
+            and (newer_than is None or record.sequence > newer_than)
+            and time.time() - record.timestamp <= max_age
+            and record.position == self.position()
+        )
+
+    def get(self, camera, newer_than=None, max_age=None, timeout=None):
+        """Get a fresh frame of a camera, reading it only if needed.
+
+        Parameters
+        ----------
+        camera : str
+            Name of the camera.
+        newer_than : int, optional
+            Sequence number the frame must be newer than.
+        max_age : float, optional
+            Maximum age of the frame in seconds, ``ttl`` by default. With 0,
+            the next frame is returned, read by this reader or by a
+            concurrent one.
+        timeout : float, optional
+            Maximum time to wait for the read of another reader.
+
+        Returns
+        -------
+        record : FrameRecord
+            Frame view in the camera ring, sequence number, acquisition
+            timestamp and motor position.
+        """
+        max_age = self.ttl if max_age is None else max_age
+        if max_age == 0:
+            # Any frame committed after the call is fresh enough
+            latest = self.latest(camera)
+            if latest is not None:
+                newer_than = latest.sequence if newer_than is None else max(newer_than, latest.sequence)
+            max_age = float("inf")
+        condition = self._conditions[camera]
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with condition:
+            while True:
+                record = self.latest(camera)
+                # A frame committed while waiting is fresh enough for the waiters
+                if self._fresh(record, newer_than, max_age):
+                    self.hits[camera] += 1
+                    return record
+                if not self._acquiring[camera]:
+                    self._acquiring[camera] = True
+                    break
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise TimeoutError(f"No frame of {camera} within {timeout} s")
+                condition.wait(remaining)
+        try:
+            record = self.read(camera)
+            self.reads[camera] += 1
+            return record
+        finally:
+            with condition:
+                self._acquiring[camera] = False
+                condition.notify_all()
+
+    def next(self, camera, timeout=None):
+        """Get the next frame of a camera, acquired after the call."""
+        return self.get(camera, max_age=0, timeout=timeout)
+
+    def stats(self):
+        """Get the number of bus reads and of frames served from the cache of each camera."""
+        return {camera: {"reads": self.reads[camera], "hits": self.hits[camera]} for camera in self.rings}
+
+
+class CameraPool(Mapping):
+    """Read-only dictionary of cameras created in parallel in the background.
+
+    Creating an MLX90640 driver reads the camera EEPROM and extracts its
+    calibration, so the cameras are created in worker threads as soon as the
+    pool is built, and accessing a camera waits only for that camera.
+
+    Parameters
+    ----------
+    factories : dict
+        Functions creating the cameras, keyed by camera name.
+
+    Attributes
+    ----------
+    startup_time : float
+        Time in seconds needed to create all the cameras, None until then.
+    """
+
+    def __init__(self, factories):
+        self.startup_time = None
+        self._start = time.monotonic()
+        self._lock = threading.Lock()
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(len(factories), 1), thread_name_prefix="camera")
+        self._futures = {name: executor.submit(factory) for name, factory in factories.items()}
+        executor.shutdown(wait=False)
+        for future in self._futures.values():
+            future.add_done_callback(self._camera_created)
+
+    def _camera_created(self, future):
+        with self._lock:
+            if self.startup_time is None and all(f.done() for f in self._futures.values()):
+                self.startup_time = time.monotonic() - self._start
+                logging.info(f"Thermal cameras ready in {self.startup_time:.3f} s.")
+
+    def __getitem__(self, name):
+        return self._futures[name].result()
+
+    def __iter__(self):
+        return iter(self._futures)
+
+    def __len__(self):
+        return len(self._futures)
+
+    def wait(self, timeout=None):
+        """Wait for all the cameras to be created.
+
+        Parameters
+        ----------
+        timeout : float
+            Maximum time to wait in seconds.
+
+        Returns
+        -------
+        startup_time : float
+            Time in seconds needed to create all the cameras.
+        """
+        concurrent.futures.wait(self._futures.values(), timeout=timeout)
+        self._camera_created(None)
+        return self.startup_time
+
+
 class ThermalCamera:
     """Class for the Thermal Camera system.
 
@@ -27,17 +709,52 @@ class ThermalCamera:
     ----------
     absolute_position : float
         Absolute position of the stepper motor in degrees.
+    engine : str
+        Temperature calculation engine of the cameras, one of ``ENGINES``.
+    backend : str or object, optional
+        Hardware backend or its name, see ``hardware.create_backend``.
+    cancel_event : threading.Event, optional
+        Event interrupting the current move or calibration when set.
+    acquisition : str
+        Where the frames are acquired, one of ``ACQUISITIONS``: ``thread``
+        reads the cameras in the threads of the readers, ``process`` in a
+        dedicated ``acquisition.AcquisitionProcess``, which needs the
+        backend by name.
 
     Attributes
     ----------
-    mlx_dict : dict
-        Dictionary containing the thermal cameras.
+    backend : object
+        Hardware backend.
+    mlx_dict : CameraPool
+        Dictionary containing the thermal cameras, None in process
+        acquisition where the cameras belong to the acquisition process.
+    acquisition : acquisition.AcquisitionProcess
+        Acquisition process, None in thread acquisition.
+    frame_rings : dict
+        ``FrameRing`` of each camera, the frames are acquired into, or
+        ``acquisition.SharedFrameRing`` in process acquisition.
+    frame_cache : FrameCache
+        Latest frame of each camera, through which all the frames are read.
+    frame_filters : dict
+        ``denoising.TemporalFilter`` of each camera, passing the frames
+        through until configured.
+    pixel_pipelines : dict
+        ``pixel_pipeline.PixelPipeline`` of each camera, correcting the
+        frames when they are read, from ``PIXEL_CALIBRATION``.
     kit : adafruit_motorkit.MotorKit
         MotorKit object.
     absolute_position : float
         Absolute position of the stepper motor in degrees.
+    gpio : module
+        ``RPi.GPIO`` or the simulated GPIO of the backend.
     pin : int
         GPIO pin to read the switch.
+    last_move : motion.MoveReport
+        Planned and actual duration of the last move, None before the first.
+    switch : homing.EdgeSwitch
+        Home switch.
+    last_homing : homing.HomingReport
+        Steps and duration of the last calibration, None before the first.
     """
 
     # Old values for the official adafruit software (not working)
@@ -47,8 +764,32 @@ class ThermalCamera:
     STEP_STYLE = stepper.MICROSTEP
     STEP_VALUE = 0.18
     STEP_TIME = 0.004
+    # Speed profile of the moves, in steps per second
+    MAX_STEP_RATE = 1 / STEP_TIME
+    START_STEP_RATE = MAX_STEP_RATE / 2
+    STEP_ACCELERATION = 1000
+    MOTION_PROFILE = "trapezoidal"
+    # Homing: fast approach, back-off larger than its overshoot, slow approach.
+    # The fast approach stays at the rate of the moves until a faster one is
+    # validated on the rig
+    HOMING_FAST_RATE = MAX_STEP_RATE
+    HOMING_SLOW_RATE = 50
+    HOMING_BACKOFF_STEPS = 12
+    ENGINES = {
+        "numpy": FastMLX90640,
+        "adafruit": adafruit_mlx90640.MLX90640,
+    }
+    ACQUISITIONS = ("thread", "process")
+    CALIBRATION_CACHE = CALIBRATION_CACHE
+    RING_SIZE = 16
+    # Maximum age of the cached frames served to the readers, in seconds
+    FRAME_TTL = 0.5
+    POSITION_JOURNAL = "absolute_position.csv"
+    PIXEL_CALIBRATION = "pixel_calibration.json"
+    # Maximum time to wait for a frame of the acquisition process, in seconds
+    ACQUISITION_TIMEOUT = 10.0
 
-    def __init__(self, absolute_position=None):
+    def __init__(self, absolute_position=None, engine="numpy", backend=None, cancel_event=None, acquisition="thread"):
         # Thermal camera setup
         self._addresses = [
             0x30,
@@ -56,19 +797,26 @@ class ThermalCamera:
             0x32,
             0x33,
         ]
-        self.mlx_dict = {
-            f"camera{i}": adafruit_mlx90640.MLX90640(busio.I2C(board.SCL, board.SDA, frequency=int(1e6)), address=addr)
-            for i, addr in enumerate(self._addresses)
-        }
-        for camera in self.mlx_dict.values():
-            camera.refresh_rate = adafruit_mlx90640.RefreshRate.REFRESH_1_HZ
+        if engine not in self.ENGINES:
+            logging.error(f"Engine must be one of {list(self.ENGINES)}.")
+            raise ValueError
+        if acquisition not in self.ACQUISITIONS:
+            logging.error(f"Acquisition must be one of {list(self.ACQUISITIONS)}.")
+            raise ValueError
+        if acquisition == "process" and not (backend is None or isinstance(backend, str)):
+            logging.error("The acquisition process needs the backend by name.")
+            raise ValueError
+        self._engine = engine
+        self.backend = create_backend(backend)
+        self.acquisition = None
         # Stepper motor setup
-        self.kit = MotorKit(i2c=board.I2C(), steppers_microsteps=10)
+        self.kit = self.backend.motor_kit()
         # TODO: pulse width customization
         # Absolute position of the stepper motor in degrees
-        # If no absolute position is given, try to import it from a file
+        # If no absolute position is given, try to import it from the journal
+        self.position_journal = PositionJournal(self.POSITION_JOURNAL)
         if absolute_position is None:
-            if os.path.exists("absolute_position.csv"):
+            if self.position_journal.last_position() is not None:
                 logging.info("No absolute position given, using last position.")
                 self.import_absolute_position()
             else:
@@ -76,10 +824,51 @@ class ThermalCamera:
                 self._absolute_position = 0.0
         else:
             self._absolute_position = absolute_position
+        cameras = [f"camera{i}" for i in range(len(self._addresses))]
+        if acquisition == "process":
+            self.mlx_dict = None
+            self.acquisition = AcquisitionProcess(
+                backend,
+                engine,
+                self._addresses,
+                cameras,
+                self.RING_SIZE,
+                self._absolute_position,
+                self.PIXEL_CALIBRATION,
+            )
+            self.frame_rings = self.acquisition.rings
+        else:
+            self.mlx_dict = CameraPool(
+                {camera: functools.partial(self._create_camera, addr) for camera, addr in zip(cameras, self._addresses)}
+            )
+            self.frame_rings = {camera: FrameRing(self.RING_SIZE) for camera in cameras}
+        self.frame_cache = FrameCache(self.frame_rings, self._read_frame, lambda: self.absolute_position, self.FRAME_TTL)
+        self.frame_filters = {camera: TemporalFilter() for camera in cameras}
+        self.pixel_pipelines = load_pixel_pipelines(self.PIXEL_CALIBRATION, cameras)
+        self.last_move = None
+        self.last_homing = None
+        self.cancel_event = threading.Event() if cancel_event is None else cancel_event
         # Set up the GPIO pins to read the switch
-        GPIO.setmode(GPIO.BCM)
-        self.pin = 23
-        GPIO.setup(self.pin, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
+        self.gpio = self.backend.gpio
+        self.gpio.setmode(self.gpio.BCM)
+        self.pin = SWITCH_PIN
+        self.gpio.setup(self.pin, self.gpio.IN, pull_up_down=self.gpio.PUD_DOWN)
+        self.switch = EdgeSwitch(self.gpio, self.pin)
+
+    def _create_camera(self, address):
+        """Create the driver of a thermal camera.
+
+        Parameters
+        ----------
+        address : int
+            Address of the camera.
+
+        Returns
+        -------
+        camera : adafruit_mlx90640.MLX90640
+            Camera driver.
+        """
+        return create_camera(self.backend, address, self._engine, self.CALIBRATION_CACHE)
 
     def address(self, camera):
         """Get the address of a thermal camera.
@@ -94,7 +883,7 @@ class ThermalCamera:
         address : int
             Address of the camera.
         """
-        return self._addresses[list(self.mlx_dict.keys()).index(camera)]
+        return self._addresses[list(self.frame_rings).index(camera)]
 
     @property
     def addresses(self):
@@ -112,10 +901,14 @@ class ThermalCamera:
             # logging.error("Absolute position must be between 0 and 360 degrees.")
             # raise ValueError
         self._absolute_position = value
-        self.export_absolute_position()
+        if self.acquisition is not None:
+            # The frames read while it changes get no position
+            self.acquisition.position = value
+        # Written in batches during a move, synced by export_absolute_position
+        self.position_journal.record(value)
 
     def get_frame(self, camera):
-        """Get a frame from the thermal camera.
+        """Get a frame from the thermal camera, denoised if a filter is set.
 
         Parameters
         ----------
@@ -125,11 +918,107 @@ class ThermalCamera:
         Returns
         -------
         buffer : numpy.ndarray
-            Array containing the frame.
+            Float32 frame.
+        """
+        return self.get_filtered_record(camera=camera, settle=True).frame
+
+    def configure_filter(self, mode=None, length=None, alpha=None):
+        """Set the temporal filter of the frames of all the cameras.
+
+        Parameters
+        ----------
+        mode : str, optional
+            One of ``denoising.MODES``.
+        length : int, optional
+            Number of frames of the moving average and median.
+        alpha : float, optional
+            Weight of the new frame in the exponential moving average.
+        """
+        config = next(iter(self.frame_filters.values())).config()
+        config.update({k: v for k, v in {"mode": mode, "length": length, "alpha": alpha}.items() if v is not None})
+        # Validated before replacing any filter
+        filters = {camera: TemporalFilter(**config) for camera in self.frame_filters}
+        self.frame_filters = filters
+
+    def get_filtered_record(self, camera, settle=False, newer_than=None, max_age=None, timeout=None):
+        """Get a frame denoised by the temporal filter of the camera.
+
+        Each frame is added once to the filter, which is reset when the motor
+        moves. Without filter, the frame is the one of ``get_frame_record``.
+
+        Parameters
+        ----------
+        camera : str
+            Name of the camera to get the frame from.
+        settle : bool
+            If True, new frames are acquired until the filter holds enough
+            frames of the current position, giving one clean frame instead
+            of several noisy ones.
+        newer_than, max_age, timeout : optional
+            Freshness of the first frame, see ``get_frame_record``.
+
+        Returns
+        -------
+        record : FrameRecord
+            Filtered frame, with the sequence number, timestamp and position
+            of the last frame added to the filter.
         """
-        buffer = np.zeros((24 * 32,))
+        frame_filter = self.frame_filters[camera]
+        record = self.get_frame_record(camera, newer_than=newer_than, max_age=max_age, timeout=timeout)
+        if frame_filter.mode == "none":
+            return record
+        # The filter is shared by the consumers, each one gets its own copy
+        frame = np.empty_like(record.frame)
+        frame_filter.update(record.frame, record.position, record.sequence, out=frame)
+        while settle and not frame_filter.settled:
+            record = self.get_frame_record(camera, max_age=0, timeout=timeout)
+            frame_filter.update(record.frame, record.position, record.sequence, out=frame)
+        return record._replace(frame=frame)
+
+    def get_frame_record(self, camera, newer_than=None, max_age=None, timeout=None):
+        """Get a frame from the thermal camera with its metadata.
+
+        The frame comes from the frame cache if it is fresh, see
+        ``FrameCache.get``.
+
+        Parameters
+        ----------
+        camera : str
+            Name of the camera to get the frame from.
+        newer_than : int, optional
+            Sequence number the frame must be newer than.
+        max_age : float, optional
+            Maximum age of the frame in seconds, ``FRAME_TTL`` by default, 0
+            for the next frame.
+        timeout : float, optional
+            Maximum time to wait for a frame read by another reader.
+
+        Returns
+        -------
+        record : FrameRecord
+            Frame view in the camera ring, sequence number, acquisition
+            timestamp and motor position.
+        """
+        return self.frame_cache.get(camera, newer_than=newer_than, max_age=max_age, timeout=timeout)
+
+    def _read_frame(self, camera):
+        """Acquire and correct a frame into the ring of a camera, returning its record."""
+        if self.acquisition is not None:
+            deadline = time.monotonic() + self.ACQUISITION_TIMEOUT
+            while True:
+                record = self.acquisition.next_record(camera, timeout=max(deadline - time.monotonic(), 0))
+                # The frames read while the motor moves have no position
+                if np.isfinite(record.position):
+                    return record
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"No frame of {camera} at a fixed position within {self.ACQUISITION_TIMEOUT} s")
+        ring = self.frame_rings[camera]
+        index, buffer = ring.acquire()
         self.mlx_dict[camera].getFrame(buffer)
-        return buffer
+        # Once for all the consumers of the frame
+        self.pixel_pipelines[camera].correct(buffer)
+        ring.commit(index, self.absolute_position)
+        return ring.record(index)
 
     def get_frame_as_bytes(self, camera):
         """Get a frame from the thermal camera as bytes.
@@ -144,8 +1033,22 @@ class ThermalCamera:
         buffer : bytearray
             Array containing the frame.
         """
-        buffer = self.get_frame(camera=camera)
-        return bytearray(struct.pack("f" * len(buffer), *buffer))
+        return bytearray(self.get_frame_as_memoryview(camera=camera))
+
+    def get_frame_as_memoryview(self, camera):
+        """Get a frame from the thermal camera as bytes, without copying it.
+
+        Parameters
+        ----------
+        camera : str
+            Name of the camera to get the frame from.
+
+        Returns
+        -------
+        buffer : memoryview
+            Bytes of the float32 frame in the camera ring.
+        """
+        return memoryview(self.get_frame(camera=camera)).cast("B")
 
     def get_frame_as_image(self, camera):
         """Get a frame from the thermal camera as an image.
@@ -163,6 +1066,21 @@ class ThermalCamera:
         buffer = self.get_frame(camera=camera)
         return np.reshape(buffer, (24, 32))
 
+    def get_oriented_image(self, camera):
+        """Get a frame from the thermal camera as an upright, cropped image.
+
+        Parameters
+        ----------
+        camera : str
+            Name of the camera to get the frame from.
+
+        Returns
+        -------
+        image : numpy.ndarray
+            Image oriented and cropped by the pixel pipeline of the camera.
+        """
+        return self.pixel_pipelines[camera].orient(self.get_frame(camera=camera))
+
     def show_frame(self, camera):
         """Plot a frame from the thermal camera.
 
@@ -206,49 +1124,78 @@ class ThermalCamera:
         state : bool
             State of the switch.
         """
-        state = GPIO.input(self.pin)
-        if state == GPIO.HIGH:
+        state = self.gpio.input(self.pin)
+        if state == self.gpio.HIGH:
             return True
         else:
             return False
 
-    def rotate(self, angle, direction="fw"):
+    def rotate(self, angle, direction="fw", profile=None):
         """Rotate the stepper motor by a given angle.
 
+        The steps follow a precomputed speed profile and are taken at
+        absolute deadlines, see ``motion.execute``.
+
         Parameters
         ----------
         angle : float
             Angle to rotate the stepper motor by.
+        direction : str
+            Direction of rotation, ``"fw"`` or ``"bw"``.
+        profile : str, optional
+            Speed profile, one of ``motion.PROFILES``, by default
+            ``MOTION_PROFILE``.
+
+        Returns
+        -------
+        report : motion.MoveReport
+            Planned and actual duration of the move.
         """
         if direction not in ["fw", "bw"]:
             logging.error("Direction must be either 'fw' or 'bw'.")
             raise ValueError
         direction = stepper.FORWARD if direction == "fw" else stepper.BACKWARD
+        # Update the absolute position considering the direction of rotation
+        step_value = -self.STEP_VALUE if direction == stepper.BACKWARD else self.STEP_VALUE
 
-        # Round to the closest multiple of the step value
-        nsteps = round(angle / self.STEP_VALUE)
-        for _ in range(abs(nsteps)):
+        def step():
             self.kit.stepper1.onestep(style=self.STEP_STYLE, direction=direction)
-            # Update the absolute position considering the direction of rotation
-            if direction == stepper.BACKWARD:
-                self.absolute_position = self.absolute_position - self.STEP_VALUE
-            else:
-                self.absolute_position = self.absolute_position + self.STEP_VALUE
-            # Check if the switch is pressed
-            # state = self.get_switch_state()
-            # if state:
-            # logging.warning("Sensor found")
-            time.sleep(self.STEP_TIME)
-        logging.info(f"Stepper motor rotated by {angle} degrees.")
+            self.absolute_position = self.absolute_position + step_value
+
+        # Round to the closest multiple of the step value
+        plan = plan_move(
+            abs(angle),
+            self.STEP_VALUE,
+            self.MAX_STEP_RATE,
+            self.START_STEP_RATE,
+            self.STEP_ACCELERATION,
+            profile or self.MOTION_PROFILE,
+        )
+        self.last_move = execute(
+            plan, step, until=self.cancel_event.is_set, clock=self.backend.clock, sleep=self.backend.sleep
+        )
+        if self.cancel_event.is_set():
+            self.cancel_event.clear()
+            logging.warning(f"Move cancelled after {self.last_move.steps} of {plan.steps} steps.")
+        logging.info(
+            f"Stepper motor rotated by {angle} degrees in {self.last_move.actual_time:.3f} s "
+            f"(planned {self.last_move.planned_time:.3f} s, max step delay {self.last_move.max_lateness * 1e3:.1f} ms)."
+        )
         self.export_absolute_position()
+        return self.last_move
 
-    def go_to(self, position):
+    def go_to(self, position, wrap=False, profile=None):
         """Go to a given position.
 
         Parameters
         ----------
         position : float
             Position to go to.
+        wrap : bool
+            If True, take the shorter way around the circle, the position
+            being reached modulo 360 degrees.
+        profile : str, optional
+            Speed profile, see ``rotate``.
         """
         # if position < 0 or position > 360:
         #     if position < 0:
@@ -256,62 +1203,100 @@ class ThermalCamera:
         #     elif position > 360:
         #         direction = "bw"
         
-        if position >= self.absolute_position:
-            direction = "fw"
-        elif position < self.absolute_position:
-            direction = "bw"
-        self.rotate(abs(position - self.absolute_position), direction)
+        angle = shortest_path(self.absolute_position, position, wrap)
+        direction = "fw" if angle >= 0 else "bw"
+        self.rotate(abs(angle), direction, profile)
         logging.info(f"Stepper motor moved to {position} degrees.")
 
     def export_absolute_position(self):
-        """Export the absolute position of the stepper motor."""
-        with open("absolute_position.csv", "a") as f:
-            f.write(f"{time.strftime('%Y-%m-%d %H:%M:%S')},{self.absolute_position}\n")
+        """Export the absolute position of the stepper motor to disk."""
+        self.position_journal.sync(self.absolute_position)
         logging.info("Exported absolute position.")
 
     def import_absolute_position(self):
         """Import the absolute position of the stepper motor."""
-        with open("absolute_position.csv", "r") as f:
-            lines = f.readlines()
-        self.absolute_position = float(lines[-1].split(",")[1])
+        position = self.position_journal.last_position()
+        if position is None:
+            logging.error("No absolute position found in the journal.")
+            raise ValueError
+        self.absolute_position = position
         logging.info("Imported absolute position.")
 
     def calibrate(self, prudence=180, direction="bw"):
         """Calibrate the stepper motor.
 
+        The motor approaches the switch fast, stops on its GPIO edge, backs
+        off and approaches it again slowly, see ``homing.home``.
+
         Parameters
         ----------
         prudence : float
             Maximum angle to rotate the stepper motor.
         direction : str
             Direction to rotate the stepper motor.
+
+        Returns
+        -------
+        report : homing.HomingReport
+            Steps and duration of the calibration.
         """
         if direction not in ["fw", "bw"]:
             logging.error("Direction must be either 'fw' or 'bw'.")
             raise ValueError
         direction = stepper.FORWARD if direction == "fw" else stepper.BACKWARD
-        update_pos_func = lambda x: (
-            (self.absolute_position + x) % 360 if direction == stepper.FORWARD else (self.absolute_position - x) % 360
-        )
+        opposite = stepper.BACKWARD if direction == stepper.FORWARD else stepper.FORWARD
+        step_value = self.STEP_VALUE if direction == stepper.FORWARD else -self.STEP_VALUE
+
+        def approach():
+            self.kit.stepper1.onestep(direction=direction, style=self.STEP_STYLE)
+            self.absolute_position = (self.absolute_position + step_value) % 360
+
+        def retreat():
+            self.kit.stepper1.onestep(direction=opposite, style=self.STEP_STYLE)
+            self.absolute_position = (self.absolute_position - step_value) % 360
+
         logging.info("Starting calibration.")
-        total_steps = round(prudence / self.STEP_VALUE)
-        steps = 0
-        while True:
-            if self.get_switch_state():
-                self.absolute_position = 0
-                logging.info("Sensor found: absolute position set to 0 degrees.")
-                break
-            else:
-                if steps >= total_steps:
-                    logging.warning("Sensor not found within the prudence angle.")
-                    break
-                else:
-                    self.kit.stepper1.onestep(direction=direction, style=self.STEP_STYLE)
-                    self.absolute_position = update_pos_func(self.STEP_VALUE)
-                    steps += 1
-                    time.sleep(0.01)
+        self.last_homing = home(
+            approach,
+            retreat,
+            self.switch,
+            round(prudence / self.STEP_VALUE),
+            self.HOMING_FAST_RATE,
+            self.HOMING_SLOW_RATE,
+            self.HOMING_BACKOFF_STEPS,
+            self.START_STEP_RATE,
+            self.STEP_ACCELERATION,
+            self.backend.clock,
+            self.backend.sleep,
+            self.cancel_event.is_set,
+        )
+        self.cancel_event.clear()
+        if self.last_homing.found:
+            self.absolute_position = 0
+            logging.info(f"Sensor found in {self.last_homing.duration:.2f} s: absolute position set to 0 degrees.")
+        else:
+            logging.warning("Sensor not found within the prudence angle.")
+        self.export_absolute_position()
+        return self.last_homing
+
+    def cancel_move(self):
+        """Interrupt the current move or calibration, the position stays exact."""
+        self.cancel_event.set()
 
     def release(self):
         """Release the stepper motor."""
         self.kit.stepper1.release()
+        self.export_absolute_position()
         logging.info("Stepper motor released.")
+
+    def close(self):
+        """Stop the acquisition process, if any, free its frame rings, and the edge detection of the switch.
+
+        The last position is synced to the journal, which is closed.
+        """
+        if self.acquisition is not None:
+            self.acquisition.close()
+            self.acquisition = None
+        self.switch.close()
+        self.export_absolute_position()
+        self.position_journal.close()
@@ -0,0 +1,370 @@
+"""Multi-resolution history of the temperature statistics of the frames.
+
+The statistics of every acquired frame (minimum, maximum, 5th and 95th
+percentiles) are aggregated per camera and motor position into buckets of
+each resolution, 1 s, 1 min and 1 h by default. A bucket is written when it
+ends, as an ``HISTORY_DTYPE`` row: the extrema of the bucket and the mean of
+the percentiles. The rows of a resolution are appended to chunk files of
+``CHUNK_BUCKETS`` buckets, ``<directory>/<resolution>s/<chunk>_<writer>.bin``,
+and a chunk older than the retention of its resolution is deleted as a whole.
+Each store writes its own files, in time order, so several processes (the
+MQTT service and the REST app) can record into the same directory.
+
+A query reads a single resolution, and only the rows of its time range from
+the memory-mapped chunks of all the writers: the long ranges only read the
+coarse rollups, never the frames nor the fine buckets.
+"""
+
+import os
+import glob
+import time
+import uuid
+import logging
+import threading
+import numpy as np
+
+from frame_format import camera_number
+
+# Bucket durations in seconds, finest first
+RESOLUTIONS = (1, 60, 3600)
+# Seconds each resolution is kept, None for ever
+RETENTION = {1: 86400, 60: 30 * 86400, 3600: None}
+CHUNK_BUCKETS = 3600
+# Number of buckets of the resolution chosen for a query
+MAX_POINTS = 1000
+HISTORY_DTYPE = np.dtype(
+    [
+        ("time", "<f8"),
+        ("camera", "u1"),
+        ("position", "<f4"),
+        ("count", "<u4"),
+        ("min", "<f4"),
+        ("max", "<f4"),
+        ("p05", "<f4"),
+        ("p95", "<f4"),
+    ]
+)
+
+
+class StatisticsStore:
+    """Store of the frame statistics, rolled up at several resolutions.
+
+    Every resolution aggregates the statistics of the frames directly, so
+    its buckets are exact whatever the finer ones kept. A frame arriving
+    after the bucket of its timestamp was written is counted in the current
+    bucket, or the last written one, so the rows of a file stay in time
+    order.
+
+    Parameters
+    ----------
+    directory : str
+        Directory of the store, created if needed.
+    resolutions : sequence of int
+        Bucket durations in seconds.
+    retention : dict, optional
+        Seconds each resolution is kept, None for ever, ``RETENTION`` by
+        default.
+    position_resolution : float
+        Width in degrees of the motor position bins.
+    """
+
+    def __init__(self, directory, resolutions=RESOLUTIONS, retention=None, position_resolution=1.0):
+        if position_resolution <= 0 or any(r <= 0 for r in resolutions):
+            raise ValueError("The resolutions must be positive")
+        self.directory = directory
+        self.resolutions = tuple(sorted(resolutions))
+        retention = RETENTION if retention is None else retention
+        self.retention = {r: retention.get(r) for r in self.resolutions}
+        self.position_resolution = position_resolution
+        self.rows_read = 0
+        self.rows_written = 0
+        # Name of the files of this store among the other writers of the directory
+        self.writer = uuid.uuid4().hex[:12]
+        # Open bucket of each resolution: start time and the aggregates by camera and position bin
+        self._buckets = {r: (None, {}) for r in self.resolutions}
+        self._written = {r: -np.inf for r in self.resolutions}
+        self._files = {}
+        self._lock = threading.Lock()
+        for r in self.resolutions:
+            os.makedirs(self._level_directory(r), exist_ok=True)
+        self.expire()
+
+    def _level_directory(self, resolution):
+        return os.path.join(self.directory, f"{resolution}s")
+
+    def _chunk_path(self, resolution, chunk):
+        return os.path.join(self._level_directory(resolution), f"{chunk:08d}_{self.writer}.bin")
+
+    def add(self, camera, timestamp, position, stats):
+        """Add the statistics of a frame.
+
+        Parameters
+        ----------
+        camera : str or int
+            Name or number of the camera.
+        timestamp : float
+            Acquisition time in seconds since the epoch.
+        position : float
+            Motor position in degrees, NaN if unknown.
+        stats : dict
+            ``min_temperature``, ``max_temperature``,
+            ``percentile05_temperature`` and ``percentile95_temperature``, see
+            ``FrameStatistics.header``.
+        """
+        number = camera if isinstance(camera, int) else camera_number(camera)
+        # Unknown positions, while moving, have their own bin
+        position_bin = -1 if np.isnan(position) else int(round(position % 360 / self.position_resolution))
+        values = (
+            stats["min_temperature"],
+            stats["max_temperature"],
+            stats["percentile05_temperature"],
+            stats["percentile95_temperature"],
+        )
+        with self._lock:
+            for r in self.resolutions:
+                start, aggregates = self._buckets[r]
+                bucket = max(timestamp // r * r, self._written[r])
+                if start is None or bucket > start:
+                    if aggregates:
+                        self._write(r, start, aggregates)
+                    start, aggregates = bucket, {}
+                    self._buckets[r] = (start, aggregates)
+                aggregate = aggregates.get((number, position_bin))
+                if aggregate is None:
+                    aggregates[(number, position_bin)] = [1, *values]
+                else:
+                    aggregate[0] += 1
+                    aggregate[1] = min(aggregate[1], values[0])
+                    aggregate[2] = max(aggregate[2], values[1])
+                    aggregate[3] += values[2]
+                    aggregate[4] += values[3]
+
+    def _rows(self, start, aggregates):
+        """Rows of the aggregates of a bucket."""
+        rows = np.zeros(len(aggregates), dtype=HISTORY_DTYPE)
+        for row, ((number, position_bin), (count, low, high, p05, p95)) in zip(rows, aggregates.items()):
+            row["time"] = start
+            row["camera"] = number
+            row["position"] = np.nan if position_bin < 0 else position_bin * self.position_resolution
+            row["count"] = count
+            row["min"] = low
+            row["max"] = high
+            row["p05"] = p05 / count
+            row["p95"] = p95 / count
+        return rows
+
+    def _write(self, resolution, start, aggregates):
+        chunk = int(start // (resolution * CHUNK_BUCKETS))
+        current = self._files.get(resolution)
+        if current is None or current[0] != chunk:
+            if current is not None:
+                current[1].close()
+            current = (chunk, open(self._chunk_path(resolution, chunk), "ab"))
+            self._files[resolution] = current
+            self._expire(resolution, start)
+        rows = self._rows(start, aggregates)
+        self._written[resolution] = start
+        current[1].write(rows.tobytes())
+        # Readable by the other processes once the bucket ends
+        current[1].flush()
+        self.rows_written += len(rows)
+
+    def flush(self, now=None):
+        """Write the buckets ended before a time, now by default."""
+        now = time.time() if now is None else now
+        with self._lock:
+            for r in self.resolutions:
+                start, aggregates = self._buckets[r]
+                if aggregates and start + r <= now:
+                    self._write(r, start, aggregates)
+                    self._buckets[r] = (None, {})
+
+    def close(self):
+        """Write the open buckets and close the files."""
+        with self._lock:
+            for r in self.resolutions:
+                start, aggregates = self._buckets[r]
+                if aggregates:
+                    self._write(r, start, aggregates)
+                self._buckets[r] = (None, {})
+            for _, f in self._files.values():
+                f.close()
+            self._files = {}
+
+    def expire(self, now=None):
+        """Delete the chunks older than the retention of their resolution."""
+        now = time.time() if now is None else now
+        with self._lock:
+            for r in self.resolutions:
+                self._expire(r, now)
+
+    def _expire(self, resolution, now):
+        retention = self.retention[resolution]
+        if retention is None:
+            return
+        span = resolution * CHUNK_BUCKETS
+        for chunk, path in self._chunks(resolution):
+            if (chunk + 1) * span <= now - retention:
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    logging.warning(f"Could not delete the expired statistics chunk {path}: {e}")
+
+    def _chunks(self, resolution):
+        chunks = []
+        for path in glob.glob(os.path.join(self._level_directory(resolution), "*.bin")):
+            try:
+                chunks.append((int(os.path.basename(path)[:-4].split("_")[0]), path))
+            except ValueError:
+                continue
+        return sorted(chunks)
+
+    def resolution(self, start=None, stop=None, max_points=MAX_POINTS):
+        """Get the finest resolution kept for a time range with at most ``max_points`` buckets."""
+        now = time.time()
+        if start is None:
+            return self.resolutions[-1]
+        stop = now if stop is None else stop
+        for r in self.resolutions:
+            retention = self.retention[r]
+            if (stop - start) / r <= max_points and (retention is None or start >= now - retention):
+                return r
+        return self.resolutions[-1]
+
+    def query(self, camera=None, start=None, stop=None, resolution=None, positions=False, max_points=MAX_POINTS):
+        """Get the statistics of a time range at one resolution.
+
+        Parameters
+        ----------
+        camera : str or int, optional
+            Name or number of the camera, all by default.
+        start, stop : float, optional
+            Time range in seconds since the epoch, ``stop`` excluded, or
+            relative to now if negative. The buckets overlapping the range
+            are selected.
+        resolution : float, optional
+            Minimum bucket duration in seconds, by default the finest kept for
+            the range with at most ``max_points`` buckets.
+        positions : bool
+            Whether to keep a row per motor position bin, instead of a row per
+            bucket and camera.
+        max_points : int
+            Maximum number of buckets of the default resolution.
+
+        Returns
+        -------
+        resolution : int
+            Bucket duration in seconds of the rows.
+        rows : numpy.ndarray
+            ``HISTORY_DTYPE`` rows, by time and camera.
+        """
+        now = time.time()
+        start = now + start if start is not None and start < 0 else start
+        stop = now + stop if stop is not None and stop < 0 else stop
+        if resolution is None:
+            resolution = self.resolution(start, stop, max_points)
+        else:
+            resolution = next((r for r in self.resolutions if r >= resolution), self.resolutions[-1])
+        span = resolution * CHUNK_BUCKETS
+        parts = []
+        with self._lock:
+            for chunk, path in self._chunks(resolution):
+                if (start is not None and (chunk + 1) * span <= start) or (stop is not None and chunk * span >= stop):
+                    continue
+                try:
+                    # Without the row of an interrupted write
+                    count = os.path.getsize(path) // HISTORY_DTYPE.itemsize
+                    if count == 0:
+                        continue
+                    data = np.memmap(path, dtype=HISTORY_DTYPE, mode="r", shape=(count,))
+                except (OSError, ValueError) as e:
+                    logging.warning(f"Skipping unreadable statistics chunk {path}: {e}")
+                    continue
+                # A writer writes its rows in time order, only those of the range are copied
+                times = data["time"]
+                low = 0 if start is None else np.searchsorted(times, start - resolution, side="right")
+                high = count if stop is None else np.searchsorted(times, stop, side="left")
+                rows = np.array(data[low:high])
+                del data, times
+                self.rows_read += len(rows)
+                parts.append(rows)
+            bucket, aggregates = self._buckets[resolution]
+            if aggregates:
+                parts.append(self._rows(bucket, aggregates))
+        rows = np.concatenate(parts) if parts else np.zeros(0, dtype=HISTORY_DTYPE)
+        selected = np.ones(len(rows), dtype=bool)
+        if camera is not None:
+            selected &= rows["camera"] == (camera if isinstance(camera, int) else camera_number(camera))
+        if start is not None:
+            selected &= rows["time"] + resolution > start
+        if stop is not None:
+            selected &= rows["time"] < stop
+        # Rows of a bucket written by several writers, or across restarts, are merged
+        return resolution, merge(rows[selected], ["time", "camera", "position"] if positions else ["time", "camera"])
+
+    def summary(self, camera=None, start=None, stop=None, positions=False, max_points=MAX_POINTS):
+        """Get the statistics of a whole time range, e.g. the maximum of each camera over a week.
+
+        The range is read at the resolution of ``query``, so its ends are
+        aligned to buckets of at most ``(stop - start) / max_points``
+        seconds.
+
+        Returns
+        -------
+        resolution : int
+            Bucket duration in seconds of the rows read.
+        rows : numpy.ndarray
+            ``HISTORY_DTYPE`` row of each camera, or of each camera and
+            position bin, ``time`` is the start of the first bucket.
+        """
+        resolution, rows = self.query(camera, start, stop, positions=positions, max_points=max_points)
+        return resolution, merge(rows, ["camera", "position"] if positions else ["camera"])
+
+
+def merge(rows, keys):
+    """Merge the ``HISTORY_DTYPE`` rows with the same values of some fields.
+
+    Parameters
+    ----------
+    rows : numpy.ndarray
+        Rows to merge.
+    keys : list of str
+        Fields of the groups, ``time``, ``camera`` and ``position``.
+
+    Returns
+    -------
+    merged : numpy.ndarray
+        Row of each group, sorted by the keys: the earliest time, the total
+        count, the extrema and the count-weighted mean percentiles, and NaN
+        positions unless grouped by position.
+    """
+    if len(rows) == 0:
+        return rows
+    # Unknown positions are one group
+    columns = [np.nan_to_num(rows[key], nan=-1) if key == "position" else rows[key] for key in keys]
+    order = np.lexsort(columns[::-1])
+    rows = rows[order]
+    first = np.zeros(len(rows), dtype=bool)
+    first[0] = True
+    for column in columns:
+        column = column[order]
+        first[1:] |= column[1:] != column[:-1]
+    starts = np.flatnonzero(first)
+    merged = rows[starts].copy()
+    counts = rows["count"].astype(np.float64)
+    merged["time"] = np.minimum.reduceat(rows["time"], starts)
+    merged["count"] = np.add.reduceat(rows["count"], starts)
+    merged["min"] = np.minimum.reduceat(rows["min"], starts)
+    merged["max"] = np.maximum.reduceat(rows["max"], starts)
+    for name in ("p05", "p95"):
+        merged[name] = np.add.reduceat(rows[name] * counts, starts) / merged["count"]
+    if "position" not in keys:
+        merged["position"] = np.nan
+    return merged
+
+
+def rows_to_dict(rows):
+    """Get JSON serializable lists of the fields of ``HISTORY_DTYPE`` rows, None for NaN."""
+    return {
+        name: [None if value != value else value for value in rows[name].tolist()] for name in HISTORY_DTYPE.names
+    }
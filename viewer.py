@@ -0,0 +1,275 @@
+"""Receiving and viewing of the frames published by the thermal camera system.
+
+The MQTT callback of ``FrameReceiver`` only queues the payloads: a worker
+thread decodes them and keeps the newest frame of each camera, so a viewer
+slower than the cameras skips frames instead of falling behind. A
+``FrameViewer`` draws the newest frames at a fixed rate, mapping the
+temperatures to colors with a lookup table and blitting only the images over
+a cached background.
+"""
+
+import json
+import time
+import logging
+import threading
+from collections import deque
+import numpy as np
+import matplotlib.pyplot as plt
+
+from frame_format import FrameDecoder, camera_number, decode_bundle
+
+TOPIC_ROOT = "/thermalcamera"
+TOPIC_BUNDLE = "/thermalcamera/frames"
+TOPIC_LAYOUT = "/thermalcamera/layout"
+
+
+class FrameReceiver:
+    """Decode the frame messages in a thread and keep the newest frame of each camera.
+
+    ``on_message`` is the ``on_message`` callback of an MQTT client
+    subscribed to the frames, the layouts and the bundles. A frame replaced
+    by a newer one of the same camera before being taken, or a message
+    pushed out of the full queue before being decoded, is dropped.
+
+    Parameters
+    ----------
+    maxsize : int
+        Maximum number of messages waiting to be decoded.
+
+    Attributes
+    ----------
+    layouts : dict
+        Gather index of the upright image of each camera number, published by
+        the service.
+    """
+
+    LOG_EVERY = 100
+
+    def __init__(self, maxsize=64):
+        self.layouts = {}
+        self.received = 0
+        self.decoded = 0
+        self.dropped = 0
+        self.taken = 0
+        self.errors = 0
+        self.decoder = FrameDecoder()
+        self._queue = deque()
+        self._maxsize = maxsize
+        self._frames = {}
+        self._condition = threading.Condition()
+        self._stopping = False
+        self._thread = None
+
+    def start(self):
+        """Start decoding in a thread."""
+        self._stopping = False
+        self._thread = threading.Thread(target=self._loop, name="frame-receiver", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5.0):
+        """Stop decoding, the queued messages are discarded."""
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def on_message(self, client, userdata, msg):
+        with self._condition:
+            self.received += 1
+            if len(self._queue) >= self._maxsize:
+                self._queue.popleft()
+                self.dropped += 1
+            self._queue.append((msg.topic, msg.payload))
+            self._condition.notify()
+
+    def take(self):
+        """Take the frames decoded since the previous call.
+
+        Returns
+        -------
+        frames : dict
+            Newest ``FrameMessage`` of each camera number with a new frame.
+        """
+        with self._condition:
+            frames, self._frames = self._frames, {}
+            self.taken += len(frames)
+        return frames
+
+    def stats(self):
+        """Get the numbers of messages received, and of frames decoded, dropped and taken."""
+        with self._condition:
+            return {
+                "received": self.received,
+                "decoded": self.decoded,
+                "dropped": self.dropped,
+                "taken": self.taken,
+                "errors": self.errors,
+                "pending": len(self._queue),
+            }
+
+    def _loop(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._stopping or self._queue)
+                if self._stopping:
+                    return
+                topic, payload = self._queue.popleft()
+            try:
+                self._decode(topic, payload)
+            except Exception as e:
+                self.errors += 1
+                if self.errors == 1 or self.errors % self.LOG_EVERY == 0:
+                    logging.error(f"Error when decoding a message of {topic} ({self.errors} so far): {e}")
+
+    def _decode(self, topic, payload):
+        if topic.startswith(f"{TOPIC_LAYOUT}/"):
+            layout = json.loads(payload)
+            self.layouts[camera_number(topic.split("/")[-1])] = np.reshape(layout["index"], layout["shape"])
+            return
+        if topic == TOPIC_BUNDLE:
+            # All the cameras of an acquisition cycle in one message
+            frames = decode_bundle(payload)
+        elif topic.startswith(f"{TOPIC_ROOT}/camera") and topic.count("/") == 2:
+            frames = [(camera_number(topic.split("/")[2]), payload)]
+        else:
+            return
+        for number, frame in frames:
+            message = self.decoder.decode(frame, number)
+            if message is None:
+                # Delta frame received before its keyframe
+                continue
+            with self._condition:
+                self.decoded += 1
+                if number in self._frames:
+                    self.dropped += 1
+                self._frames[number] = message
+
+
+class FrameViewer:
+    """Draw the newest frames of the cameras at a fixed rate.
+
+    The temperatures are mapped to colors with a lookup table of the
+    colormap, and only the images and their labels are drawn again, over a
+    background kept from the last full draw. The frames per second rendered
+    and dropped are shown and logged every second.
+
+    Parameters
+    ----------
+    receiver : FrameReceiver
+        Receiver of the frames.
+    cameras : int
+        Number of cameras, shown on two columns.
+    fps : float
+        Frames per second of the display.
+    cmap : str
+        Name of the matplotlib colormap.
+    clim : tuple of float, optional
+        Fixed temperature range of the colormap, by default from the minimum
+        (at most 20 C) to the maximum of each frame.
+    """
+
+    LEVELS = 256
+
+    def __init__(self, receiver, cameras=4, fps=10.0, cmap="plasma", clim=None):
+        self.receiver = receiver
+        self.fps = fps
+        self.clim = clim
+        self.rendered = 0
+        self.rates = {"rendered": 0.0, "dropped": 0.0, "received": 0.0}
+        self.lut = (plt.get_cmap(cmap)(np.linspace(0, 1, self.LEVELS))[:, :3] * 255).astype(np.uint8)
+        rows = (cameras + 1) // 2
+        self.fig, axs = plt.subplots(rows, 2, figsize=(10, 4 * rows), squeeze=False)
+        blank = np.zeros((32, 24, 3), dtype=np.uint8)
+        self.images = []
+        self.labels = []
+        for i, ax in enumerate(axs.flat):
+            if i >= cameras:
+                ax.set_visible(False)
+                continue
+            ax.set_title(f"Camera {i}")
+            self.images.append(ax.imshow(blank, interpolation="nearest", animated=True))
+            self.labels.append(ax.text(0.02, 0.98, "", transform=ax.transAxes, va="top", color="white", animated=True))
+        self.status = self.fig.text(0.01, 0.01, "", animated=True)
+        self.artists = [*self.images, *self.labels, self.status]
+        self._background = None
+        self._last = (time.monotonic(), receiver.stats(), 0)
+        self.fig.canvas.mpl_connect("draw_event", self._on_draw)
+        self.timer = None
+
+    def colors(self, image, low, high):
+        """Map temperatures to RGB colors with the lookup table."""
+        scaled = (image - low) * ((self.LEVELS - 1) / max(high - low, 1e-6))
+        np.clip(scaled, 0, self.LEVELS - 1, out=scaled)
+        np.nan_to_num(scaled, copy=False)
+        return self.lut[scaled.astype(np.uint8)]
+
+    def update(self):
+        """Set the images of the new frames.
+
+        Returns
+        -------
+        changed : bool
+            Whether an artist changed and must be drawn.
+        """
+        frames = self.receiver.take()
+        for number, message in frames.items():
+            if number >= len(self.images):
+                continue
+            image = message.image
+            if self.clim is not None:
+                low, high = self.clim
+            else:
+                low = min(20, message.min_temperature if message.min_temperature is not None else image.min())
+                high = message.max_temperature if message.max_temperature is not None else image.max()
+            layout = self.receiver.layouts.get(number)
+            upright = image[layout] if layout is not None else np.flip(np.rot90(image.reshape(24, 32)), axis=0)
+            self.images[number].set_data(self.colors(upright, low, high))
+            self.labels[number].set_text(f"{low:.1f} - {high:.1f} C")
+            self.rendered += 1
+        now, stats, rendered = self._last
+        elapsed = time.monotonic() - now
+        if elapsed < 1:
+            return bool(frames)
+        current = self.receiver.stats()
+        self.rates = {
+            "rendered": (self.rendered - rendered) / elapsed,
+            "dropped": (current["dropped"] - stats["dropped"]) / elapsed,
+            "received": (current["received"] - stats["received"]) / elapsed,
+        }
+        self._last = (time.monotonic(), current, self.rendered)
+        self.status.set_text(
+            f"{self.rates['received']:.1f} msg/s, {self.rates['rendered']:.1f} frames/s rendered, "
+            f"{self.rates['dropped']:.1f} dropped"
+        )
+        logging.info(f"Viewer rates: {self.rates}")
+        return True
+
+    def draw(self):
+        """Draw the new frames, blitting the images over the cached background."""
+        if not self.update():
+            return
+        canvas = self.fig.canvas
+        if self._background is None:
+            # Draws the figure, then the artists in _on_draw
+            canvas.draw()
+            return
+        canvas.restore_region(self._background)
+        self._draw_artists()
+        canvas.blit(self.fig.bbox)
+
+    def _draw_artists(self):
+        for artist in self.artists:
+            self.fig.draw_artist(artist)
+
+    def _on_draw(self, event):
+        # Full draws, at the start and on resizes, do not include the animated artists
+        self._background = self.fig.canvas.copy_from_bbox(self.fig.bbox)
+        self._draw_artists()
+
+    def show(self):
+        """Show the window, drawing every ``1 / fps`` seconds until it is closed."""
+        self.timer = self.fig.canvas.new_timer(interval=int(1000 / self.fps))
+        self.timer.add_callback(self.draw)
+        self.timer.start()
+        plt.show()